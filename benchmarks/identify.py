@@ -0,0 +1,93 @@
+"""
+    benchmarks/identify
+    ~~~~~~~~~~~~~~~~~~~
+
+    Compares the frame rate of the per-frame identification
+    (local_maxima + net_gradient) with the fused kernel of
+    localize.identify_in_frames on synthetic frames, both run on a
+    thread pool as in localize.identify_async.
+
+    Usage: python -m benchmarks.identify [-t THREADS] [-g GRADIENT] [-b BOX]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from picasso import localize
+
+
+def synthetic_movie(n_frames, size, n_spots=200, seed=0):
+    """ Poisson background with Gaussian spots """
+    r = np.random.RandomState(seed)
+    y, x = np.mgrid[:size, :size]
+    movie = r.poisson(100, (n_frames, size, size)).astype(np.float32)
+    for frame in movie:
+        for yc, xc in r.uniform(5, size - 5, (n_spots, 2)):
+            window = slice(int(yc) - 4, int(yc) + 5), slice(
+                int(xc) - 4, int(xc) + 5
+            )
+            frame[window] += 500 * np.exp(
+                -((y[window] - yc) ** 2 + (x[window] - xc) ** 2) / 2
+            )
+    return movie.astype(np.uint16)
+
+
+def per_frame(movie, minimum_ng, box, executor):
+    list(
+        executor.map(
+            lambda i: localize.identify_by_frame_number(
+                movie, minimum_ng, box, i
+            ),
+            range(len(movie)),
+        )
+    )
+
+
+def batched(movie, minimum_ng, box, executor):
+    n = localize._identify_block_frames(movie)
+    list(
+        executor.map(
+            lambda i: localize.identify_in_frames(
+                movie[i: i + n], minimum_ng, box
+            ),
+            range(0, len(movie), n),
+        )
+    )
+
+
+def frames_per_second(function, movie, minimum_ng, box, n_threads):
+    with ThreadPoolExecutor(n_threads) as executor:
+        function(movie[:2], minimum_ng, box, executor)  # compile
+        t0 = time.time()
+        function(movie, minimum_ng, box, executor)
+        return len(movie) / (time.time() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-t", "--threads", type=int, default=os.cpu_count(), help="threads"
+    )
+    parser.add_argument(
+        "-g", "--gradient", type=float, default=5000, help="minimum gradient"
+    )
+    parser.add_argument("-b", "--box", type=int, default=7, help="box size")
+    args = parser.parse_args()
+    for size, n_frames in [(256, 400), (2048, 8)]:
+        movie = synthetic_movie(n_frames, size)
+        for name, function in [("per frame", per_frame), ("batched", batched)]:
+            fps = frames_per_second(
+                function, movie, args.gradient, args.box, args.threads
+            )
+            print(
+                "{}x{} {:<10} {:>10,.1f} frames/s ({} threads)".format(
+                    size, size, name, fps, args.threads
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+    benchmarks/render
+    ~~~~~~~~~~~~~~~~~
+
+    Compares the serial Gaussian rendering, which evaluates the 2D
+    exponential for every pixel of every kernel, with the tiled, threaded
+    renderer of render.render_gaussian on random localizations.
+
+    Usage: python -m benchmarks.render [-n LOCS] [-o OVERSAMPLING]
+"""
+import argparse
+import time
+
+import numba
+import numpy as np
+
+from picasso import render
+
+
+@numba.jit(nopython=True, nogil=True)
+def serial(image, x, y, sx, sy):
+    """ The previous kernel of render.render_gaussian """
+    n_pixel_y, n_pixel_x = image.shape
+    for x_, y_, sx_, sy_ in zip(x, y, sx, sy):
+        i_min, i_max, j_min, j_max = render._gaussian_bounds(
+            x_, y_, sx_, sy_, n_pixel_y, n_pixel_x
+        )
+        for i in range(i_min, i_max):
+            for j in range(j_min, j_max):
+                image[i, j] += np.exp(
+                    -(
+                        (j - x_ + 0.5) ** 2 / (2 * sx_ ** 2)
+                        + (i - y_ + 0.5) ** 2 / (2 * sy_ ** 2)
+                    )
+                ) / (2 * np.pi * sx_ * sy_)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--locs", type=int, default=1000000, help="localizations"
+    )
+    parser.add_argument(
+        "-o", "--oversampling", type=float, default=20, help="oversampling"
+    )
+    parser.add_argument("-s", "--size", type=int, default=256, help="pixels")
+    args = parser.parse_args()
+    r = np.random.RandomState(0)
+    x = args.oversampling * r.uniform(0, args.size, args.locs)
+    y = args.oversampling * r.uniform(0, args.size, args.locs)
+    sx = args.oversampling * r.uniform(0.05, 0.15, args.locs)
+    sy = args.oversampling * r.uniform(0.05, 0.15, args.locs)
+    shape = 2 * (int(np.ceil(args.oversampling * args.size)),)
+    for name, draw in [
+        ("serial", serial),
+        ("tiled", render._draw_gaussians),
+    ]:
+        draw(np.zeros((1, 1), dtype=np.float32), x[:1], y[:1], sx[:1], sy[:1])
+        image = np.zeros(shape, dtype=np.float32)
+        t0 = time.time()
+        draw(image, x, y, sx, sy)
+        dt = time.time() - t0
+        print(
+            "{:<8} {:>14,.0f} locs/s ({}x{} pixels)".format(
+                name, args.locs / dt, *shape
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
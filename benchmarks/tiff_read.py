@@ -0,0 +1,161 @@
+"""
+    benchmarks/tiff_read
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Compares the frame rate of concurrent TIFF frame reads with positioned
+    reads against the previous reader that locks every frame read.
+
+    Usage: python -m benchmarks.tiff_read [movie.ome.tif] [-t THREADS]
+        [-r REPEATS]
+    Without a movie, a synthetic uncompressed TIFF of --size GB is written
+    to a temporary folder first. The movie is read once before timing, and
+    the readers alternate in each repeat, such that neither runs with a
+    colder page cache. With --drop-caches (Linux, as root), the page cache
+    is dropped before every run instead.
+"""
+import argparse
+import os
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from picasso import io
+
+
+class LockedTiffMap(io.TiffMap):
+    """ The previous reader, which serializes all frame reads """
+
+    def __getitem__(self, index):
+        with self.lock:
+            self.file.seek(self.image_offsets[index])
+            frame = np.fromfile(
+                self.file, dtype=self._tif_dtype, count=self.frame_size
+            )
+        return frame.reshape(self.frame_shape)
+
+
+def write_tif(path, n_frames, height, width):
+    """ Writes a little endian, uncompressed uint16 TIFF with one strip """
+    frame_bytes = 2 * height * width
+    ifd_bytes = 2 + 7 * 12 + 4
+    frame = np.random.randint(0, 1000, (height, width)).astype("<u2")
+    with open(path, "wb") as f:
+        f.write(b"II" + struct.pack("<HL", 42, 8))
+        for i in range(n_frames):
+            offset = f.tell()
+            image_offset = offset + ifd_bytes
+            next_ifd = 0
+            if i < n_frames - 1:
+                next_ifd = image_offset + frame_bytes
+            entries = [
+                (256, 4, 1, width),
+                (257, 4, 1, height),
+                (258, 3, 1, 16),
+                (259, 3, 1, 1),
+                (273, 4, 1, image_offset),
+                (278, 4, 1, height),
+                (279, 4, 1, frame_bytes),
+            ]
+            f.write(struct.pack("<H", len(entries)))
+            for tag, type, count, value in entries:
+                if type == 3:
+                    f.write(struct.pack("<HHLHH", tag, type, count, value, 0))
+                else:
+                    f.write(struct.pack("<HHLL", tag, type, count, value))
+            f.write(struct.pack("<L", next_ifd))
+            frame.tofile(f)
+
+
+def drop_caches():
+    """ Writes dirty pages and drops the page cache (Linux, as root) """
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def frames_per_second(tif, n_threads):
+    """
+    Reads all frames of tif with n_threads threads. Read errors of any
+    thread are raised.
+    """
+    n_frames = len(tif)
+    current = [0]
+    lock = threading.Lock()
+
+    def worker():
+        n_read = 0
+        while True:
+            with lock:
+                index = current[0]
+                if index == n_frames:
+                    return n_read
+                current[0] += 1
+            tif[index].sum()
+            n_read += 1
+
+    t0 = time.time()
+    with ThreadPoolExecutor(n_threads) as executor:
+        futures = [executor.submit(worker) for _ in range(n_threads)]
+        n_read = sum([_.result() for _ in futures])
+    dt = time.time() - t0
+    assert n_read == n_frames
+    return n_read / dt
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", nargs="?", help="an uncompressed TIFF movie")
+    parser.add_argument(
+        "-s", "--size", type=float, default=2, help="GB of synthetic movie"
+    )
+    parser.add_argument(
+        "-t", "--threads", type=int, default=os.cpu_count(), help="threads"
+    )
+    parser.add_argument(
+        "-r", "--repeats", type=int, default=5, help="runs per reader"
+    )
+    parser.add_argument(
+        "--drop-caches",
+        action="store_true",
+        help="drop the page cache before every run (Linux, as root)",
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = args.file
+        if path is None:
+            path = os.path.join(tmp_dir, "benchmark.ome.tif")
+            n_frames = int(args.size * 1e9 / (2 * 512 * 512))
+            print("Writing {:,} frames to {}...".format(n_frames, path))
+            write_tif(path, n_frames, 512, 512)
+        readers = [("locked", LockedTiffMap), ("positioned", io.TiffMap)]
+        if not args.drop_caches:
+            with io.TiffMap(path) as tif:
+                frames_per_second(tif, args.threads)
+        fps = {name: [] for name, cls in readers}
+        for repeat in range(args.repeats):
+            # Alternate which reader goes first
+            for name, cls in readers[:: 1 if repeat % 2 == 0 else -1]:
+                if args.drop_caches:
+                    drop_caches()
+                with cls(path) as tif:
+                    fps[name].append(frames_per_second(tif, args.threads))
+        for name, cls in readers:
+            print(
+                "{:<12} {:>10,.0f} frames/s (median of {}, {:,.0f} to"
+                " {:,.0f}, {} threads)".format(
+                    name,
+                    np.median(fps[name]),
+                    args.repeats,
+                    min(fps[name]),
+                    max(fps[name]),
+                    args.threads,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
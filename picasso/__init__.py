@@ -5,10 +5,41 @@
     :authors: Joerg Schnitzbauer, Maximilian Thomas Strauss, 2016-2018
     :copyright: Copyright (c) 2016-2018 Jungmann Lab, MPI of Biochemistry
 """
+import os as _os
 import os.path as _ospath
+import sys as _sys
 import yaml as _yaml
 
 
+def _numba_cache_dir():
+    """
+    Compiled numba kernels are cached in ~/.picasso/numba_cache, unless
+    NUMBA_CACHE_DIR is set or the directory is not writable, such that the
+    cache does not depend on the install location and is shared by all
+    processes of a user. Numba replaces cache files atomically, so
+    concurrent workers can fill it.
+    """
+    cache_dir = _os.environ.get("NUMBA_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    cache_dir = _ospath.join(
+        _ospath.expanduser("~"), ".picasso", "numba_cache"
+    )
+    try:
+        _os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        return None
+    if not _os.access(cache_dir, _os.W_OK):
+        return None
+    _os.environ["NUMBA_CACHE_DIR"] = cache_dir
+    if "numba" in _sys.modules:
+        # Numba reads the environment only when it is imported
+        _sys.modules["numba"].config.CACHE_DIR = cache_dir
+    return cache_dir
+
+
+NUMBA_CACHE_DIR = _numba_cache_dir()
+
 _this_file = _ospath.abspath(__file__)
 _this_dir = _ospath.dirname(_this_file)
 try:
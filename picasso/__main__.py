@@ -40,8 +40,9 @@ def _hdf2visp(path, pixel_size):
 
         for path in paths:
             print("Converting {}".format(path))
-            locs, info = load_locs(path)
-            locs = locs[["x", "y", "z", "photons", "frame"]].copy()
+            locs, info = load_locs(
+                path, fields=["x", "y", "z", "photons", "frame"], lazy=True
+            )
             locs.x *= pixel_size
             locs.y *= pixel_size
             outname = os.path.splitext(path)[0] + ".3d"
@@ -168,77 +169,81 @@ def _hdf2csv(path):
     print("Complete.")
 
 
-def _link(files, d_max, tolerance):
-    import numpy as _np
-    from tqdm import tqdm as _tqdm
-    from . import lib as _lib
-    from h5py import File
-
+def _link(files, d_max, tolerance, indexed=False):
     import glob
+    from . import batch
 
     paths = glob.glob(files)
     if paths:
-        from . import io, postprocess
+        batch.map_files(
+            _link_file, paths, (d_max, tolerance), {"indexed": indexed}
+        )
 
-        for path in paths:
-            try:
-                locs, info = io.load_locs(path)
-            except io.NoMetadataFileError:
-                continue
-            linked_locs = postprocess.link(locs, info, d_max, tolerance)
-            base, ext = os.path.splitext(path)
-            link_info = {
-                "Maximum Distance": d_max,
-                "Maximum Transient Dark Time": tolerance,
-                "Generated by": "Picasso Link",
-            }
-            info.append(link_info)
-            io.save_locs(base + "_link.hdf5", linked_locs, info)
 
-            try:
-                # Check if there is a _clusters.hdf5 file present
-                # if yes update this file
-                cluster_path = base[:-7] + "_clusters.hdf5"
-                print(cluster_path)
-                clusters = io.load_clusters(cluster_path)
-                print("Clusterfile detected. Updating entries.")
-
-                n_after_link = []
-                linked_len = []
-                linked_n = []
-                linked_photonrate = []
-
-                for group in _tqdm(_np.unique(clusters["groups"])):
-                    temp = linked_locs[linked_locs["group"] == group]
-                    if len(temp) > 0:
-                        n_after_link.append(len(temp))
-                        linked_len.append(_np.mean(temp["len"]))
-                        linked_n.append(_np.mean(temp["n"]))
-                        linked_photonrate.append(_np.mean(temp["photon_rate"]))
-
-                clusters = _lib.append_to_rec(
-                    clusters,
-                    _np.array(n_after_link, dtype=_np.int32),
-                    "n_after_link",
-                )
-                clusters = _lib.append_to_rec(
-                    clusters,
-                    _np.array(linked_len, dtype=_np.int32),
-                    "linked_len",
-                )
-                clusters = _lib.append_to_rec(
-                    clusters, _np.array(linked_n, dtype=_np.int32), "linked_n"
-                )
-                clusters = _lib.append_to_rec(
-                    clusters,
-                    _np.array(linked_photonrate, dtype=_np.float32),
-                    "linked_photonrate",
-                )
-                with File(cluster_path, "w") as clusters_file:
-                    clusters_file.create_dataset("clusters", data=clusters)
-            except Exception as e:
-                print(e)
-                continue
+def _link_file(path, d_max, tolerance, indexed=False):
+    import numpy as _np
+    from tqdm import tqdm as _tqdm
+    from . import lib as _lib
+    from h5py import File
+    from . import io, postprocess
+
+    try:
+        locs, info = io.load_locs(path)
+    except io.NoMetadataFileError:
+        return
+    linked_locs = postprocess.link(locs, info, d_max, tolerance)
+    base, ext = os.path.splitext(path)
+    link_info = {
+        "Maximum Distance": d_max,
+        "Maximum Transient Dark Time": tolerance,
+        "Generated by": "Picasso Link",
+    }
+    info.append(link_info)
+    io.save_locs(base + "_link.hdf5", linked_locs, info, indexed=indexed)
+
+    try:
+        # Check if there is a _clusters.hdf5 file present
+        # if yes update this file
+        cluster_path = base[:-7] + "_clusters.hdf5"
+        print(cluster_path)
+        clusters = io.load_clusters(cluster_path)
+        print("Clusterfile detected. Updating entries.")
+
+        n_after_link = []
+        linked_len = []
+        linked_n = []
+        linked_photonrate = []
+
+        for group in _tqdm(_np.unique(clusters["groups"])):
+            temp = linked_locs[linked_locs["group"] == group]
+            if len(temp) > 0:
+                n_after_link.append(len(temp))
+                linked_len.append(_np.mean(temp["len"]))
+                linked_n.append(_np.mean(temp["n"]))
+                linked_photonrate.append(_np.mean(temp["photon_rate"]))
+
+        clusters = _lib.append_to_rec(
+            clusters,
+            _np.array(n_after_link, dtype=_np.int32),
+            "n_after_link",
+        )
+        clusters = _lib.append_to_rec(
+            clusters,
+            _np.array(linked_len, dtype=_np.int32),
+            "linked_len",
+        )
+        clusters = _lib.append_to_rec(
+            clusters, _np.array(linked_n, dtype=_np.int32), "linked_n"
+        )
+        clusters = _lib.append_to_rec(
+            clusters,
+            _np.array(linked_photonrate, dtype=_np.float32),
+            "linked_photonrate",
+        )
+        with File(cluster_path, "w") as clusters_file:
+            clusters_file.create_dataset("clusters", data=clusters)
+    except Exception as e:
+        print(e)
 
 
 def _cluster_combine(files):
@@ -281,6 +286,7 @@ def _cluster_combine_dist(files):
 
 def _clusterfilter(files, clusterfile, parameter, minval, maxval):
     from glob import glob
+    from itertools import chain
     from tqdm import tqdm
     import numpy as np
 
@@ -290,7 +296,7 @@ def _clusterfilter(files, clusterfile, parameter, minval, maxval):
 
         for path in paths:
             try:
-                locs, info = io.load_locs(path)
+                info = io.load_info(path)
             except io.NoMetadataFileError:
                 continue
 
@@ -308,66 +314,56 @@ def _clusterfilter(files, clusterfile, parameter, minval, maxval):
                         "Error: All localizations in range. Filtering aborted."
                     )
                 else:
-                    print("Isolating locs.. Step 1: in range")
-                    groups = clusters["groups"][selector]
-                    first = True
-                    for group in tqdm(groups):
-                        if first:
-                            all_locs = locs[locs["group"] == group]
-                            first = False
-                        else:
-                            all_locs = np.append(
-                                all_locs, locs[locs["group"] == group]
-                            )
-
+                    print("Isolating locs in and out of range...")
+                    groups_in = clusters["groups"][selector]
+                    groups_out = clusters["groups"][~selector]
                     base, ext = os.path.splitext(path)
-                    clusterfilter_info = {
-                        "Generated by": "Picasso Clusterfilter - in",
-                        "Paramter": parameter,
-                        "Minval": minval,
-                        "Maxval": maxval,
-                    }
-                    info.append(clusterfilter_info)
-                    all_locs.sort(kind="mergesort", order="frame")
-                    all_locs = all_locs.view(np.recarray)
-                    out_path = base + "_filter_in.hdf5"
-                    io.save_locs(out_path, all_locs, info)
-                    print("Complete. Saved to: {}".format(out_path))
-
-                    print("Isolating locs.. Step 2: out of range")
-                    groups = clusters["groups"][~selector]
-                    first = True
-                    for group in tqdm(groups):
-                        if first:
-                            all_locs = locs[locs["group"] == group]
-                            first = False
-                        else:
-                            all_locs = np.append(
-                                all_locs, locs[locs["group"] == group]
+                    outputs = []
+                    for suffix in ["in", "out"]:
+                        clusterfilter_info = {
+                            "Generated by": "Picasso Clusterfilter - "
+                            + suffix,
+                            "Paramter": parameter,
+                            "Minval": minval,
+                            "Maxval": maxval,
+                        }
+                        out_path = base + "_filter_{}.hdf5".format(suffix)
+                        outputs.append(
+                            (out_path, info + [clusterfilter_info])
+                        )
+                    # One sweep over the locs, streamed in chunks
+                    chunks = io.iter_locs(path)
+                    locs = next(chunks)
+                    writers = [
+                        io.LocsWriter(out_path, locs.dtype, out_info)
+                        for out_path, out_info in outputs
+                    ]
+                    with writers[0], writers[1]:
+                        for locs in tqdm(chain([locs], chunks), unit="chunks"):
+                            writers[0].append(
+                                locs[np.isin(locs.group, groups_in)]
                             )
-
-                    base, ext = os.path.splitext(path)
-                    clusterfilter_info = {
-                        "Generated by": "Picasso Clusterfilter - out",
-                        "Paramter": parameter,
-                        "Minval": minval,
-                        "Maxval": maxval,
-                    }
-                    info.append(clusterfilter_info)
-                    all_locs.sort(kind="mergesort", order="frame")
-                    all_locs = all_locs.view(np.recarray)
-                    out_path = base + "_filter_out.hdf5"
-                    io.save_locs(out_path, all_locs, info)
-                    print("Complete. Saved to: {}".format(out_path))
+                            writers[1].append(
+                                locs[np.isin(locs.group, groups_out)]
+                            )
+                    for out_path, _ in outputs:
+                        print("Complete. Saved to: {}".format(out_path))
 
             except ValueError:
                 print("Error: Field {} not found.".format(parameter))
 
 
-def _undrift(files, segmentation, display=True, fromfile=None):
+def _undrift(
+    files,
+    segmentation,
+    display=True,
+    fromfile=None,
+    mode="render",
+    indexed=False,
+):
     import glob
-    from . import io, postprocess
-    from numpy import genfromtxt, savetxt
+    from . import batch
+    from numpy import genfromtxt
 
     paths = glob.glob(files)
     undrift_info = {"Generated by": "Picasso Undrift"}
@@ -375,91 +371,136 @@ def _undrift(files, segmentation, display=True, fromfile=None):
         undrift_info["From File"] = fromfile
         drift = genfromtxt(fromfile)
     else:
+        undrift_info["Mode"] = mode
         undrift_info["Segmentation"] = segmentation
-    for path in paths:
-        try:
-            locs, info = io.load_locs(path)
-        except io.NoMetadataFileError:
-            continue
-        info.append(undrift_info)
-        if fromfile is not None:
-            # this works for mingjies drift files but not for the own ones
-            locs.x -= drift[:, 1][locs.frame]
-            locs.y -= drift[:, 0][locs.frame]
-            if display:
-                import matplotlib.pyplot as plt
-
-                plt.style.use("ggplot")
-                plt.figure(figsize=(17, 6))
-                plt.suptitle("Estimated drift")
-                plt.subplot(1, 2, 1)
-                plt.plot(drift[:, 1], label="x")
-                plt.plot(drift[:, 0], label="y")
-                plt.legend(loc="best")
-                plt.xlabel("Frame")
-                plt.ylabel("Drift (pixel)")
-                plt.subplot(1, 2, 2)
-                plt.plot(
-                    drift[:, 1],
-                    drift[:, 0],
-                    color=list(plt.rcParams["axes.prop_cycle"])[2]["color"],
-                )
-                plt.axis("equal")
-                plt.xlabel("x")
-                plt.ylabel("y")
-                plt.show()
-        else:
-            print("Undrifting file {}".format(path))
-            drift, locs = postprocess.undrift(
-                locs, info, segmentation, display=display
+        drift = None
+    batch.map_files(
+        _undrift_file,
+        paths,
+        (segmentation, display, undrift_info, drift, mode),
+        {"indexed": indexed},
+        parallel=not display,
+    )
+
+
+def _undrift_file(
+    path, segmentation, display, undrift_info, drift, mode, indexed=False
+):
+    from . import io, postprocess
+    from numpy import savetxt
+
+    try:
+        locs, info = io.load_locs(path)
+    except io.NoMetadataFileError:
+        return
+    info.append(undrift_info)
+    if "From File" in undrift_info:
+        # this works for mingjies drift files but not for the own ones
+        locs.x -= drift[:, 1][locs.frame]
+        locs.y -= drift[:, 0][locs.frame]
+        if display:
+            import matplotlib.pyplot as plt
+
+            plt.style.use("ggplot")
+            plt.figure(figsize=(17, 6))
+            plt.suptitle("Estimated drift")
+            plt.subplot(1, 2, 1)
+            plt.plot(drift[:, 1], label="x")
+            plt.plot(drift[:, 0], label="y")
+            plt.legend(loc="best")
+            plt.xlabel("Frame")
+            plt.ylabel("Drift (pixel)")
+            plt.subplot(1, 2, 2)
+            plt.plot(
+                drift[:, 1],
+                drift[:, 0],
+                color=list(plt.rcParams["axes.prop_cycle"])[2]["color"],
             )
-        base, ext = os.path.splitext(path)
-        io.save_locs(base + "_undrift.hdf5", locs, info)
-        savetxt(base + "_drift.txt", drift, header="dx\tdy", newline="\r\n")
+            plt.axis("equal")
+            plt.xlabel("x")
+            plt.ylabel("y")
+            plt.show()
+    elif mode == "locs":
+        print("Undrifting file {}".format(path))
+        drift, locs = postprocess.undrift_locs(
+            locs, info, segmentation, display=display
+        )
+    else:
+        print("Undrifting file {}".format(path))
+        drift, locs = postprocess.undrift(
+            locs, info, segmentation, display=display
+        )
+    base, ext = os.path.splitext(path)
+    io.save_locs(base + "_undrift.hdf5", locs, info, indexed=indexed)
+    savetxt(base + "_drift.txt", drift, header="dx\tdy", newline="\r\n")
 
 
-def _density(files, radius):
+def _density(files, radius, indexed=False):
     import glob
+    from . import batch
 
     paths = glob.glob(files)
     if paths:
-        from . import io, postprocess
+        batch.map_files(
+            _density_file, paths, (radius,), {"indexed": indexed}
+        )
 
-        for path in paths:
-            locs, info = io.load_locs(path)
-            locs = postprocess.compute_local_density(locs, info, radius)
-            base, ext = os.path.splitext(path)
-            density_info = {
-                "Generated by": "Picasso Density",
-                "Radius": radius,
-            }
-            info.append(density_info)
-            io.save_locs(base + "_density.hdf5", locs, info)
+
+def _density_file(path, radius, indexed=False):
+    from . import io, postprocess
+
+    locs, info = io.load_locs(path)
+    locs = postprocess.compute_local_density(locs, info, radius)
+    base, ext = os.path.splitext(path)
+    density_info = {
+        "Generated by": "Picasso Density",
+        "Radius": radius,
+    }
+    info.append(density_info)
+    io.save_locs(base + "_density.hdf5", locs, info, indexed=indexed)
 
 
-def _dbscan(files, radius, min_density):
+def _dbscan(files, radius, min_density, pixelsize=130, indexed=False):
     import glob
+    from . import batch
+
     paths = glob.glob(files)
     if paths:
-        from . import io, postprocess
-        from h5py import File
+        batch.map_files(
+            _dbscan_file,
+            paths,
+            (radius, min_density, pixelsize),
+            {"indexed": indexed},
+        )
 
-        for path in paths:
-            print("Loading {} ...".format(path))
-            locs, info = io.load_locs(path)
-            clusters, locs = postprocess.dbscan(locs, radius, min_density)
-            base, ext = os.path.splitext(path)
-            dbscan_info = {
-                "Generated by": "Picasso DBSCAN",
-                "Radius": radius,
-                "Minimum local density": min_density,
-            }
-            info.append(dbscan_info)
-            io.save_locs(base + "_dbscan.hdf5", locs, info)
-            with File(base + "_dbclusters.hdf5", "w") as clusters_file:
-                clusters_file.create_dataset("clusters", data=clusters)
-            print("Clustering executed. Results are saved in: \n" + base + "_dbscan.hdf5" +
-                  "\n" + base + "_dbclusters.hdf5")
+
+def _dbscan_file(path, radius, min_density, pixelsize, indexed=False):
+    from . import io, postprocess
+    from h5py import File
+
+    print("Loading {} ...".format(path))
+    locs, info = io.load_locs(path)
+    clusters, locs = postprocess.dbscan(locs, radius, min_density, pixelsize)
+    base, ext = os.path.splitext(path)
+    dbscan_info = {
+        "Generated by": "Picasso DBSCAN",
+        "Radius": radius,
+        "Minimum local density": min_density,
+    }
+    if hasattr(locs, "z"):
+        dbscan_info["Pixelsize"] = pixelsize
+    info.append(dbscan_info)
+    io.save_locs(base + "_dbscan.hdf5", locs, info, indexed=indexed)
+    with File(base + "_dbclusters.hdf5", "w") as clusters_file:
+        clusters_file.create_dataset("clusters", data=clusters)
+    print(
+        "Clustering executed. Results are saved in: \n"
+        + base
+        + "_dbscan.hdf5"
+        + "\n"
+        + base
+        + "_dbclusters.hdf5"
+    )
 
 def _hdbscan(files, min_cluster, min_samples):
     import glob
@@ -490,7 +531,7 @@ def _nneighbor(files):
     import glob
     import h5py as _h5py
     import numpy as np
-    from scipy.spatial import distance
+    from .neighbors import Neighbors
 
     paths = glob.glob(files)
     if paths:
@@ -499,30 +540,33 @@ def _nneighbor(files):
             with _h5py.File(path, "r") as locs_file:
                 locs = locs_file["clusters"][...]
             clusters = np.rec.array(locs, dtype=locs.dtype)
-            points = np.array(clusters[["com_x", "com_y"]].tolist())
-            alldist = distance.cdist(points, points)
-            alldist[alldist == 0] = float("inf")
-            minvals = np.amin(alldist, axis=0)
+            points = np.stack([clusters.com_x, clusters.com_y], axis=1)
+            # Clusters at the same position do not count
+            minvals = Neighbors(points).nearest_distinct()
             base, ext = os.path.splitext(path)
             out_path = base + "_minval.txt"
             np.savetxt(out_path, minvals, newline="\r\n")
             print("Saved filest o: {}".format(out_path))
 
 
-def _dark(files):
+def _dark(files, indexed=False):
     import glob
+    from . import batch
 
     paths = glob.glob(files)
     if paths:
-        from . import io, postprocess
+        batch.map_files(_dark_file, paths, kwargs={"indexed": indexed})
 
-        for path in paths:
-            locs, info = io.load_locs(path)
-            locs = postprocess.compute_dark_times(locs)
-            base, ext = os.path.splitext(path)
-            dbscan_info = {"Generated by": "Picasso Dark"}
-            info.append(dbscan_info)
-            io.save_locs(base + "_dark.hdf5", locs, info)
+
+def _dark_file(path, indexed=False):
+    from . import io, postprocess
+
+    locs, info = io.load_locs(path)
+    locs = postprocess.compute_dark_times(locs)
+    base, ext = os.path.splitext(path)
+    dbscan_info = {"Generated by": "Picasso Dark"}
+    info.append(dbscan_info)
+    io.save_locs(base + "_dark.hdf5", locs, info, indexed=indexed)
 
 
 def _align(files, display):
@@ -573,20 +617,22 @@ def _join(files):
 
 def _groupprops(files):
     import glob
+    from . import batch
 
     paths = glob.glob(files)
     if paths:
-        from .io import load_locs, save_datasets
-        from .postprocess import groupprops
-        from os.path import splitext
+        batch.map_files(_groupprops_file, paths)
 
-        for path in paths:
-            locs, info = load_locs(path)
-            groups = groupprops(locs)
-            base, ext = splitext(path)
-            save_datasets(
-                base + "_groupprops.hdf5", info, locs=locs, groups=groups
-            )
+
+def _groupprops_file(path):
+    from .io import load_locs, save_datasets
+    from .postprocess import groupprops
+    from os.path import splitext
+
+    locs, info = load_locs(path)
+    groups = groupprops(locs)
+    base, ext = splitext(path)
+    save_datasets(base + "_groupprops.hdf5", info, locs=locs, groups=groups)
 
 
 def _pair_correlation(files, bin_size, r_max):
@@ -645,17 +691,9 @@ def _nanotron(args):
 def _localize(args):
     files = args.files
     from glob import glob
-    from .io import load_movie, save_locs, save_info
-    from .localize import (
-        get_spots,
-        identify_async,
-        identifications_from_futures,
-        fit_async,
-        locs_from_fits,
-    )
-    from os.path import splitext, isdir
-    from time import sleep
-    from . import gausslq, avgroi
+    from .io import save_info
+    from os.path import isdir
+    from . import batch, gausslq
     import os.path as _ospath
     import re as _re
     import os as _os
@@ -746,8 +784,6 @@ def _localize(args):
                 save_info(info_path, [info])
 
     if paths:
-        box = args.box_side_length
-        min_net_gradient = args.gradient
         camera_info = {}
         camera_info["baseline"] = args.baseline
         camera_info["sensitivity"] = args.sensitivity
@@ -762,8 +798,8 @@ def _localize(args):
             convergence = 0
             max_iterations = 0
 
+        z_fit = None
         if args.fit_method == "lq-3d" or args.fit_method == "lq-gpu-3d":
-            from . import zfit
             print("------------------------------------------")
             print('Fitting 3D')
             magnification_factor = float(input("Enter Magnification factor: "))
@@ -777,155 +813,275 @@ def _localize(args):
                     print(e)
                     print('Error loading calibration file.')
                     raise
+            z_fit = (z_calibration, magnification_factor, zpath)
 
-        for i, path in enumerate(paths):
-            print("------------------------------------------")
-            print("------------------------------------------")
-            print("Processing {}, File {} of {}".format(path, i+1, len(paths)))
-            print("------------------------------------------")
-            movie, info = load_movie(path)
-            current, futures = identify_async(movie, min_net_gradient, box)
-            n_frames = len(movie)
-            while current[0] < n_frames:
+        batch.map_files(
+            _localize_file,
+            paths,
+            (args, camera_info, convergence, max_iterations, z_fit),
+        )
+    else:
+        print("Error. No files found.")
+        raise FileNotFoundError
+
+
+def _localize_file(
+    path, args, camera_info, convergence, max_iterations, z_fit=None
+):
+    from .io import load_movie, save_locs
+    from .localize import (
+        get_spots,
+        identify_async,
+        identifications_from_futures,
+        fit_async,
+        locs_from_fits,
+        localize_chunked_async,
+    )
+    from .gaussmle import gaussmle_parallel
+    from os.path import splitext
+    from time import sleep
+    from . import gausslq, avgroi
+
+    box = args.box_side_length
+    min_net_gradient = args.gradient
+
+    def fit_chunk(ids, spots):
+        if args.fit_method == "lq" or args.fit_method == "lq-3d":
+            fs = gausslq.fit_spots_parallel(spots, asynch=True)
+            theta = gausslq.fits_from_futures(fs)
+            return gausslq.locs_from_fits(ids, theta, box, args.gain)
+        elif (
+            args.fit_method == "lq-gpu" or args.fit_method == "lq-gpu-3d"
+        ):
+            theta = gausslq.fit_spots_gpufit(spots)
+            em = camera_info["gain"] > 1
+            return gausslq.locs_from_fits_gpufit(ids, theta, box, em)
+        elif args.fit_method == "mle":
+            thetas, CRLBs, likelihoods, iterations = gaussmle_parallel(
+                spots, convergence, max_iterations
+            )
+            return locs_from_fits(
+                ids, thetas, CRLBs, likelihoods, iterations, box
+            )
+        elif args.fit_method == "avg":
+            fs = avgroi.fit_spots_parallel(spots, asynch=True)
+            theta = avgroi.fits_from_futures(fs)
+            return avgroi.locs_from_fits(ids, theta, box, args.gain)
+
+    print("------------------------------------------")
+    print("------------------------------------------")
+    print("Processing {}".format(path))
+    print("------------------------------------------")
+    movie, info = load_movie(path)
+    n_frames = len(movie)
+    if args.chunk_frames > 0:
+        current, future = localize_chunked_async(
+            movie,
+            camera_info,
+            min_net_gradient,
+            box,
+            fit_chunk,
+            args.chunk_frames,
+        )
+        while not future.done():
+            print(
+                "Localizing in frame {:,} of {:,}".format(
+                    current[0] + 1, n_frames
+                ),
+                end="\r",
+            )
+            sleep(0.2)
+        locs = future.result()
+        print(
+            "Localizing in frame {:,} of {:,}".format(
+                n_frames, n_frames
+            )
+        )
+    else:
+        current, futures = identify_async(
+            movie, min_net_gradient, box
+        )
+        while current[0] < n_frames:
+            print(
+                "Identifying in frame {:,} of {:,}".format(
+                    current[0] + 1, n_frames
+                ),
+                end="\r",
+            )
+            sleep(0.2)
+        print(
+            "Identifying in frame {:,} of {:,}".format(
+                n_frames, n_frames
+            )
+        )
+        ids = identifications_from_futures(futures)
+        if args.fit_method == "lq" or args.fit_method == "lq-3d":
+            spots = get_spots(movie, ids, box, camera_info)
+            theta = gausslq.fit_spots_parallel(spots, asynch=False)
+            locs = gausslq.locs_from_fits(
+                ids, theta, box, args.gain
+            )
+        elif (
+            args.fit_method == "lq-gpu"
+            or args.fit_method == "lq-gpu-3d"
+        ):
+            spots = get_spots(movie, ids, box, camera_info)
+            theta = gausslq.fit_spots_gpufit(spots)
+            em = camera_info["gain"] > 1
+            locs = gausslq.locs_from_fits_gpufit(
+                ids, theta, box, em
+            )
+        elif args.fit_method == "mle":
+            (
+                current,
+                thetas,
+                CRLBs,
+                likelihoods,
+                iterations,
+            ) = fit_async(
+                movie,
+                camera_info,
+                ids,
+                box,
+                convergence,
+                max_iterations,
+            )
+            n_spots = len(ids)
+            while current[0] < n_spots:
                 print(
-                    "Identifying in frame {:,} of {:,}".format(
-                        current[0] + 1, n_frames
+                    "Fitting spot {:,} of {:,}".format(
+                        current[0] + 1, n_spots
                     ),
                     end="\r",
                 )
                 sleep(0.2)
             print(
-                "Identifying in frame {:,} of {:,}".format(n_frames, n_frames)
+                "Fitting spot {:,} of {:,}".format(n_spots, n_spots)
+            )
+            locs = locs_from_fits(
+                ids, thetas, CRLBs, likelihoods, iterations, box
             )
-            ids = identifications_from_futures(futures)
-
-            if args.fit_method == "lq" or args.fit_method == "lq-3d":
-                spots = get_spots(movie, ids, box, camera_info)
-                theta = gausslq.fit_spots_parallel(spots, asynch=False)
-                locs = gausslq.locs_from_fits(ids, theta, box, args.gain)
-            elif args.fit_method == "lq-gpu" or args.fit_method == "lq-gpu-3d":
-                spots = get_spots(movie, ids, box, camera_info)
-                theta = gausslq.fit_spots_gpufit(spots)
-                em = camera_info["gain"] > 1
-                locs = gausslq.locs_from_fits_gpufit(ids, theta, box, em)
-            elif args.fit_method == "mle":
-                current, thetas, CRLBs, likelihoods, iterations = fit_async(
-                    movie, camera_info, ids, box, convergence, max_iterations
-                )
-                n_spots = len(ids)
-                while current[0] < n_spots:
-                    print(
-                        "Fitting spot {:,} of {:,}".format(
-                            current[0] + 1, n_spots
-                        ),
-                        end="\r",
-                    )
-                    sleep(0.2)
-                print("Fitting spot {:,} of {:,}".format(n_spots, n_spots))
-                locs = locs_from_fits(
-                    ids, thetas, CRLBs, likelihoods, iterations, box
-                )
-
-            elif args.fit_method == "avg":
-                spots = get_spots(movie, ids, box, camera_info)
-                theta = avgroi.fit_spots_parallel(spots, asynch=False)
-                locs = avgroi.locs_from_fits(ids, theta, box, args.gain)
 
-            else:
-                print("This should never happen...")
-
-            localize_info = {
-                "Generated by": "Picasso Localize",
-                "ROI": None,
-                "Box Size": box,
-                "Min. Net Gradient": min_net_gradient,
-                "Convergence Criterion": convergence,
-                "Max. Iterations": max_iterations,
-            }
+        elif args.fit_method == "avg":
+            spots = get_spots(movie, ids, box, camera_info)
+            theta = avgroi.fit_spots_parallel(spots, asynch=False)
+            locs = avgroi.locs_from_fits(
+                ids, theta, box, args.gain
+            )
 
-            if args.fit_method == "lq-3d" or args.fit_method == "lq-gpu-3d":
-                print("------------------------------------------")
-                print("Fitting 3D...", end='')
-                fs = zfit.fit_z_parallel(locs, info, z_calibration,
-                                         magnification_factor,
-                                         filter=0, asynch=True)
-                locs = zfit.locs_from_futures(fs, filter=0)
-                localize_info["Z Calibration Path"] = zpath
-                localize_info["Z Calibration"] = z_calibration
-                print("complete.")
-                print("------------------------------------------")
-
-            info.append(localize_info)
-
-            base, ext = splitext(path)
-            out_path = base + "_locs.hdf5"
-            save_locs(out_path, locs, info)
-            print("File saved to {}".format(out_path))
-            if args.drift > 0:
-                print("Undrifting file:")
-                print("------------------------------------------")
-                try:
-                    _undrift(
-                        out_path, args.drift, display=False, fromfile=None
-                    )
-                except Exception as e:
-                    print(e)
-                    print("Drift correction failed for {}".format(out_path))
+        else:
+            print("This should never happen...")
+
+    localize_info = {
+        "Generated by": "Picasso Localize",
+        "ROI": None,
+        "Box Size": box,
+        "Min. Net Gradient": min_net_gradient,
+        "Convergence Criterion": convergence,
+        "Max. Iterations": max_iterations,
+    }
+
+    if args.fit_method == "lq-3d" or args.fit_method == "lq-gpu-3d":
+        from . import zfit
+
+        z_calibration, magnification_factor, zpath = z_fit
+        print("------------------------------------------")
+        print("Fitting 3D...", end='')
+        fs = zfit.fit_z_parallel(locs, info, z_calibration,
+                                 magnification_factor,
+                                 filter=0, asynch=True)
+        locs = zfit.locs_from_futures(fs, filter=0)
+        localize_info["Z Calibration Path"] = zpath
+        localize_info["Z Calibration"] = z_calibration
+        print("complete.")
+        print("------------------------------------------")
+
+    info.append(localize_info)
+
+    base, ext = splitext(path)
+    out_path = base + "_locs.hdf5"
+    indexed = getattr(args, "indexed", False)
+    save_locs(out_path, locs, info, indexed=indexed)
+    print("File saved to {}".format(out_path))
+    if args.drift > 0:
+        print("Undrifting file:")
+        print("------------------------------------------")
+        try:
+            _undrift_file(
+                out_path,
+                args.drift,
+                False,
+                {
+                    "Generated by": "Picasso Undrift",
+                    "Mode": "render",
+                    "Segmentation": args.drift,
+                },
+                None,
+                "render",
+                indexed,
+            )
+        except Exception as e:
+            print(e)
+            print("Drift correction failed for {}".format(out_path))
 
-            print("                                          ")
-    else:
-        print("Error. No files found.")
-        raise FileNotFoundError
+    print("                                          ")
 
 
-def _render(args):
-    from .lib import locs_glob_map
+def _render_file(
+    locs,
+    info,
+    path,
+    oversampling,
+    blur_method,
+    min_blur_width,
+    vmin,
+    vmax,
+    scaling,
+    cmap,
+    silent,
+):
+    import numpy as np
     from .render import render
     from os.path import splitext
     from matplotlib.pyplot import imsave
-    from os import startfile
-    from os.path import isdir
-    from .io import load_user_settings, save_user_settings
-    from tqdm import tqdm
-    from glob import glob
 
-    def render_many(
+    if blur_method == "none":
+        blur_method = None
+    # Read only the columns of lazy locs that the blur needs
+    fields = ["x", "y"]
+    if blur_method not in [None, "smooth"]:
+        fields += ["lpx", "lpy"]
+    locs = np.rec.fromarrays([locs[_] for _ in fields], names=fields)
+    N, image = render(
         locs,
         info,
-        path,
         oversampling,
-        blur_method,
-        min_blur_width,
-        vmin,
-        vmax,
-        scaling,
-        cmap,
-        silent,
-    ):
-        if blur_method == "none":
-            blur_method = None
-        N, image = render(
-            locs,
-            info,
-            oversampling,
-            blur_method=blur_method,
-            min_blur_width=min_blur_width,
+        blur_method=blur_method,
+        min_blur_width=min_blur_width,
+    )
+    base, ext = splitext(path)
+    out_path = base + ".png"
+    im_max = image.max() / 100
+    if scaling == "yes":
+        imsave(
+            out_path, image,
+            vmin=vmin * im_max, vmax=vmax * im_max,
+            cmap=cmap
         )
-        base, ext = splitext(path)
-        out_path = base + ".png"
-        im_max = image.max() / 100
-        if scaling == "yes":
-            imsave(
-                out_path, image,
-                vmin=vmin * im_max, vmax=vmax * im_max,
-                cmap=cmap
-            )
-        else:
-            imsave(
-                out_path, image, vmin=vmin, vmax=vmax, cmap=cmap
-            )
-        if not silent:
-            startfile(out_path)
+    else:
+        imsave(
+            out_path, image, vmin=vmin, vmax=vmax, cmap=cmap
+        )
+    if not silent:
+        from os import startfile
+
+        startfile(out_path)
+
+
+def _render(args):
+    from .lib import locs_glob_map
+    from os.path import isdir
+    from .io import load_user_settings, save_user_settings
 
     settings = load_user_settings()
     cmap = args.cmap
@@ -939,40 +1095,210 @@ def _render(args):
 
     if isdir(args.files):
         print("Analyzing folder")
-        paths = glob(args.files + "/*.hdf5")
-        print("A total of {} files detected. Rendering.".format(len(paths)))
-
-        for path in tqdm(paths):
-                locs_glob_map(
-                    render_many,
-                    path,
-                    args=(
-                        args.oversampling,
-                        args.blur_method,
-                        args.min_blur_width,
-                        args.vmin,
-                        args.vmax,
-                        args.scaling,
-                        cmap,
-                        True,
-                    ),
-                )
-
+        pattern = args.files + "/*.hdf5"
+        silent = True
     else:
-        locs_glob_map(
-            render_many,
-            args.files,
-            args=(
-                args.oversampling,
-                args.blur_method,
-                args.min_blur_width,
-                args.vmin,
-                args.vmax,
-                args.scaling,
-                cmap,
-                args.silent,
-            ),
+        pattern = args.files
+        silent = args.silent
+    locs_glob_map(
+        _render_file,
+        pattern,
+        lazy=True,
+        args=(
+            args.oversampling,
+            args.blur_method,
+            args.min_blur_width,
+            args.vmin,
+            args.vmax,
+            args.scaling,
+            cmap,
+            silent,
+        ),
+        # Show the images one after the other
+        parallel=silent,
+    )
+
+
+def _warmup_movie(path, n_frames=200, size=48, n_sites=24, seed=0):
+    """ Saves a small simulated raw movie of blinking sites """
+    import numpy as np
+    from .io import save_raw
+
+    random = np.random.RandomState(seed)
+    sites = random.uniform(6, size - 6, (n_sites, 2))
+    on = random.rand(n_frames, n_sites) < 0.5
+    drift = np.linspace(0, 0.5, n_frames)
+    yy, xx = np.mgrid[:size, :size]
+    movie = np.zeros((n_frames, size, size), dtype=np.float32)
+    for frame in range(n_frames):
+        for y, x in sites[on[frame]] + drift[frame]:
+            spot = np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / 2)
+            movie[frame] += 1000 / (2 * np.pi) * spot
+    movie = random.poisson(movie + 10).astype(np.uint16)
+    info = [
+        {
+            "Byte Order": "<",
+            "Data Type": "uint16",
+            "Frames": n_frames,
+            "Height": size,
+            "Width": size,
+        }
+    ]
+    save_raw(path, movie, info)
+
+
+def _warmup():
+    """
+    Runs the pipelines on a small simulated movie, such that numba compiles
+    (or loads from its cache) the kernels for the signatures they use, and
+    reports the compile time of each kernel
+    """
+    import argparse
+    import contextlib
+    import os.path
+    import tempfile
+    import time
+    import numpy as np
+    from numba.core import event
+    from numba.core.caching import NullCache
+    from numba.core.dispatcher import Dispatcher
+    from . import NUMBA_CACHE_DIR
+    from . import avgroi, gausslq, gaussmle, lib, localize, postprocess
+    from . import render, zfit
+    from .io import load_locs, load_movie
+
+    def pipelines(tmp_dir):
+        movie_path = os.path.join(tmp_dir, "movie.raw")
+        _warmup_movie(movie_path)
+        locs_path = os.path.join(tmp_dir, "movie_locs.hdf5")
+        args = argparse.Namespace(
+            files=movie_path,
+            box_side_length=7,
+            gradient=1000,
+            baseline=0,
+            sensitivity=1,
+            gain=1,
+            qe=1,
+            drift=0,
         )
+        for fit_method, chunk_frames, drift in [
+            ("lq", 0, 0),
+            ("avg", 0, 0),
+            ("lq", 64, 0),
+            ("avg", 64, 0),
+            ("mle", 64, 0),
+            ("mle", 0, 50),
+        ]:
+            args.fit_method = fit_method
+            args.chunk_frames = chunk_frames
+            args.drift = drift
+            _localize(args)
+        _undrift(locs_path, 50, display=False, mode="locs")
+        _link(locs_path, 1.0, 1)
+        _dark(locs_path.replace(".hdf5", "_link.hdf5"))
+        _density(locs_path, 1.0)
+        _dbscan(locs_path, 0.5, 2)
+        _groupprops(locs_path.replace(".hdf5", "_dbscan.hdf5"))
+        locs, info = load_locs(locs_path)
+        postprocess.next_frame_neighbor_distance_histogram(locs)
+        postprocess.pair_correlation(locs, info, 0.1, 2)
+        movie, _ = load_movie(movie_path)
+        camera_info = {"baseline": 0, "sensitivity": 1, "gain": 1, "qe": 1}
+        ids = localize.identify(movie, 1000, 7)
+        spots = localize.get_spots(movie, ids, 7, camera_info)
+        gaussmle.gaussmle(spots, 0.001, 100, method="sigmaxy")
+        # The avg fits of _localize run in worker processes
+        avgroi.fit_spots(spots)
+        z_range = np.linspace(-600, 600, 121)
+        calibration = {
+            "X Coefficients": np.polyfit(
+                z_range, np.sqrt(1 + ((z_range - 250) / 400) ** 2), 6
+            ).tolist(),
+            "Y Coefficients": np.polyfit(
+                z_range, np.sqrt(1 + ((z_range + 250) / 400) ** 2), 6
+            ).tolist(),
+            "Range": 1200.0,
+        }
+        zfit.locs_from_futures(
+            zfit.fit_z_parallel(locs, info, calibration, 1, 0, True), 0
+        )
+        locs, info = load_locs(locs_path, fields=["x", "y", "lpx", "lpy"])
+        for blur_method in [
+            None, "gaussian", "gaussian_iso", "smooth", "convolve"
+        ]:
+            render.render(locs, info, 5, blur_method=blur_method)
+
+    print("Numba cache: {}".format(NUMBA_CACHE_DIR or "default"))
+    print("Compiling kernels...")
+    start = time.perf_counter()
+    with event.install_recorder("numba:compile") as recorder:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.devnull, "w") as devnull:
+                with contextlib.redirect_stdout(
+                    devnull
+                ), contextlib.redirect_stderr(devnull):
+                    pipelines(tmp_dir)
+    total = time.perf_counter() - start
+
+    # Compile time of each kernel, without the kernels that it compiled
+    compile_time = {}
+    stack = []
+    for timestamp, ev in recorder.buffer:
+        if ev.is_start:
+            stack.append([ev.data["dispatcher"], timestamp, 0.0])
+        else:
+            dispatcher, started, nested = stack.pop()
+            duration = timestamp - started
+            if stack:
+                stack[-1][2] += duration
+            compile_time[dispatcher] = (
+                compile_time.get(dispatcher, 0.0) + duration - nested
+            )
+
+    # Kernels that are only called by other kernels get no signatures of
+    # their own when loaded from the cache: they are linked into the cached
+    # code of their callers
+    rows = []
+    for module in [
+        avgroi, gausslq, gaussmle, lib, localize, postprocess, render, zfit
+    ]:
+        for name, kernel in sorted(vars(module).items()):
+            if isinstance(kernel, Dispatcher) and not isinstance(
+                kernel._cache, NullCache
+            ):
+                rows.append(
+                    (
+                        "{}.{}".format(module.__name__, name),
+                        len(kernel.signatures),
+                        compile_time.get(kernel, 0.0),
+                        sum(kernel.stats.cache_hits.values()),
+                    )
+                )
+    print(
+        "{:<56} {:>10} {:>12} {:>10}".format(
+            "Kernel", "Signatures", "Compile (s)", "From cache"
+        )
+    )
+    for name, n_signatures, seconds, cache_hits in rows:
+        if n_signatures:
+            print(
+                "{:<56} {:>10} {:>12.2f} {:>10}".format(
+                    name, n_signatures, seconds, cache_hits
+                )
+            )
+        else:
+            print("{:<56} {:>10}".format(name, "-"))
+    n_direct = sum(1 for row in rows if row[1])
+    print(
+        "{} kernels ready in {:.1f} s, {:.1f} s of which compiling.".format(
+            len(rows), total, sum(compile_time.values())
+        )
+    )
+    print(
+        "{} kernels were compiled or loaded on their own. The other {}"
+        " (-) are\ncompiled into the kernels that call them, or not used by"
+        " the pipelines.".format(n_direct, len(rows) - n_direct)
+    )
 
 
 def main():
@@ -980,9 +1306,22 @@ def main():
 
     # Main parser
     parser = argparse.ArgumentParser("picasso")
+    parser.add_argument(
+        "--cores",
+        type=int,
+        help=(
+            "number of cores of batch commands, split between files"
+            " processed at once and the threads of each file"
+            " (default: 3/4 of the CPUs)"
+        ),
+    )
+    parser.add_argument(
+        "--summary",
+        help="save the status and time of each processed file to this yaml",
+    )
     subparsers = parser.add_subparsers(dest="command")
 
-    for command in ["toraw", "localize", "filter", "render"]:
+    for command in ["toraw", "filter"]:
         subparsers.add_parser(command)
 
     # link parser
@@ -1016,6 +1355,14 @@ def main():
             " to still consider them the same binding event (default=1)"
         ),
     )
+    link_parser.add_argument(
+        "--indexed",
+        action="store_true",
+        help=(
+            "save the localizations in tiles for fast region and frame"
+            " reads, with the localizations of a frame in tile order"
+        ),
+    )
 
     cluster_combine_parser = subparsers.add_parser(
         "cluster_combine",
@@ -1078,7 +1425,11 @@ def main():
         "-m",
         "--mode",
         default="render",
-        help='"std", "render" or "framepair")',
+        choices=["render", "locs"],
+        help=(
+            '"render" (cross-correlation of rendered segments) or "locs"'
+            " (matching the localizations of each segment to the previous)"
+        ),
     )
     undrift_parser.add_argument(
         "-s",
@@ -1102,6 +1453,14 @@ def main():
         action="store_false",
         help="do not display estimated drift",
     )
+    undrift_parser.add_argument(
+        "--indexed",
+        action="store_true",
+        help=(
+            "save the localizations in tiles for fast region and frame"
+            " reads, with the localizations of a frame in tile order"
+        ),
+    )
 
     # local densitydd
     density_parser = subparsers.add_parser(
@@ -1122,6 +1481,14 @@ def main():
             " to be considered local"
         ),
     )
+    density_parser.add_argument(
+        "--indexed",
+        action="store_true",
+        help=(
+            "save the localizations in tiles for fast region and frame"
+            " reads, with the localizations of a frame in tile order"
+        ),
+    )
 
     # DBSCAN
     dbscan_parser = subparsers.add_parser(
@@ -1151,6 +1518,21 @@ def main():
             " to be assigned to a cluster"
         ),
     )
+    dbscan_parser.add_argument(
+        "-p",
+        "--pixelsize",
+        type=float,
+        default=130,
+        help="camera pixel size in nm, to scale z of 3D localizations",
+    )
+    dbscan_parser.add_argument(
+        "--indexed",
+        action="store_true",
+        help=(
+            "save the localizations in tiles for fast region and frame"
+            " reads, with the localizations of a frame in tile order"
+        ),
+    )
 
     # HDBSCAN
     hdbscan_parser = subparsers.add_parser(
@@ -1190,6 +1572,14 @@ def main():
             " specified by a unix style path pattern"
         ),
     )
+    dark_parser.add_argument(
+        "--indexed",
+        action="store_true",
+        help=(
+            "save the localizations in tiles for fast region and frame"
+            " reads, with the localizations of a frame in tile order"
+        ),
+    )
 
     # align
     align_parser = subparsers.add_parser(
@@ -1294,6 +1684,24 @@ def main():
     localize_parser.add_argument(
         "-qe", "--qe", type=float, default=1, help="camera quantum efficiency"
     )
+    localize_parser.add_argument(
+        "-c",
+        "--chunk-frames",
+        type=int,
+        default=0,
+        help=(
+            "identify and fit in chunks of this many frames"
+            " to limit memory usage, 0 to deactivate"
+        ),
+    )
+    localize_parser.add_argument(
+        "--indexed",
+        action="store_true",
+        help=(
+            "save the localizations in tiles for fast region and frame"
+            " reads, with the localizations of a frame in tile order"
+        ),
+    )
 
     # nneighbors
     nneighbor_parser = subparsers.add_parser(
@@ -1432,8 +1840,18 @@ def main():
     hdf2csv_parser = subparsers.add_parser("hdf2csv")
     hdf2csv_parser.add_argument("files")
 
+    subparsers.add_parser(
+        "warmup",
+        help="compile the numba kernels of the pipelines into the cache",
+    )
+
     # Parse
     args = parser.parse_args()
+    if args.cores:
+        import os
+
+        os.environ["PICASSO_CORES"] = str(args.cores)
+        os.environ["PICASSO_THREADS"] = str(args.cores)
     if args.command:
         if args.command == "toraw":
             from .gui import toraw
@@ -1476,7 +1894,7 @@ def main():
 
             average3.main()
         elif args.command == "link":
-            _link(args.files, args.distance, args.tolerance)
+            _link(args.files, args.distance, args.tolerance, args.indexed)
         elif args.command == "cluster_combine":
             _cluster_combine(args.files)
         elif args.command == "cluster_combine_dist":
@@ -1491,18 +1909,29 @@ def main():
             )
         elif args.command == "undrift":
             _undrift(
-                args.files, args.segmentation, args.nodisplay, args.fromfile
+                args.files,
+                args.segmentation,
+                args.nodisplay,
+                args.fromfile,
+                args.mode,
+                args.indexed,
             )
         elif args.command == "density":
-            _density(args.files, args.radius)
+            _density(args.files, args.radius, args.indexed)
         elif args.command == "dbscan":
-            _dbscan(args.files, args.radius, args.density)
+            _dbscan(
+                args.files,
+                args.radius,
+                args.density,
+                args.pixelsize,
+                args.indexed,
+            )
         elif args.command == "hdbscan":
             _hdbscan(args.files, args.min_cluster, args.min_samples)
         elif args.command == "nneighbor":
             _nneighbor(args.files)
         elif args.command == "dark":
-            _dark(args.files)
+            _dark(args.files, args.indexed)
         elif args.command == "align":
             _align(args.file, args.display)
         elif args.command == "join":
@@ -1525,9 +1954,21 @@ def main():
             _csv2hdf(args.files, args.pixelsize)
         elif args.command == "hdf2csv":
             _hdf2csv(args.files)
+        elif args.command == "warmup":
+            _warmup()
+        from . import batch
+
+        if args.summary:
+            batch.save_summary(args.summary)
+        if any(_["Status"] != "Done" for _ in batch.SUMMARY):
+            raise SystemExit(1)
     else:
         parser.print_help()
 
 
 if __name__ == "__main__":
-    main()
+    # Run the functions of the importable module, such that batch workers
+    # can unpickle them
+    import picasso.__main__ as _main
+
+    _main.main()
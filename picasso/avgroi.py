@@ -12,12 +12,12 @@ from scipy import optimize as _optimize
 import numpy as _np
 from tqdm import tqdm as _tqdm
 import numba as _numba
-import multiprocessing as _multiprocessing
 from concurrent import futures as _futures
+from . import lib as _lib
 from . import postprocess as _postprocess
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _sum(spot, size):
     _sum_ = 0.0
     for i in range(size):
@@ -44,7 +44,7 @@ def fit_spots(spots):
 
 
 def fit_spots_parallel(spots, asynch=False):
-    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    n_workers = _lib.n_workers()
     n_spots = len(spots)
     n_tasks = 100 * n_workers
     spots_per_task = [
@@ -0,0 +1,141 @@
+"""
+    picasso.batch
+    ~~~~~~~~~~~~~
+
+    Runs a function on many files at once in worker processes, within a
+    budget of cores that is split between the files and the threads of each
+    file
+
+    :copyright: Copyright (c) 2016-2018 Jungmann Lab, MPI of Biochemistry
+"""
+import multiprocessing as _multiprocessing
+import os as _os
+import time as _time
+import traceback as _traceback
+from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
+from concurrent.futures import as_completed as _as_completed
+
+import yaml as _yaml
+
+
+# Results of all files processed by this process, see save_summary
+SUMMARY = []
+
+
+def cores():
+    """
+    The cores of a batch: PICASSO_CORES (see picasso --cores), or three
+    quarters of the CPUs
+    """
+    try:
+        return max(1, int(_os.environ["PICASSO_CORES"]))
+    except (KeyError, ValueError):
+        return max(1, int(0.75 * _multiprocessing.cpu_count()))
+
+
+def split_cores(n_files, n_cores=None):
+    """
+    The number of files processed at once and the threads of each file,
+    such that all cores are used
+    """
+    if n_cores is None:
+        n_cores = cores()
+    n_processes = max(1, min(n_files, n_cores))
+    return n_processes, max(1, n_cores // n_processes)
+
+
+def _init_worker(n_threads):
+    # Runs before the worker imports numpy or the picasso modules
+    for name in [
+        "PICASSO_THREADS",
+        "OMP_NUM_THREADS",
+        "OPENBLAS_NUM_THREADS",
+        "MKL_NUM_THREADS",
+    ]:
+        _os.environ[name] = str(n_threads)
+
+
+def _run(function, path, args, kwargs):
+    """ Calls function for one file and reports how it went """
+    start = _time.perf_counter()
+    try:
+        function(path, *args, **kwargs)
+    except Exception as e:
+        _traceback.print_exc()
+        status = "Failed"
+        error = "{}: {}".format(type(e).__name__, e)
+    else:
+        status = "Done"
+        error = None
+    return {
+        "Path": path,
+        "Function": function.__name__,
+        "Status": status,
+        "Time (s)": round(_time.perf_counter() - start, 3),
+        "Error": error,
+    }
+
+
+def map_files(function, paths, args=(), kwargs={}, parallel=True):
+    """
+    Calls function(path, *args, **kwargs) for each path. Unless parallel is
+    False (e.g. to show plots), files are processed at once in worker
+    processes if the cores allow, see split_cores. The function must then be
+    picklable, i.e. defined at module level. A failing file does not stop
+    the others. Returns the result of each file, in the order of the paths:
+    its status, processing time and error.
+    """
+    paths = list(paths)
+    n_processes, n_threads = split_cores(len(paths))
+    start = _time.perf_counter()
+    if n_processes == 1 or not parallel:
+        results = [_run(function, path, args, kwargs) for path in paths]
+    else:
+        print(
+            "Processing {} files, {} at once with {} threads each".format(
+                len(paths), n_processes, n_threads
+            )
+        )
+        results = [None] * len(paths)
+        with _ProcessPoolExecutor(
+            n_processes,
+            mp_context=_multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(n_threads,),
+        ) as executor:
+            futures = {
+                executor.submit(_run, function, path, args, kwargs): i
+                for i, path in enumerate(paths)
+            }
+            for future in _as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    # The worker process died, e.g. out of memory
+                    results[i] = {
+                        "Path": paths[i],
+                        "Function": function.__name__,
+                        "Status": "Failed",
+                        "Time (s)": None,
+                        "Error": "{}: {}".format(type(e).__name__, e),
+                    }
+    SUMMARY.extend(results)
+    if len(paths) > 1:
+        failed = [_ for _ in results if _["Status"] != "Done"]
+        print(
+            "Processed {} of {} files in {:.1f} s.".format(
+                len(paths) - len(failed),
+                len(paths),
+                _time.perf_counter() - start,
+            )
+        )
+        for result in failed:
+            print("Failed: {} ({})".format(result["Path"], result["Error"]))
+    return results
+
+
+def save_summary(path):
+    """ Saves the results of all files processed by this process """
+    with open(path, "w") as summary_file:
+        _yaml.dump(SUMMARY, summary_file, default_flow_style=False)
@@ -13,8 +13,8 @@ from scipy import optimize as _optimize
 import numpy as _np
 from tqdm import tqdm as _tqdm
 import numba as _numba
-import multiprocessing as _multiprocessing
 from concurrent import futures as _futures
+from . import lib as _lib
 from . import postprocess as _postprocess
 
 try:
@@ -25,7 +25,7 @@ except ImportError:
     gpufit_installed = False
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _gaussian(mu, sigma, grid):
     norm = 0.3989422804014327 / sigma
     return norm * _np.exp(-0.5 * ((grid - mu) / sigma) ** 2)
@@ -40,7 +40,7 @@ def integrated_gaussian(mu, sigma, grid):
 """
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _sum_and_center_of_mass(spot, size):
     x = 0.0
     y = 0.0
@@ -55,7 +55,7 @@ def _sum_and_center_of_mass(spot, size):
     return _sum_, y, x
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_sigmas(spot, y, x, sum, size):
     sum_deviation_y = 0.0
     sum_deviation_x = 0.0
@@ -68,7 +68,7 @@ def _initial_sigmas(spot, y, x, sum, size):
     return sy, sx
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_parameters(spot, size, size_half):
     theta = _np.zeros(6, dtype=_np.float32)
     theta[3] = _np.min(spot)
@@ -102,14 +102,14 @@ def initial_parameters_gpufit(spots, size):
     return initial_parameters
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _outer(a, b, size, model, n, bg):
     for i in range(size):
         for j in range(size):
             model[i, j] = n * a[i] * b[j] + bg
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _compute_model(theta, grid, size, model_x, model_y, model):
     model_x[:] = _gaussian(
         theta[0], theta[4], grid
@@ -119,7 +119,7 @@ def _compute_model(theta, grid, size, model_x, model_y, model):
     return model
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _compute_residuals(
     theta, spot, grid, size, model_x, model_y, model, residuals
 ):
@@ -128,6 +128,161 @@ def _compute_residuals(
     return residuals.flatten()
 
 
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _model_and_jacobian(theta, spot, grid, size, residuals, jacobian):
+    """
+    Residuals and derivatives of the model in _compute_model with respect to
+    [x, y, photons, bg, sx, sy]; returns the sum of squared residuals
+    """
+    chi2 = 0.0
+    for i in range(size):
+        dy = (grid[i] - theta[1]) / theta[5]
+        model_y = 0.3989422804014327 / theta[5] * _np.exp(-0.5 * dy ** 2)
+        for j in range(size):
+            dx = (grid[j] - theta[0]) / theta[4]
+            model_x = 0.3989422804014327 / theta[4] * _np.exp(-0.5 * dx ** 2)
+            psf = model_y * model_x
+            signal = theta[2] * psf
+            residual = spot[i, j] - signal - theta[3]
+            residuals[i, j] = residual
+            chi2 += residual ** 2
+            jacobian[i, j, 0] = signal * dx / theta[4]
+            jacobian[i, j, 1] = signal * dy / theta[5]
+            jacobian[i, j, 2] = psf
+            jacobian[i, j, 3] = 1.0
+            jacobian[i, j, 4] = signal * (dx ** 2 - 1) / theta[4]
+            jacobian[i, j, 5] = signal * (dy ** 2 - 1) / theta[5]
+    return chi2
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _chi2(theta, spot, grid, size):
+    chi2 = 0.0
+    for i in range(size):
+        dy = (grid[i] - theta[1]) / theta[5]
+        model_y = 0.3989422804014327 / theta[5] * _np.exp(-0.5 * dy ** 2)
+        for j in range(size):
+            dx = (grid[j] - theta[0]) / theta[4]
+            model_x = 0.3989422804014327 / theta[4] * _np.exp(-0.5 * dx ** 2)
+            residual = spot[i, j] - theta[2] * model_y * model_x - theta[3]
+            chi2 += residual ** 2
+    return chi2
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _solve_damped(alpha, beta, damping, n_params, L, delta):
+    """
+    Solves (alpha + damping * diag(alpha)) delta = beta with a Cholesky
+    decomposition; returns False if the matrix is not positive definite
+    """
+    for i in range(n_params):
+        for j in range(i + 1):
+            value = alpha[i, j]
+            if i == j:
+                value += damping * alpha[i, i]
+            for k in range(j):
+                value -= L[i, k] * L[j, k]
+            if i == j:
+                if not value > 0:
+                    return False
+                L[i, i] = _np.sqrt(value)
+            else:
+                L[i, j] = value / L[j, j]
+    for i in range(n_params):
+        value = beta[i]
+        for k in range(i):
+            value -= L[i, k] * delta[k]
+        delta[i] = value / L[i, i]
+    for i in range(n_params - 1, -1, -1):
+        value = delta[i]
+        for k in range(i + 1, n_params):
+            value -= L[k, i] * delta[k]
+        delta[i] = value / L[i, i]
+    return True
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _fit_spot_lm(spot, grid, size, theta0, ftol, xtol, max_it):
+    """
+    Levenberg-Marquardt fit with an analytic Jacobian, stopping on the
+    relative reduction of the squared residuals (ftol) or on the relative
+    step size (xtol), as with leastsq
+    """
+    n_params = 6
+    theta = theta0.astype(_np.float64)
+    residuals = _np.empty((size, size), dtype=_np.float64)
+    jacobian = _np.empty((size, size, n_params), dtype=_np.float64)
+    alpha = _np.empty((n_params, n_params), dtype=_np.float64)
+    beta = _np.empty(n_params, dtype=_np.float64)
+    L = _np.zeros((n_params, n_params), dtype=_np.float64)
+    delta = _np.empty(n_params, dtype=_np.float64)
+    new_theta = _np.empty(n_params, dtype=_np.float64)
+    damping = 1e-3
+    for it in range(max_it):
+        chi2 = _model_and_jacobian(
+            theta, spot, grid, size, residuals, jacobian
+        )
+        if not _np.isfinite(chi2):
+            break
+        for k in range(n_params):
+            beta[k] = 0.0
+            for m in range(k + 1):
+                alpha[k, m] = 0.0
+        for i in range(size):
+            for j in range(size):
+                for k in range(n_params):
+                    beta[k] += jacobian[i, j, k] * residuals[i, j]
+                    for m in range(k + 1):
+                        alpha[k, m] += jacobian[i, j, k] * jacobian[i, j, m]
+        converged = False
+        while True:
+            if damping > 1e10:
+                converged = True
+                break
+            if not _solve_damped(alpha, beta, damping, n_params, L, delta):
+                damping *= 10
+                continue
+            for k in range(n_params):
+                new_theta[k] = theta[k] + delta[k]
+            new_chi2 = _chi2(new_theta, spot, grid, size)
+            if new_chi2 < chi2:
+                break
+            damping *= 10
+        if converged:
+            break
+        # Reduction of chi2 predicted by the linear model
+        predicted = 0.0
+        for k in range(n_params):
+            predicted += delta[k] * (
+                beta[k] + damping * alpha[k, k] * delta[k]
+            )
+        # Parameters are scaled by the norms of the Jacobian columns
+        step = 0.0
+        norm = 0.0
+        for k in range(n_params):
+            step += alpha[k, k] * delta[k] ** 2
+            norm += alpha[k, k] * new_theta[k] ** 2
+            theta[k] = new_theta[k]
+        if _np.sqrt(step) <= xtol * _np.sqrt(norm):
+            break
+        if (chi2 - new_chi2 <= ftol * chi2) and (predicted <= ftol * chi2):
+            break
+        damping = max(damping / 10, 1e-7)
+    return theta
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _fit_spots_lm(spots, theta, ftol, xtol, max_it):
+    size = spots.shape[1]
+    size_half = int(size / 2)
+    grid = _np.arange(-size_half, size_half + 1).astype(_np.float64)
+    for i in range(len(spots)):
+        theta0 = _initial_parameters(spots[i], size, size_half)
+        theta[i] = _fit_spot_lm(
+            spots[i], grid, size, theta0, ftol, xtol, max_it
+        )
+
+
 def fit_spot(spot):
     size = spot.shape[0]
     size_half = int(size / 2)
@@ -155,16 +310,15 @@ def fit_spot(spot):
     return result[0]
 
 
-def fit_spots(spots):
+def fit_spots(spots, ftol=1e-2, xtol=1e-2, max_it=100):
     theta = _np.empty((len(spots), 6), dtype=_np.float32)
     theta.fill(_np.nan)
-    for i, spot in enumerate(spots):
-        theta[i] = fit_spot(spot)
+    _fit_spots_lm(spots, theta, ftol, xtol, max_it)
     return theta
 
 
 def fit_spots_parallel(spots, asynch=False):
-    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    n_workers = _lib.n_workers()
     n_spots = len(spots)
     n_tasks = 100 * n_workers
     spots_per_task = [
@@ -175,9 +329,11 @@ def fit_spots_parallel(spots, asynch=False):
     ]
     start_indices = _np.cumsum([0] + spots_per_task[:-1])
     fs = []
-    executor = _futures.ProcessPoolExecutor(n_workers)
+    # The fits release the GIL, so threads avoid pickling the spots
+    executor = _futures.ThreadPoolExecutor(n_workers)
     for i, n_spots_task in zip(start_indices, spots_per_task):
         fs.append(executor.submit(fit_spots, spots[i: i + n_spots_task]))
+    executor.shutdown(wait=False)
     if asynch:
         return fs
     with _tqdm(total=n_tasks, unit="task") as progress_bar:
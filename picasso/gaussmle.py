@@ -11,15 +11,17 @@
 import numpy as _np
 import numba as _numba
 import math as _math
-import multiprocessing as _multiprocessing
 import threading as _threading
 from concurrent import futures as _futures
+from . import lib as _lib
 
 
 GAMMA = _np.array([1.0, 1.0, 0.5, 1.0, 1.0, 1.0])
+# Maximum number of spots that a worker fits between progress updates
+MAX_RANGE = 256
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _sum_and_center_of_mass(spot, size):
     x = 0.0
     y = 0.0
@@ -34,7 +36,7 @@ def _sum_and_center_of_mass(spot, size):
     return _sum_, y, x
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def mean_filter(spot, size):
     filtered_spot = _np.zeros_like(spot)
     for k in range(size):
@@ -52,7 +54,7 @@ def mean_filter(spot, size):
     return filtered_spot
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_sigmas(spot, y, x, size):
     size_half = int(size / 2)
     sum_deviation_y = 0.0
@@ -78,7 +80,7 @@ def _initial_sigmas(spot, y, x, size):
     return sy, sx
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_parameters(spot, size):
     sum, y, x = _sum_and_center_of_mass(spot, size)
     bg = _np.min(mean_filter(spot, size))
@@ -88,7 +90,7 @@ def _initial_parameters(spot, size):
     return x, y, photons_sane, bg, sx, sy
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_theta_sigma(spot, size):
     theta = _np.zeros(5, dtype=_np.float32)
     theta[0], theta[1], theta[2], theta[3], sx, sy = _initial_parameters(
@@ -98,7 +100,7 @@ def _initial_theta_sigma(spot, size):
     return theta
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _initial_theta_sigmaxy(spot, size):
     theta = _np.zeros(6, dtype=_np.float32)
     theta[0], theta[1], theta[2], theta[3], theta[4], theta[
@@ -107,7 +109,7 @@ def _initial_theta_sigmaxy(spot, size):
     return theta
 
 
-@_numba.vectorize(nopython=True)
+@_numba.vectorize(nopython=True, cache=True)
 def _erf(x):
     """ Currently not needed, but might be useful for a CUDA implementation """
     ax = _np.abs(x)
@@ -203,7 +205,7 @@ def _erf(x):
     return _np.sign(x)
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _gaussian_integral(x, mu, sigma):
     sq_norm = 0.70710678118654757 / sigma  # sq_norm = sqrt(0.5/sigma**2)
     d = x - mu
@@ -212,7 +214,7 @@ def _gaussian_integral(x, mu, sigma):
     )
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _derivative_gaussian_integral(x, mu, sigma, photons, PSFc):
     d = x - mu
     a = _np.exp(-0.5 * ((d + 0.5) / sigma) ** 2)
@@ -227,7 +229,7 @@ def _derivative_gaussian_integral(x, mu, sigma, photons, PSFc):
     return dudt, d2udt2
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _derivative_gaussian_integral_1d_sigma(x, mu, sigma, photons, PSFc):
     ax = _np.exp(-0.5 * ((x + 0.5 - mu) / sigma) ** 2)
     bx = _np.exp(-0.5 * ((x - 0.5 - mu) / sigma) ** 2)
@@ -243,7 +245,7 @@ def _derivative_gaussian_integral_1d_sigma(x, mu, sigma, photons, PSFc):
     return dudt, d2udt2
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _derivative_gaussian_integral_2d_sigma(
     x, y, mu, nu, sigma, photons, PSFx, PSFy
 ):
@@ -269,15 +271,35 @@ def _worker(
     max_it,
     current,
     lock,
+    claimed,
+    n_workers,
 ):
+    """
+    Fits contiguous ranges of spots, which shrink towards the end so that
+    the workers finish together. current[0] counts the fitted spots.
+    """
     N = len(spots)
     while True:
         with lock:
-            index = current[0]
-            if index == N:
+            start = claimed[0]
+            if start == N:
                 return
-            current[0] += 1
-        func(spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+            n = max(1, (N - start) // (2 * n_workers))
+            stop = start + min(n, MAX_RANGE)
+            claimed[0] = stop
+        func(
+            spots,
+            start,
+            stop,
+            thetas,
+            CRLBs,
+            likelihoods,
+            iterations,
+            eps,
+            max_it,
+        )
+        with lock:
+            current[0] += stop - start
 
 
 def gaussmle(spots, eps, max_it, method="sigma"):
@@ -287,33 +309,50 @@ def gaussmle(spots, eps, max_it, method="sigma"):
     likelihoods = _np.zeros(N, dtype=_np.float32)
     iterations = _np.zeros(N, dtype=_np.int32)
     if method == "sigma":
-        func = _mlefit_sigma
+        func = _mlefit_sigma_range
     elif method == "sigmaxy":
-        func = _mlefit_sigmaxy
+        func = _mlefit_sigmaxy_range
     else:
         raise ValueError("Method not available.")
-    for i in range(N):
-        func(spots, i, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+    func(spots, 0, N, thetas, CRLBs, likelihoods, iterations, eps, max_it)
     return thetas, CRLBs, likelihoods, iterations
 
 
 def gaussmle_async(spots, eps, max_it, method="sigma"):
+    current, thetas, CRLBs, likelihoods, iterations, _ = _gaussmle_submit(
+        spots, eps, max_it, method
+    )
+    return current, thetas, CRLBs, likelihoods, iterations
+
+
+def gaussmle_parallel(spots, eps, max_it, method="sigma"):
+    """ Same as gaussmle_async, but returns when all spots are fitted """
+    _, thetas, CRLBs, likelihoods, iterations, fs = _gaussmle_submit(
+        spots, eps, max_it, method
+    )
+    for f in fs:
+        f.result()
+    return thetas, CRLBs, likelihoods, iterations
+
+
+def _gaussmle_submit(spots, eps, max_it, method):
     N = len(spots)
     thetas = _np.zeros((N, 6), dtype=_np.float32)
     CRLBs = _np.inf * _np.ones((N, 6), dtype=_np.float32)
     likelihoods = _np.zeros(N, dtype=_np.float32)
     iterations = _np.zeros(N, dtype=_np.int32)
-    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    n_workers = _lib.n_workers()
     lock = _threading.Lock()
     current = [0]
+    claimed = [0]
     if method == "sigma":
-        func = _mlefit_sigma
+        func = _mlefit_sigma_range
     elif method == "sigmaxy":
-        func = _mlefit_sigmaxy
+        func = _mlefit_sigmaxy_range
     else:
         raise ValueError("Method not available.")
     executor = _futures.ThreadPoolExecutor(n_workers)
-    for i in range(n_workers):
+    fs = [
         executor.submit(
             _worker,
             func,
@@ -326,16 +365,18 @@ def gaussmle_async(spots, eps, max_it, method="sigma"):
             max_it,
             current,
             lock,
+            claimed,
+            n_workers,
         )
+        for _ in range(n_workers)
+    ]
     executor.shutdown(wait=False)
     # A synchronous single-threaded version for debugging:
-    # for i in range(N):
-    #     print('Spot', i)
-    #     func(spots, i, thetas, CRLBs, likelihoods, iterations, eps, max_it)
-    return current, thetas, CRLBs, likelihoods, iterations
+    # func(spots, 0, N, thetas, CRLBs, likelihoods, iterations, eps, max_it)
+    return current, thetas, CRLBs, likelihoods, iterations, fs
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _mlefit_sigma(
     spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it
 ):
@@ -490,7 +531,7 @@ def _mlefit_sigma(
     CRLBs[index, 5] = CRLB[4]
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _mlefit_sigmaxy(
     spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it
 ):
@@ -652,6 +693,26 @@ def _mlefit_sigmaxy(
     CRLBs[index] = CRLB
 
 
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _mlefit_sigma_range(
+    spots, start, stop, thetas, CRLBs, likelihoods, iterations, eps, max_it
+):
+    for index in range(start, stop):
+        _mlefit_sigma(
+            spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it
+        )
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _mlefit_sigmaxy_range(
+    spots, start, stop, thetas, CRLBs, likelihoods, iterations, eps, max_it
+):
+    for index in range(start, stop):
+        _mlefit_sigmaxy(
+            spots, index, thetas, CRLBs, likelihoods, iterations, eps, max_it
+        )
+
+
 def locs_from_fits(
     identifications, theta, CRLBs, likelihoods, iterations, box
 ):
@@ -0,0 +1,127 @@
+"""
+    picasso.grouping
+    ~~~~~~~~~~~~~~~~
+
+    Statistics of localizations per group, computed from a single sort
+
+    :copyright: Copyright (c) 2016-2018 Jungmann Lab, MPI of Biochemistry
+"""
+import numpy as _np
+from scipy.spatial import ConvexHull as _ConvexHull
+
+from . import neighbors as _neighbors
+
+
+class Groups:
+    """
+    Sorts the localizations once by one or more keys (e.g. group and
+    cluster), such that each group is a contiguous segment. Reductions
+    return one value per group, in the order of the keys.
+    """
+
+    def __init__(self, *keys):
+        self.N = len(keys[0])
+        self.order = _np.lexsort(keys[::-1])
+        changes = _np.zeros(max(self.N - 1, 0), dtype=bool)
+        for key in keys:
+            sorted_key = key[self.order]
+            changes |= sorted_key[1:] != sorted_key[:-1]
+        self.starts = _np.flatnonzero(changes) + 1
+        if self.N > 0:
+            self.starts = _np.insert(self.starts, 0, 0)
+        self.ends = _np.append(self.starts[1:], self.N)
+        self.counts = self.ends - self.starts
+        self.ids = [key[self.order][self.starts] for key in keys]
+        self.n_groups = len(self.starts)
+
+    def __len__(self):
+        return self.n_groups
+
+    def sort(self, values):
+        """ Values in the order of the groups """
+        return values[self.order]
+
+    def segments(self, values):
+        """ Iterates over the sorted values of each group """
+        values = self.sort(values)
+        for start, end in zip(self.starts, self.ends):
+            yield values[start:end]
+
+    def expand(self, group_values):
+        """ Maps one value per group back to each localization """
+        expanded = _np.empty(self.N, dtype=group_values.dtype)
+        expanded[self.order] = _np.repeat(group_values, self.counts)
+        return expanded
+
+    def _reduce(self, ufunc, values, dtype=None):
+        values = self.sort(values)
+        if dtype is not None:
+            values = values.astype(dtype)
+        if self.n_groups == 0:
+            return _np.zeros(0, dtype=values.dtype)
+        return ufunc.reduceat(values, self.starts)
+
+    def count(self):
+        return self.counts
+
+    def sum(self, values):
+        return self._reduce(_np.add, values, _np.float64)
+
+    def mean(self, values):
+        return self.sum(values) / self.counts
+
+    def std(self, values):
+        mean = self.mean(values)
+        deviation = values - self.expand(mean)
+        return _np.sqrt(self.sum(deviation ** 2) / self.counts)
+
+    def min(self, values):
+        return self._reduce(_np.minimum, values)
+
+    def max(self, values):
+        return self._reduce(_np.maximum, values)
+
+    def weighted_mean(self, values, weights):
+        weights = _np.float64(weights)
+        return self.sum(weights * values) / self.sum(weights)
+
+    def first(self, values):
+        return self.sort(values)[self.starts]
+
+    def last(self, values):
+        return self.sort(values)[self.ends - 1]
+
+    def convex_hull(self, points):
+        """
+        Volume (area in 2D) of the convex hull of each group of points, an
+        array of shape (N, dimensions), or 0 if it can not be computed
+        """
+        hull = _np.zeros(self.n_groups)
+        for i, group_points in enumerate(self.segments(points)):
+            try:
+                hull[i] = _ConvexHull(group_points).volume
+            except Exception as e:
+                print(e)
+        return hull
+
+    def min_distance_to_others(self, points, labels):
+        """
+        For each group, the minimum distance of each label (in ascending
+        order) to the points of the other labels in the group. Returns the
+        concatenated distances of all groups.
+        """
+        min_dist = []
+        for group_points, group_labels in zip(
+            self.segments(points), self.segments(labels)
+        ):
+            unique_labels, label_index = _np.unique(
+                group_labels, return_inverse=True
+            )
+            neighbors = _neighbors.Neighbors(group_points)
+            distances = neighbors.nearest_other(label_index)
+            group_min = _np.full(len(unique_labels), _np.inf)
+            _np.minimum.at(group_min, label_index, distances)
+            min_dist.append(group_min)
+        if len(min_dist) == 0:
+            return _np.zeros(0)
+        return _np.concatenate(min_dist)
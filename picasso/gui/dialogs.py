@@ -0,0 +1,51 @@
+"""
+    gui/dialogs
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Progress and status dialogs shared by the GUIs, available as
+    picasso.lib.ProgressDialog and picasso.lib.StatusDialog
+
+    :copyright: Copyright (c) 2016 Jungmann Lab, MPI of Biochemistry
+"""
+from PyQt5 import QtCore, QtWidgets
+
+from .. import lib
+
+
+class ProgressDialog(QtWidgets.QProgressDialog):
+    def __init__(self, description, minimum, maximum, parent):
+        super().__init__(
+            description,
+            None,
+            minimum,
+            maximum,
+            parent,
+            QtCore.Qt.CustomizeWindowHint,
+        )
+        lib._dialogs.append(self)
+        self.setMinimumDuration(500)
+        self.setModal(True)
+        self.app = QtCore.QCoreApplication.instance()
+
+    def set_value(self, value):
+        self.setValue(value)
+        self.app.processEvents()
+
+    def closeEvent(self, event):
+        lib._dialogs.remove(self)
+
+
+class StatusDialog(QtWidgets.QDialog):
+    def __init__(self, description, parent):
+        super(StatusDialog, self).__init__(
+            parent, QtCore.Qt.CustomizeWindowHint
+        )
+        lib._dialogs.append(self)
+        vbox = QtWidgets.QVBoxLayout(self)
+        label = QtWidgets.QLabel(description)
+        vbox.addWidget(label)
+        self.show()
+        QtCore.QCoreApplication.instance().processEvents()
+
+    def closeEvent(self, event):
+        lib._dialogs.remove(self)
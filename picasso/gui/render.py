@@ -42,11 +42,18 @@ import colorsys
 
 from .. import imageprocess, io, lib, postprocess, render
 
+plt.style.use("ggplot")
+
 DEFAULT_OVERSAMPLING = 1.0
 INITIAL_REL_MAXIMUM = 0.5
 ZOOM = 10 / 7
 N_GROUP_COLORS = 8
 N_Z_COLORS = 32
+# Memory budget of the tile caches of all channels, unless set in the
+# user settings (Render: Tile cache MB)
+TILE_CACHE_MB = 512
+# Blur widths below this fraction of a display pixel are not drawn
+LOD_MAX_BLUR = 1 / 3
 
 matplotlib.rcParams.update({"axes.titlesize": "large"})
 
@@ -1158,6 +1165,72 @@ class LinkDialog(QtWidgets.QDialog):
             result == QtWidgets.QDialog.Accepted,
         )
 
+
+class OpenRegionDialog(QtWidgets.QDialog):
+    def __init__(self, window, info):
+        super().__init__(window)
+        self.window = window
+        self.setWindowTitle("Open region")
+        vbox = QtWidgets.QVBoxLayout(self)
+        grid = QtWidgets.QGridLayout()
+        height = info[0]["Height"]
+        width = info[0]["Width"]
+        n_frames = info[0].get("Frames", 0)
+        self.spinboxes = {}
+        for i, (label, name, maximum, value) in enumerate(
+            [
+                ("Min. y (pixels):", "y_min", height, 0),
+                ("Max. y (pixels):", "y_max", height, height),
+                ("Min. x (pixels):", "x_min", width, 0),
+                ("Max. x (pixels):", "x_max", width, width),
+            ]
+        ):
+            grid.addWidget(QtWidgets.QLabel(label), i, 0)
+            spinbox = QtWidgets.QDoubleSpinBox()
+            spinbox.setRange(0, maximum)
+            spinbox.setValue(value)
+            grid.addWidget(spinbox, i, 1)
+            self.spinboxes[name] = spinbox
+        for i, (label, name, value) in enumerate(
+            [
+                ("First frame:", "start", 0),
+                ("Last frame (exclusive):", "stop", n_frames),
+            ]
+        ):
+            grid.addWidget(QtWidgets.QLabel(label), i + 4, 0)
+            spinbox = QtWidgets.QSpinBox()
+            spinbox.setRange(0, 2**31 - 1)
+            spinbox.setValue(value)
+            grid.addWidget(spinbox, i + 4, 1)
+            self.spinboxes[name] = spinbox
+        vbox.addLayout(grid)
+        # OK and Cancel buttons
+        self.buttons = QtWidgets.QDialogButtonBox(
+            QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel,
+            QtCore.Qt.Horizontal,
+            self,
+        )
+        vbox.addWidget(self.buttons)
+        self.buttons.accepted.connect(self.accept)
+        self.buttons.rejected.connect(self.reject)
+
+    # static method to create the dialog and return input
+    @staticmethod
+    def getParams(parent, info):
+        dialog = OpenRegionDialog(parent, info)
+        result = dialog.exec_()
+        value = {k: v.value() for k, v in dialog.spinboxes.items()}
+        viewport = [
+            (value["y_min"], value["x_min"]),
+            (value["y_max"], value["x_max"]),
+        ]
+        return (
+            viewport,
+            (value["start"], value["stop"]),
+            result == QtWidgets.QDialog.Accepted,
+        )
+
+
 class DbscanDialog(QtWidgets.QDialog):
     def __init__(self, window):
         super().__init__(window)
@@ -2429,16 +2502,36 @@ class View(QtWidgets.QLabel):
         self.currentdrift = []
         self.x_render_cache = []
         self.x_render_state = False
+        self._tile_caches = {}
+        try:
+            settings = io.load_user_settings()
+            tile_cache_mb = settings["Render"]["Tile cache MB"]
+        except KeyError:
+            tile_cache_mb = None
+        if not tile_cache_mb:
+            tile_cache_mb = TILE_CACHE_MB
+        self.tile_cache_mb = tile_cache_mb
 
     def is_consecutive(l):
         setl = set(l)
         return len(l) == len(setl) and setl == set(range(min(l), max(l) + 1))
 
-    def add(self, path, render=True):
+    def add(self, path, render=True, viewport=None, frames=None):
         try:
-            locs, info = io.load_locs(path, qt_parent=self)
+            locs, info = io.load_locs(
+                path, qt_parent=self, viewport=viewport, frames=frames
+            )
         except io.NoMetadataFileError:
             return
+        if viewport is not None or frames is not None:
+            region_info = {"Generated by": "Picasso Render : Open region"}
+            if viewport is not None:
+                region_info["Viewport"] = [
+                    [float(_) for _ in corner] for corner in viewport
+                ]
+            if frames is not None:
+                region_info["Frames"] = [int(_) for _ in frames]
+            info = info + [region_info]
         locs = lib.ensure_sanity(locs, info)
 
         # update pixelsize
@@ -2758,15 +2851,20 @@ class View(QtWidgets.QLabel):
     def dbscan(self):
         radius, min_density, ok = DbscanDialog.getParams()
         if ok:
+            pixelsize = self.window.display_settings_dlg.pixelsize.value()
             for locs_path in (self.locs_paths):
                 locs, locs_info = io.load_locs(locs_path)
-                clusters, locs = postprocess.dbscan(locs, radius, min_density)
+                clusters, locs = postprocess.dbscan(
+                    locs, radius, min_density, pixelsize
+                )
                 base, ext = os.path.splitext(locs_path)
                 dbscan_info = {
                     "Generated by": "Picasso DBSCAN",
                     "Radius": radius,
                     "Minimum local density": min_density,
                 }
+                if hasattr(locs, "z"):
+                    dbscan_info["Pixelsize"] = pixelsize
                 locs_info.append(dbscan_info)
                 io.save_locs(base + "_dbscan.hdf5", locs, locs_info)
                 with File(base + "_dbclusters.hdf5", "w") as clusters_file:
@@ -4390,7 +4488,6 @@ class View(QtWidgets.QLabel):
     def filter_picks(self):
         channel = self.get_channel("Pick similar")
         if channel is not None:
-            locs = self.locs[channel]
             info = self.infos[channel]
             d = self.window.tools_settings_dialog.pick_diameter.value()
             r = d / 2
@@ -4403,25 +4500,8 @@ class View(QtWidgets.QLabel):
 
             if self._picks:
                 removelist = []
-                loccount = []
-                progress = lib.ProgressDialog(
-                    "Counting in picks..", 0, len(self._picks) - 1, self
-                )
-                progress.set_value(0)
-                progress.show()
-                for i, pick in enumerate(self._picks):
-                    x, y = pick
-                    block_locs = postprocess.get_block_locs_at(
-                        x, y, index_blocks
-                    )
-                    pick_locs = lib.locs_at(x, y, block_locs, r)
-                    locs = stack_arrays(
-                        pick_locs, asrecarray=True, usemask=False
-                    )
-                    loccount.append(len(locs))
-                    progress.set_value(i)
-
-                progress.close()
+                x, y = np.array(self._picks).T
+                loccount, _ = index_blocks.indices_within(x, y, r)
                 fig = plt.figure()
                 fig.canvas.set_window_title("Localizations in Picks")
                 ax = fig.add_subplot(111)
@@ -4495,13 +4575,18 @@ class View(QtWidgets.QLabel):
         progress = lib.ProgressDialog("Indexing localizations", 0, K, self)
         progress.show()
         progress.set_value(0)
-        index_blocks = postprocess.get_index_blocks(
+        index_blocks = postprocess.IndexBlocks(
             locs, info, size, progress.set_value
         )
         self.index_blocks[channel] = index_blocks
 
     def get_index_blocks(self, channel):
-        if self.index_blocks[channel] is None:
+        """ The index of the channel, rebuilt if the locs have changed """
+        index_blocks = self.index_blocks[channel]
+        size = self.window.tools_settings_dialog.pick_diameter.value() / 2
+        if index_blocks is None or not index_blocks.matches(
+            self.locs[channel], self.infos[channel], size
+        ):
             self.index_locs(channel)
         return self.index_blocks[channel]
 
@@ -4513,7 +4598,6 @@ class View(QtWidgets.QLabel):
             )
         channel = self.get_channel("Pick similar")
         if channel is not None:
-            locs = self.locs[channel]
             info = self.infos[channel]
             d = self.window.tools_settings_dialog.pick_diameter.value()
             r = d / 2
@@ -4521,14 +4605,10 @@ class View(QtWidgets.QLabel):
                 self.window.tools_settings_dialog.pick_similar_range.value()
             )
             index_blocks = self.get_index_blocks(channel)
-            n_locs = []
-            rmsd = []
-            for i, pick in enumerate(self._picks):
-                x, y = pick
-                block_locs = postprocess.get_block_locs_at(x, y, index_blocks)
-                pick_locs = lib.locs_at(x, y, block_locs, r)
-                n_locs.append(len(pick_locs))
-                rmsd.append(self.rmsd_at_com(pick_locs))
+            x, y = np.array(self._picks).T
+            picks_locs = index_blocks.locs_within(x, y, r)
+            n_locs = [len(_) for _ in picks_locs]
+            rmsd = [self.rmsd_at_com(_) for _ in picks_locs]
             mean_n_locs = np.mean(n_locs)
             mean_rmsd = np.mean(rmsd)
             std_n_locs = np.std(n_locs)
@@ -4546,9 +4626,6 @@ class View(QtWidgets.QLabel):
             y_range_shift = y_range_base + d / 2
             d2 = d ** 2
             nx = len(x_range)
-            locs, size, x_index, y_index, block_starts, block_ends, K, L = (
-                index_blocks
-            )
             progress = lib.ProgressDialog("Pick similar", 0, nx, self)
             progress.set_value(0)
             for i, x_grid in enumerate(x_range):
@@ -4557,51 +4634,42 @@ class View(QtWidgets.QLabel):
                     y_range = y_range_shift
                 else:
                     y_range = y_range_base
-                for y_grid in y_range:
-                    n_block_locs = postprocess.n_block_locs_at(
-                        x_grid, y_grid, size, K, L, block_starts, block_ends
-                    )
-                    if n_block_locs > min_n_locs:
-                        block_locs = postprocess.get_block_locs_at(
-                            x_grid, y_grid, index_blocks
-                        )
-                        picked_locs = lib.locs_at(
-                            x_grid, y_grid, block_locs, r
-                        )
-                        if len(picked_locs) > 1:
-                            # Move to COM peak
-                            x_test_old = x_grid
-                            y_test_old = y_grid
+                n_block_locs = index_blocks.n_block_locs_at(
+                    np.full(len(y_range), x_grid), y_range
+                )
+                for y_grid in y_range[n_block_locs > min_n_locs]:
+                    block_locs = index_blocks.block_locs_at(x_grid, y_grid)
+                    picked_locs = lib.locs_at(x_grid, y_grid, block_locs, r)
+                    if len(picked_locs) > 1:
+                        # Move to COM peak
+                        x_test_old = x_grid
+                        y_test_old = y_grid
+                        x_test = picked_locs.x.mean()
+                        y_test = picked_locs.y.mean()
+                        while (
+                            np.abs(x_test - x_test_old) > 1e-3
+                            or np.abs(y_test - y_test_old) > 1e-3
+                        ):
+                            x_test_old = x_test
+                            y_test_old = y_test
+                            picked_locs = lib.locs_at(
+                                x_test, y_test, block_locs, r
+                            )
                             x_test = picked_locs.x.mean()
                             y_test = picked_locs.y.mean()
-                            while (
-                                np.abs(x_test - x_test_old) > 1e-3
-                                or np.abs(y_test - y_test_old) > 1e-3
-                            ):
-                                x_test_old = x_test
-                                y_test_old = y_test
-                                picked_locs = lib.locs_at(
-                                    x_test, y_test, block_locs, r
-                                )
-                                x_test = picked_locs.x.mean()
-                                y_test = picked_locs.y.mean()
-                            if np.all(
-                                (x_similar - x_test) ** 2
-                                + (y_similar - y_test) ** 2
-                                > d2
-                            ):
-                                if min_n_locs < len(picked_locs) < max_n_locs:
-                                    if (
-                                        min_rmsd
-                                        < self.rmsd_at_com(picked_locs)
-                                        < max_rmsd
-                                    ):
-                                        x_similar = np.append(
-                                            x_similar, x_test
-                                        )
-                                        y_similar = np.append(
-                                            y_similar, y_test
-                                        )
+                        if np.all(
+                            (x_similar - x_test) ** 2
+                            + (y_similar - y_test) ** 2
+                            > d2
+                        ):
+                            if min_n_locs < len(picked_locs) < max_n_locs:
+                                if (
+                                    min_rmsd
+                                    < self.rmsd_at_com(picked_locs)
+                                    < max_rmsd
+                                ):
+                                    x_similar = np.append(x_similar, x_test)
+                                    y_similar = np.append(y_similar, y_test)
                 progress.set_value(i + 1)
             similar = list(zip(x_similar, y_similar))
             self._picks = []
@@ -4620,12 +4688,9 @@ class View(QtWidgets.QLabel):
                 d = self.window.tools_settings_dialog.pick_diameter.value()
                 r = d / 2
                 index_blocks = self.get_index_blocks(channel)
-                for i, pick in enumerate(self._picks):
-                    x, y = pick
-                    block_locs = postprocess.get_block_locs_at(
-                        x, y, index_blocks
-                    )
-                    group_locs = lib.locs_at(x, y, block_locs, r)
+                x, y = np.array(self._picks).T
+                picks_locs = index_blocks.locs_within(x, y, r)
+                for i, group_locs in enumerate(picks_locs):
                     if add_group:
                         group = i * np.ones(len(group_locs), dtype=np.int32)
                         group_locs = lib.append_to_rec(
@@ -4779,12 +4844,16 @@ class View(QtWidgets.QLabel):
                 n_locs = self.n_locs
                 image = self.image
             else:
-                renderings = []
-                for i in range(len(self.locs)):
-                    # We render all images first
-                    # and later decide to keep them or not
-                    renderings.append(render.render(locsall[i], **kwargs))
-                renderings = [render.render(_, **kwargs) for _ in locsall]
+                # We render all images first
+                # and later decide to keep them or not
+                renderings = None
+                if all([_ is __ for _, __ in zip(locsall, self.locs)]):
+                    # Only drawing the scene (cache) may rescale
+                    renderings = self.render_from_tile_caches(
+                        range(n_channels), kwargs, exact=not cache
+                    )
+                if renderings is None:
+                    renderings = [render.render(_, **kwargs) for _ in locsall]
                 n_locs = sum([_[0] for _ in renderings])
                 image = np.array([_[1] for _ in renderings])
         else:
@@ -4915,7 +4984,16 @@ class View(QtWidgets.QLabel):
             n_locs = self.n_locs
             image = self.image
         else:
-            n_locs, image = render.render(locs, **kwargs)
+            renderings = None
+            if locs is self.locs[0]:
+                # Only drawing the scene (cache) may rescale
+                renderings = self.render_from_tile_caches(
+                    [0], kwargs, exact=not cache
+                )
+            if renderings is None:
+                n_locs, image = render.render(locs, **kwargs)
+            else:
+                n_locs, image = renderings[0]
         if cache:
             self.n_locs = n_locs
             self.image = image
@@ -4930,6 +5008,69 @@ class View(QtWidgets.QLabel):
         self._bgra[..., 2] = cmap[:, 0][image]
         return self._bgra
 
+    def get_tile_cache(self, channel):
+        """ The tile cache of the channel, rebuilt if its locs changed """
+        locs = self.locs[channel]
+        info = self.infos[channel]
+        stale = [_ for _ in self._tile_caches if _ >= len(self.locs)]
+        if stale:
+            self.close_tile_caches(stale)
+        tile_cache = self._tile_caches.get(channel)
+        # The budget is shared by all channels
+        max_bytes = self.tile_cache_mb * 2 ** 20 / len(self.locs)
+        if tile_cache is None or not tile_cache.matches(locs, info):
+            if tile_cache is not None:
+                tile_cache.close()
+            tile_cache = render.TileCache(locs, info, max_bytes=max_bytes)
+            self._tile_caches[channel] = tile_cache
+        tile_cache.max_bytes = max_bytes
+        return tile_cache
+
+    def close_tile_caches(self, channels=None):
+        """
+        Closes the tile caches of removed channels, or of all channels, and
+        renumbers the others to the channels that remain
+        """
+        if channels is None:
+            channels = list(self._tile_caches)
+        tile_caches = {}
+        for channel, tile_cache in self._tile_caches.items():
+            if channel in channels:
+                tile_cache.close()
+            else:
+                shift = len([_ for _ in channels if _ < channel])
+                tile_caches[channel - shift] = tile_cache
+        self._tile_caches = tile_caches
+
+    def render_from_tile_caches(self, channels, kwargs, exact=False):
+        """
+        Renders the channels from their histogram tile caches, if no blur
+        is visible at the current zoom. Returns None if the channels need
+        to be rendered exactly, e.g. while the caches are built.
+        Unless exact, the image is at the next power of two oversampling,
+        as draw_scene scales it to the view anyway. Exact renderings (e.g.
+        for export) are identical to render.render, otherwise None.
+        """
+        blur_method = kwargs["blur_method"]
+        if exact and blur_method is not None:
+            return None
+        if blur_method in ["gaussian", "gaussian_iso", "convolve"]:
+            blur_width = max(self.median_lp, kwargs["min_blur_width"])
+            if kwargs["oversampling"] * blur_width >= LOD_MAX_BLUR:
+                return None
+        elif blur_method is not None:
+            return None
+        tile_caches = [self.get_tile_cache(_) for _ in channels]
+        if not all([_.ready.is_set() for _ in tile_caches]):
+            return None
+        renderings = [
+            _.render(kwargs["oversampling"], kwargs["viewport"], exact=exact)
+            for _ in tile_caches
+        ]
+        if any([_ is None for _ in renderings]):
+            return None
+        return renderings
+
     def resizeEvent(self, event):
         self.update_scene()
 
@@ -5390,6 +5531,52 @@ class View(QtWidgets.QLabel):
                     rcc_progress.set_value(n_pairs)
                     self.update_scene()
 
+    def undrift_locs(self):
+        """ Undrifts by matching the locs of segments to previous ones. """
+        channel = self.get_channel("Undrift")
+        if channel is not None:
+            info = self.infos[channel]
+            n_frames = info[0]["Frames"]
+            if n_frames < 1000:
+                default_segmentation = int(n_frames / 4)
+            else:
+                default_segmentation = 1000
+            segmentation, ok = QtWidgets.QInputDialog.getInt(
+                self,
+                "Undrift by localizations",
+                "Segmentation:",
+                default_segmentation,
+            )
+
+            if ok:
+                locs = self.locs[channel]
+                n_segments = render.n_segments(info, segmentation)
+                progress = lib.ProgressDialog(
+                    "Matching segments", 0, n_segments, self
+                )
+                try:
+                    drift, _ = postprocess.undrift_locs(
+                        locs, info, segmentation, False, progress.set_value
+                    )
+                    self.locs[channel] = lib.ensure_sanity(locs, info)
+                    self.index_blocks[channel] = None
+                    self.add_drift(channel, drift)
+                    self.update_scene()
+                    self.show_drift()
+
+                except Exception as e:
+                    QtWidgets.QMessageBox.information(
+                        self,
+                        "Undrift Error",
+                        (
+                            "Undrifting failed. \nConsider changing "
+                            "segmentation.\n"
+                            "The following exception occured:\n\n {}".format(e)
+                        ),
+                    )
+                    progress.set_value(n_segments)
+                    self.update_scene()
+
     @check_picks
     def undrift_from_picked(self):
         channel = self.get_channel("Undrift from picked")
@@ -5887,6 +6074,8 @@ class Window(QtWidgets.QMainWindow):
         open_action = file_menu.addAction("Open")
         open_action.setShortcut(QtGui.QKeySequence.Open)
         open_action.triggered.connect(self.open_file_dialog)
+        open_region_action = file_menu.addAction("Open region")
+        open_region_action.triggered.connect(self.open_region_dialog)
         save_action = file_menu.addAction("Save localizations")
         save_action.setShortcut("Ctrl+S")
         save_action.triggered.connect(self.save_locs)
@@ -6042,6 +6231,10 @@ class Window(QtWidgets.QMainWindow):
         undrift_action = postprocess_menu.addAction("Undrift by RCC")
         undrift_action.setShortcut("Ctrl+U")
         undrift_action.triggered.connect(self.view.undrift)
+        undrift_locs_action = postprocess_menu.addAction(
+            "Undrift by localizations"
+        )
+        undrift_locs_action.triggered.connect(self.view.undrift_locs)
         undrift_from_picked_action = postprocess_menu.addAction(
             "Undrift from picked"
         )
@@ -6126,6 +6319,7 @@ class Window(QtWidgets.QMainWindow):
                 self.view.locs_paths[0]
             )
         io.save_user_settings(settings)
+        self.view.close_tile_caches()
         QtWidgets.qApp.closeAllWindows()
 
     def export_current(self):
@@ -6831,6 +7025,36 @@ class Window(QtWidgets.QMainWindow):
                 self.view.add(path, render=False)
                 self.view.update_scene()
 
+    def open_region_dialog(self):
+        """
+        Loads only the locs of a region and range of frames, which reads
+        only the chunks that hold them from files saved with --indexed
+        """
+        if self.pwd == []:
+            path, ext = QtWidgets.QFileDialog.getOpenFileName(
+                self, "Add localizations", filter="*.hdf5"
+            )
+        else:
+            path, ext = QtWidgets.QFileDialog.getOpenFileName(
+                self, "Add localizations", directory=self.pwd, filter="*.hdf5"
+            )
+        if not path:
+            return
+        try:
+            info = io.load_info(path, qt_parent=self)
+        except io.NoMetadataFileError:
+            return
+        viewport, frames, ok = OpenRegionDialog.getParams(self, info)
+        if ok:
+            self.pwd = path
+            if len(self.view.locs) == 0:
+                self.view.add(path, viewport=viewport, frames=frames)
+            else:
+                self.view.add(
+                    path, render=False, viewport=viewport, frames=frames
+                )
+                self.view.update_scene()
+
     def resizeEvent(self, event):
         self.update_info()
 
@@ -7,17 +7,15 @@
     :author: Joerg Schnitzbauer, 2016
     :copyright: Copyright (c) 2016 Jungmann Lab, MPI of Biochemistry
 """
-import matplotlib.pyplot as _plt
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+from concurrent.futures import as_completed as _as_completed
+
 import numpy as _np
 from numpy import fft as _fft
-import lmfit as _lmfit
 from tqdm import tqdm as _tqdm
 from . import lib as _lib
 
 
-_plt.style.use("ggplot")
-
-
 def xcorr(imageA, imageB):
     FimageA = _fft.fft2(imageA)
     CFimageB = _np.conj(_fft.fft2(imageB))
@@ -49,8 +47,6 @@ def get_image_shift(imageA, imageB, box, roi=None, display=False):
         Y_ = X_ = 0
     # A quarter of the fit ROI
     fit_X = int(box / 2)
-    # A coordinate grid for the fitting ROI
-    y, x = _np.mgrid[-fit_X: fit_X + 1, -fit_X: fit_X + 1]
     # Find the brightest pixel and cut out the fit ROI
     y_max_, x_max_ = _np.unravel_index(XCorr.argmax(), XCorr.shape)
     FitROI = XCorr[
@@ -58,45 +54,27 @@ def get_image_shift(imageA, imageB, box, roi=None, display=False):
         x_max_ - fit_X: x_max_ + fit_X + 1,
     ]
 
-    dimensions = FitROI.shape
-
-    if 0 in dimensions or dimensions[0] != dimensions[1]:
+    if FitROI.shape != (2 * fit_X + 1, 2 * fit_X + 1):
         xc, yc = 0, 0
     else:
-        # The fit model
-        def flat_2d_gaussian(a, xc, yc, s, b):
-            A = a * _np.exp(-0.5 * ((x - xc) ** 2 + (y - yc) ** 2) / s ** 2) + b
-            return A.flatten()
-
-        gaussian2d = _lmfit.Model(
-            flat_2d_gaussian, name="2D Gaussian", independent_vars=[]
-        )
-
-        # Set up initial parameters and fit
-        params = _lmfit.Parameters()
-        params.add("a", value=FitROI.max(), vary=True, min=0)
-        params.add("xc", value=0, vary=True)
-        params.add("yc", value=0, vary=True)
-        params.add("s", value=1, vary=True, min=0)
-        params.add("b", value=FitROI.min(), vary=True, min=0)
-        results = gaussian2d.fit(FitROI.flatten(), params)
-
-        # Get maximum coordinates and add offsets
-        xc = results.best_values["xc"]
-        yc = results.best_values["yc"]
+        # Get the subpixel maximum coordinates and add offsets
+        yc, xc = _subpixel_peak(FitROI)
         xc += X_ + x_max_
         yc += Y_ + y_max_
 
         if display:
-            _plt.figure(figsize=(17, 10))
-            _plt.subplot(1, 3, 1)
-            _plt.imshow(imageA, interpolation="none")
-            _plt.subplot(1, 3, 2)
-            _plt.imshow(imageB, interpolation="none")
-            _plt.subplot(1, 3, 3)
-            _plt.imshow(XCorr, interpolation="none")
-            _plt.plot(xc, yc, "x")
-            _plt.show()
+            import matplotlib.pyplot as plt
+
+            plt.style.use("ggplot")
+            plt.figure(figsize=(17, 10))
+            plt.subplot(1, 3, 1)
+            plt.imshow(imageA, interpolation="none")
+            plt.subplot(1, 3, 2)
+            plt.imshow(imageB, interpolation="none")
+            plt.subplot(1, 3, 3)
+            plt.imshow(XCorr, interpolation="none")
+            plt.plot(xc, yc, "x")
+            plt.show()
 
         xc -= _np.floor(X / 2)
         yc -= _np.floor(Y / 2)
@@ -104,23 +82,151 @@ def get_image_shift(imageA, imageB, box, roi=None, display=False):
     return -yc, -xc
 
 
+# Least squares fit of c0 + c1 x + c2 y + c3 x^2 + c4 y^2 + c5 x y to 3x3
+# values, as a matrix applied to the flattened values
+_y3, _x3 = _np.mgrid[-1:2, -1:2].reshape(2, 9)
+_QUADRATIC_3X3 = _np.linalg.pinv(
+    _np.stack(
+        [_np.ones(9), _x3, _y3, _x3 ** 2, _y3 ** 2, _x3 * _y3], axis=1
+    )
+)
+
+
+def _subpixel_peak(roi):
+    """
+    Offset (y, x) of the maximum of a peak from the center of a square roi.
+    A 2D Gaussian is fitted in closed form to the 3x3 pixels around the
+    center, after subtracting the roi minimum as background.
+    """
+    c = roi.shape[0] // 2
+    peak = roi[c - 1: c + 2, c - 1: c + 2] - roi.min()
+    if _np.all(peak > 0):
+        c0, c1, c2, c3, c4, c5 = _QUADRATIC_3X3 @ _np.log(peak).ravel()
+        hessian = _np.array([[2 * c4, c5], [c5, 2 * c3]])
+        if hessian[0, 0] < 0 and _np.linalg.det(hessian) > 0:
+            offset = -_np.linalg.solve(hessian, [c2, c1])
+            if _np.all(_np.abs(offset) <= 1):
+                return offset[0], offset[1]
+    # Parabolas through the center row and column
+    offset = []
+    for m, z, p in [peak[:, 1], peak[1, :]]:
+        curvature = m - 2 * z + p
+        offset.append((m - p) / (2 * curvature) if curvature < 0 else 0.0)
+    return offset[0], offset[1]
+
+
+def _correlation_lags(n, roi):
+    """
+    Lags of the correlation of images of size n that get_image_shift keeps
+    for a roi, in the order of its (fftshifted) correlation image
+    """
+    crop = 0 if roi is None else max(int((n - roi) / 2), 0)
+    return _np.arange(crop - n // 2, n - crop - n // 2)
+
+
+class _CroppedCorrelation:
+    """
+    Cross-correlations of images of a shape, evaluated at the lags of a roi
+    only. If the roi is at most half of the image, the inverse DFT of the
+    product of the half spectra is taken with two matrix products, which
+    is cheaper than a full inverse FFT.
+    """
+
+    def __init__(self, shape, roi):
+        self.shape = shape
+        Y, X = shape
+        self.Y_ = max(int((Y - roi) / 2), 0) if roi is not None else 0
+        self.X_ = max(int((X - roi) / 2), 0) if roi is not None else 0
+        lags_y = _correlation_lags(Y, roi)
+        lags_x = _correlation_lags(X, roi)
+        self.full = 2 * len(lags_y) > Y or 2 * len(lags_x) > X
+        if self.full:
+            return
+        k_y = _np.arange(Y)
+        k_x = _np.arange(X // 2 + 1)
+        self.inverse_y = _np.exp(2j * _np.pi * _np.outer(lags_y, k_y) / Y)
+        # Each frequency of the half spectrum stands for itself and its
+        # complex conjugate, apart from 0 and the Nyquist frequency
+        weights = _np.full(len(k_x), 2.0)
+        weights[0] = 1
+        if X % 2 == 0:
+            weights[-1] = 1
+        self.inverse_x = (
+            weights[:, _np.newaxis]
+            * _np.exp(2j * _np.pi * _np.outer(k_x, lags_x) / X)
+        )
+        self.norm = 1 / (Y * X * _np.sqrt(Y * X))
+
+    def __call__(self, spectrumA, spectrumB):
+        product = spectrumA * _np.conj(spectrumB)
+        if self.full:
+            Y, X = self.shape
+            XCorr = _fft.fftshift(_fft.irfft2(product, s=self.shape))
+            XCorr = XCorr[self.Y_: Y - self.Y_, self.X_: X - self.X_]
+            return XCorr / _np.sqrt(Y * X)
+        XCorr = (self.inverse_y @ product) @ self.inverse_x
+        return self.norm * XCorr.real
+
+
+def _rcc_shift(spectrumA, spectrumB, correlation, box):
+    """ Shift from A to B like get_image_shift, from their spectra """
+    if spectrumA[0, 0].real == 0 or spectrumB[0, 0].real == 0:
+        # The images are empty
+        return 0, 0
+    XCorr = correlation(spectrumA, spectrumB)
+    fit_X = int(box / 2)
+    y_max_, x_max_ = _np.unravel_index(XCorr.argmax(), XCorr.shape)
+    FitROI = XCorr[
+        max(y_max_ - fit_X, 0): y_max_ + fit_X + 1,
+        max(x_max_ - fit_X, 0): x_max_ + fit_X + 1,
+    ]
+    if FitROI.shape != (2 * fit_X + 1, 2 * fit_X + 1):
+        return 0, 0
+    yc, xc = _subpixel_peak(FitROI)
+    Y, X = correlation.shape
+    yc += correlation.Y_ + y_max_ - _np.floor(Y / 2)
+    xc += correlation.X_ + x_max_ - _np.floor(X / 2)
+    return -yc, -xc
+
+
 def rcc(segments, max_shift=None, callback=None):
-    n_segments = len(segments)
+    """
+    Redundant cross-correlation: the shifts between all pairs of segments,
+    reduced to one shift per segment. Segments can be any iterable of
+    images, e.g. a generator; only the (single precision) spectrum of each
+    is kept. Pairs are correlated in a thread pool.
+    """
+    spectra = []
+    shape = None
+    for segment in segments:
+        shape = segment.shape
+        spectra.append(_fft.rfft2(segment).astype(_np.complex64))
+    n_segments = len(spectra)
     shifts_x = _np.zeros((n_segments, n_segments))
     shifts_y = _np.zeros((n_segments, n_segments))
     n_pairs = int(n_segments * (n_segments - 1) / 2)
+    if callback is not None:
+        callback(0)
+    if n_pairs == 0:
+        return _lib.minimize_shifts(shifts_x, shifts_y)
+    correlation = _CroppedCorrelation(shape, max_shift)
+    n_workers = _lib.n_workers()
     flag = 0
     with _tqdm(
         total=n_pairs, desc="Correlating image pairs", unit="pairs"
     ) as progress_bar:
-        if callback is not None:
-            callback(0)
-        for i in range(n_segments - 1):
-            for j in range(i + 1, n_segments):
+        with _ThreadPoolExecutor(n_workers) as executor:
+            futures = {
+                executor.submit(
+                    _rcc_shift, spectra[i], spectra[j], correlation, 5
+                ): (i, j)
+                for i in range(n_segments - 1)
+                for j in range(i + 1, n_segments)
+            }
+            for future in _as_completed(futures):
+                i, j = futures[future]
+                shifts_y[i, j], shifts_x[i, j] = future.result()
                 progress_bar.update()
-                shifts_y[i, j], shifts_x[i, j] = get_image_shift(
-                    segments[i], segments[j], 5, max_shift
-                )
                 flag += 1
                 if callback is not None:
                     callback(flag)
@@ -9,6 +9,7 @@
 """
 import os.path as _ospath
 import numpy as _np
+from numpy.lib.recfunctions import repack_fields as _repack_fields
 import yaml as _yaml
 import glob as _glob
 import h5py as _h5py
@@ -16,11 +17,25 @@ import re as _re
 import struct as _struct
 import json as _json
 import os as _os
+import tempfile as _tempfile
 import threading as _threading
-from PyQt5.QtWidgets import QMessageBox as _QMessageBox
 from . import lib as _lib
 
 
+# Positioned reads allow reading frames from multiple threads without a lock
+_HAS_PREADV = hasattr(_os, "preadv")
+
+# Layout of indexed locs files: tiles of LOCS_TILE_SIZE camera pixels
+# (doubled until there are at most LOCS_MAX_TILES), LOCS_FRAME_BLOCKS
+# blocks of frames and chunks of LOCS_CHUNK_ROWS locs
+LOCS_TILE_SIZE = 32
+LOCS_MAX_TILES = 4096
+LOCS_FRAME_BLOCKS = 64
+LOCS_CHUNK_ROWS = 2 ** 14
+# Rows of locs read or written at once when streaming
+LOCS_STREAM_ROWS = 2 ** 20
+
+
 class NoMetadataFileError(FileNotFoundError):
     pass
 
@@ -47,12 +62,12 @@ def load_raw(path, prompt_info=None):
                     base, ext = _ospath.splitext(path)
                     info_path = base + ".yaml"
                     save_info(info_path, info)
-    dtype = _np.dtype(info[0]["Data Type"])
+    # Big endian movies stay mapped, numpy swaps bytes of what is read
+    dtype = _np.dtype(info[0]["Data Type"]).newbyteorder(
+        info[0]["Byte Order"]
+    )
     shape = (info[0]["Frames"], info[0]["Height"], info[0]["Width"])
     movie = _np.memmap(path, dtype, "r", shape=shape)
-    if info[0]["Byte Order"] != "<":
-        movie = movie.byteswap()
-        info[0]["Byte Order"] = "<"
     return movie, info
 
 
@@ -76,8 +91,12 @@ def multiple_filenames(path, index):
 
 
 def load_tif(path):
-    movie = TiffMultiMap(path, memmap_frames=False)
+    movie = TiffMultiMap(path, memmap_frames=True)
     info = movie.info()
+    if movie.memmaps is not None and movie.n_maps == 1:
+        # A single mapped file behaves just like a raw movie
+        movie.close()
+        movie = movie.memmaps[0]
     return movie, [info]
 
 
@@ -103,6 +122,8 @@ def load_info(path, qt_parent=None):
             )
         )
         if qt_parent is not None:
+            from PyQt5.QtWidgets import QMessageBox as _QMessageBox
+
             _QMessageBox.critical(
                 qt_parent,
                 "An error occured",
@@ -178,6 +199,8 @@ class TiffMap:
         self.first_ifd_offset = self.read("L")
 
         # Read info from first IFD
+        self.compression = 1
+        self.n_strips = 1
         self.file.seek(self.first_ifd_offset)
         n_entries = self.read("H")
         for i in range(n_entries):
@@ -197,6 +220,10 @@ class TiffMap:
                 # the tif byte order might be different
                 # so we also store the file dtype
                 self._tif_dtype = _np.dtype(self._tif_byte_order + dtype_str)
+            elif tag == 259:
+                self.compression = self.read(type, count)
+            elif tag == 273:
+                self.n_strips = count
         self.frame_shape = (self.height, self.width)
         self.frame_size = self.height * self.width
 
@@ -231,41 +258,39 @@ class TiffMap:
         self.close()
 
     def __getitem__(self, it):
-
-        with self.lock:  # for reading frames from multiple threads
-            if isinstance(it, tuple):
-                if isinstance(it, int) or _np.issubdtype(it[0], _np.integer):
-                    return self[it[0]][it[1:]]
-                elif isinstance(it[0], slice):
-                    indices = range(*it[0].indices(self.n_frames))
-                    stack = _np.array([self.get_frame(_) for _ in indices])
-                    if len(indices) == 0:
-                        return stack
-                    else:
-                        if len(it) == 2:
-                            return stack[:, it[1]]
-                        elif len(it) == 3:
-                            return stack[:, it[1], it[2]]
-                        else:
-                            raise IndexError
-                elif it[0] == Ellipsis:
-                    stack = self[it[0]]
+        if isinstance(it, tuple):
+            if isinstance(it, int) or _np.issubdtype(it[0], _np.integer):
+                return self[it[0]][it[1:]]
+            elif isinstance(it[0], slice):
+                indices = range(*it[0].indices(self.n_frames))
+                stack = _np.array([self.get_frame(_) for _ in indices])
+                if len(indices) == 0:
+                    return stack
+                else:
                     if len(it) == 2:
                         return stack[:, it[1]]
                     elif len(it) == 3:
                         return stack[:, it[1], it[2]]
                     else:
                         raise IndexError
-            elif isinstance(it, slice):
-                indices = range(*it.indices(self.n_frames))
-                return _np.array([self.get_frame(_) for _ in indices])
-            elif it == Ellipsis:
-                return _np.array(
-                    [self.get_frame(_) for _ in range(self.n_frames)]
-                )
-            elif isinstance(it, int) or _np.issubdtype(it, _np.integer):
-                return self.get_frame(it)
-            raise TypeError
+            elif it[0] == Ellipsis:
+                stack = self[it[0]]
+                if len(it) == 2:
+                    return stack[:, it[1]]
+                elif len(it) == 3:
+                    return stack[:, it[1], it[2]]
+                else:
+                    raise IndexError
+        elif isinstance(it, slice):
+            indices = range(*it.indices(self.n_frames))
+            return _np.array([self.get_frame(_) for _ in indices])
+        elif it == Ellipsis:
+            return _np.array(
+                [self.get_frame(_) for _ in range(self.n_frames)]
+            )
+        elif isinstance(it, int) or _np.issubdtype(it, _np.integer):
+            return self.get_frame(it)
+        raise TypeError
 
     def __iter__(self):
         for i in range(self.n_frames):
@@ -343,19 +368,70 @@ class TiffMap:
         return info
 
     def get_frame(self, index, array=None):
-        self.file.seek(self.image_offsets[index])
-        frame = _np.reshape(
-            _np.fromfile(
-                self.file, dtype=self._tif_dtype, count=self.frame_size
-            ),
-            self.frame_shape,
-        )
+        """
+        Reads a frame with a positioned read, which does not touch the
+        shared file position. Thus, frames can be read from multiple threads
+        concurrently. Only where positioned reads are not available
+        (e.g. on Windows), reading falls back to a locked seek and read.
+        """
+        frame = _np.empty(self.frame_shape, dtype=self._tif_dtype)
+        offset = self.image_offsets[index]
+        if _HAS_PREADV:
+            n_bytes = _os.preadv(self.file.fileno(), [frame], offset)
+        else:
+            with self.lock:
+                self.file.seek(offset)
+                n_bytes = self.file.readinto(frame)
+        if n_bytes != frame.nbytes:
+            raise ValueError("Could not read frame {}.".format(index))
         # We only want to deal with little endian byte order downstream:
         if self._tif_byte_order == ">":
             frame.byteswap(True)
-            frame = frame.newbyteorder("<")
+            frame = frame.view(self.dtype)
         return frame
 
+    def memmap(self):
+        """
+        Returns all frames as a read-only, strided view into a memory map of
+        the file, so that frames and frame stacks are not copied on access.
+        This requires uncompressed, little endian frames of a single strip
+        that are equally spaced in the file. Otherwise, returns None.
+        """
+        if (
+            self.compression != 1
+            or self.n_strips != 1
+            or self._tif_byte_order != "<"
+        ):
+            return None
+        offsets = _np.array(self.image_offsets, dtype=_np.int64)
+        itemsize = self._tif_dtype.itemsize
+        frame_bytes = self.frame_size * itemsize
+        if self.n_frames > 1:
+            strides = _np.unique(_np.diff(offsets))
+            if len(strides) != 1 or strides[0] < frame_bytes:
+                return None
+            stride = int(strides[0])
+        else:
+            stride = frame_bytes
+        if offsets[0] % itemsize or stride % itemsize:
+            return None
+        length = (self.n_frames - 1) * stride + frame_bytes
+        if offsets[0] + length > _ospath.getsize(self.path):
+            return None
+        file_map = _np.memmap(
+            self.path,
+            dtype=_np.uint8,
+            mode="r",
+            offset=offsets[0],
+            shape=(length,),
+        )
+        return _np.ndarray(
+            (self.n_frames, self.height, self.width),
+            dtype=self._tif_dtype,
+            buffer=file_map,
+            strides=(stride, self.width * itemsize, itemsize),
+        )
+
     def read(self, type, count=1):
         if type == "c":
             return self.file.read(count)
@@ -403,6 +479,12 @@ class TiffMultiMap:
         ]
         self.maps = [TiffMap(path, verbose=verbose) for path in self.paths]
         self.n_maps = len(self.maps)
+        # Memory mapped frames of each file, if all files can be mapped
+        self.memmaps = None
+        if memmap_frames:
+            memmaps = [_.memmap() for _ in self.maps]
+            if all([_ is not None for _ in memmaps]):
+                self.memmaps = memmaps
         self.n_frames_per_map = [_.n_frames for _ in self.maps]
         self.n_frames = sum(self.n_frames_per_map)
         self.cum_n_frames = _np.insert(_np.cumsum(self.n_frames_per_map), 0, 0)
@@ -429,7 +511,7 @@ class TiffMultiMap:
                     raise IndexError
             elif isinstance(it[0], slice):
                 indices = range(*it[0].indices(self.n_frames))
-                stack = _np.array([self.get_frame(_) for _ in indices])
+                stack = self.get_stack(indices)
                 if len(indices) == 0:
                     return stack
                 else:
@@ -443,9 +525,9 @@ class TiffMultiMap:
                 return self[it[0]][it[1:]]
         elif isinstance(it, slice):
             indices = range(*it.indices(self.n_frames))
-            return _np.array([self.get_frame(_) for _ in indices])
+            return self.get_stack(indices)
         elif it == Ellipsis:
-            return _np.array([self.get_frame(_) for _ in range(self.n_frames)])
+            return self.get_stack(range(self.n_frames))
         elif isinstance(it, int) or _np.issubdtype(it, _np.integer):
             return self.get_frame(it)
         raise TypeError
@@ -468,8 +550,27 @@ class TiffMultiMap:
                 break
         else:
             raise IndexError
+        if self.memmaps is not None:
+            return self.memmaps[i][index - self.cum_n_frames[i]]
         return self.maps[i][index - self.cum_n_frames[i]]
 
+    def get_stack(self, indices):
+        """
+        Returns the frames at the given range of indices. If the frames are
+        memory mapped and all from one file, this is a view without copy.
+        """
+        if (
+            self.memmaps is not None
+            and len(indices) > 0
+            and indices.step > 0
+        ):
+            i = _np.searchsorted(self.cum_n_frames, indices[0], "right") - 1
+            start = indices[0] - self.cum_n_frames[i]
+            stop = indices[-1] - self.cum_n_frames[i]
+            if 0 <= start and stop < self.n_frames_per_map[i]:
+                return self.memmaps[i][start: stop + 1: indices.step]
+        return _np.array([self.get_frame(_) for _ in indices])
+
     def info(self):
         info = self.maps[0].info()
         info["Frames"] = self.n_frames
@@ -556,18 +657,184 @@ def save_datasets(path, info, **kwargs):
     save_info(info_path, info)
 
 
-def save_locs(path, locs, info):
+def save_locs(path, locs, info, indexed=False, compression=None):
+    """
+    Saves locs to an hdf5 file and info to a yaml file of the same name.
+    With indexed=True, the locs are stored sorted by spatial tile and
+    frame, with an index of their row ranges (see _save_indexed_locs).
+    load_locs returns them sorted by frame again, with the locs of each
+    frame in tile order, while iter_locs and raw hdf5 reads see the
+    stored order.
+    compression (e.g. "gzip" or "lzf") stores the locs in compressed
+    chunks.
+    """
     locs = _lib.ensure_sanity(locs, info)
     with _h5py.File(path, "w") as locs_file:
-        locs_file.create_dataset("locs", data=locs)
+        if indexed:
+            _save_indexed_locs(locs_file, locs, info, compression)
+        elif compression is not None:
+            locs_file.create_dataset(
+                "locs", data=locs, chunks=True, compression=compression
+            )
+        else:
+            locs_file.create_dataset("locs", data=locs)
     base, ext = _ospath.splitext(path)
     info_path = base + ".yaml"
     save_info(info_path, info)
 
 
-def load_locs(path, qt_parent=None):
+def _save_indexed_locs(locs_file, locs, info, compression):
+    """
+    Stores the locs sorted by square tiles of camera pixels, row by row,
+    and by frame within each tile, in chunks of LOCS_CHUNK_ROWS rows. The
+    index dataset holds the first row of each pair of tile and block of
+    frames, in this order, followed by the number of locs.
+    """
+    height = info[0]["Height"]
+    width = info[0]["Width"]
+    tile_size = LOCS_TILE_SIZE
+    while _np.ceil(height / tile_size) * _np.ceil(width / tile_size) > (
+        LOCS_MAX_TILES
+    ):
+        tile_size *= 2
+    n_tiles_y = int(_np.ceil(height / tile_size))
+    n_tiles_x = int(_np.ceil(width / tile_size))
+    frame = locs.frame.astype(_np.int64)
+    n_frames = int(frame.max()) + 1 if len(locs) else 1
+    frame_block = int(_np.ceil(n_frames / LOCS_FRAME_BLOCKS))
+    n_frame_blocks = int(_np.ceil(n_frames / frame_block))
+    tile = (locs.y // tile_size).astype(_np.int64) * n_tiles_x
+    tile += (locs.x // tile_size).astype(_np.int64)
+    order = _np.lexsort((frame, tile))
+    key = tile[order] * n_frame_blocks + frame[order] // frame_block
+    index = _np.searchsorted(
+        key, _np.arange(n_tiles_y * n_tiles_x * n_frame_blocks + 1)
+    )
+    if len(locs) == 0:
+        # Empty datasets can not be chunked
+        locs_file.create_dataset("locs", data=locs)
+    else:
+        locs_file.create_dataset(
+            "locs",
+            data=locs[order],
+            chunks=(min(LOCS_CHUNK_ROWS, len(locs)),),
+            compression=compression,
+        )
+    index = locs_file.create_dataset("index", data=index)
+    index.attrs["tile_size"] = tile_size
+    index.attrs["n_tiles_y"] = n_tiles_y
+    index.attrs["n_tiles_x"] = n_tiles_x
+    index.attrs["frame_block"] = frame_block
+    index.attrs["n_frame_blocks"] = n_frame_blocks
+
+
+def _indexed_row_ranges(index, viewport, frames):
+    """
+    Merged row ranges of the tiles overlapping the viewport and the blocks
+    of frames overlapping frames, from the index dataset of a locs file
+    """
+    starts = index[...]
+    tile_size = index.attrs["tile_size"]
+    n_tiles_y = index.attrs["n_tiles_y"]
+    n_tiles_x = index.attrs["n_tiles_x"]
+    frame_block = index.attrs["frame_block"]
+    n_frame_blocks = index.attrs["n_frame_blocks"]
+    if viewport is None:
+        ty_min, tx_min = 0, 0
+        ty_max, tx_max = n_tiles_y, n_tiles_x
+    else:
+        (y_min, x_min), (y_max, x_max) = viewport
+        ty_min = min(max(int(y_min // tile_size), 0), n_tiles_y)
+        tx_min = min(max(int(x_min // tile_size), 0), n_tiles_x)
+        ty_max = min(max(int(_np.ceil(y_max / tile_size)), 0), n_tiles_y)
+        tx_max = min(max(int(_np.ceil(x_max / tile_size)), 0), n_tiles_x)
+    if frames is None:
+        fb_min, fb_max = 0, n_frame_blocks
+    else:
+        start, stop = frames
+        fb_min = min(max(int(start // frame_block), 0), n_frame_blocks)
+        fb_max = min(
+            max(int(_np.ceil(stop / frame_block)), 0), n_frame_blocks
+        )
+    ranges = []
+    for ty in range(ty_min, ty_max):
+        for tx in range(tx_min, tx_max):
+            key = (ty * n_tiles_x + tx) * n_frame_blocks
+            first = starts[key + fb_min]
+            last = starts[key + fb_max]
+            if first == last:
+                continue
+            if ranges and ranges[-1][1] == first:
+                ranges[-1][1] = last
+            else:
+                ranges.append([first, last])
+    return ranges
+
+
+def load_locs(
+    path,
+    qt_parent=None,
+    viewport=None,
+    frames=None,
+    fields=None,
+    lazy=False,
+):
+    """
+    Loads locs and their info. Optionally only the locs within a viewport
+    [(y_min, x_min), (y_max, x_max)] and frames (start, stop), where
+    minimums are inclusive and maximums exclusive, and only the given
+    fields, such that the other columns are neither read nor copied. For
+    files saved with indexed=True, only the chunks that hold these locs
+    are read, and the locs are sorted by frame again. With lazy=True and
+    no viewport or frames, returns LazyLocs, which read each column on
+    first access.
+    """
+    if lazy and viewport is None and frames is None:
+        locs = LazyLocs(path, fields=fields)
+        info = load_info(path, qt_parent=qt_parent)
+        return locs, info
     with _h5py.File(path, "r") as locs_file:
-        locs = locs_file["locs"][...]
+        dataset = locs_file["locs"]
+        names = dataset.dtype.names
+        # Indexed files are stored in tile order
+        sort = "index" in locs_file and "frame" in names
+        if fields is not None:
+            missing = [_ for _ in fields if _ not in names]
+            if missing:
+                raise ValueError(
+                    "Fields not in {}: {}".format(path, ", ".join(missing))
+                )
+            # The fields needed for the selection are read as well
+            names = list(fields)
+            if viewport is not None:
+                names += [_ for _ in ["x", "y"] if _ not in names]
+            if (frames is not None or sort) and "frame" not in names:
+                names.append("frame")
+            dataset = dataset.fields(names)
+        selective = viewport is not None or frames is not None
+        if selective and "index" in locs_file:
+            ranges = _indexed_row_ranges(locs_file["index"], viewport, frames)
+            locs = _np.concatenate(
+                [dataset[start:stop] for start, stop in ranges]
+                + [dataset[0:0]]
+            )
+        else:
+            locs = dataset[...]
+    if viewport is not None:
+        (y_min, x_min), (y_max, x_max) = viewport
+        locs = locs[
+            (locs["x"] >= x_min)
+            & (locs["y"] >= y_min)
+            & (locs["x"] < x_max)
+            & (locs["y"] < y_max)
+        ]
+    if frames is not None:
+        start, stop = frames
+        locs = locs[(locs["frame"] >= start) & (locs["frame"] < stop)]
+    if sort:
+        locs = locs[_np.argsort(locs["frame"], kind="stable")]
+    if fields is not None and len(fields) < len(locs.dtype.names):
+        locs = _repack_fields(locs[list(fields)])
     locs = _np.rec.array(
         locs, dtype=locs.dtype
     )  # Convert to rec array with fields as attributes
@@ -575,6 +842,268 @@ def load_locs(path, qt_parent=None):
     return locs, info
 
 
+class LazyLocs:
+    """
+    Locs of a file whose columns are read on first access, from a memory
+    map of uncompressed files or from the hdf5 file otherwise. Columns are
+    accessed like those of a recarray, by attribute or key. Any other use
+    (selecting rows, sorting, numpy functions) converts the locs once to a
+    recarray, which then holds all columns. Like load_locs, the columns
+    of indexed files are in the order of frames.
+    """
+
+    def __init__(self, path, fields=None):
+        self.path = path
+        with _h5py.File(path, "r") as locs_file:
+            dataset = locs_file["locs"]
+            file_dtype = dataset.dtype
+            self._len = len(dataset)
+            offset = dataset.id.get_offset()
+            contiguous = dataset.chunks is None and offset is not None
+            # Indexed files are stored in tile order
+            indexed = "index" in locs_file and "frame" in file_dtype.names
+        if fields is None:
+            fields = file_dtype.names
+        missing = [_ for _ in fields if _ not in file_dtype.names]
+        if missing:
+            raise ValueError(
+                "Fields not in {}: {}".format(path, ", ".join(missing))
+            )
+        self.dtype = _np.dtype([(_, file_dtype[_]) for _ in fields])
+        self._memmap = None
+        if contiguous:
+            self._memmap = _np.memmap(
+                path, file_dtype, "r", offset=offset, shape=self._len
+            )
+        self._columns = {}
+        self._records = None
+        self._order = None
+        if indexed:
+            self._order = _np.argsort(self._read("frame"), kind="stable")
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def shape(self):
+        return (self._len,)
+
+    def column(self, name):
+        if self._records is not None:
+            return self._records[name]
+        if name not in self._columns:
+            column = self._read(name)
+            if self._order is not None:
+                column = column[self._order]
+            self._columns[name] = column
+        return self._columns[name]
+
+    def _read(self, name):
+        """ A column in the order of the file """
+        if self._memmap is not None:
+            return _np.array(self._memmap[name])
+        with _h5py.File(self.path, "r") as locs_file:
+            return locs_file["locs"].fields(name)[...]
+
+    def to_recarray(self):
+        """ All columns, including changes to those already read """
+        if self._records is None:
+            records = _np.recarray(self._len, dtype=self.dtype)
+            for name in self.dtype.names:
+                records[name] = self.column(name)
+            self._records = records
+            self._columns = {}
+            self._memmap = None
+        return self._records
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set on the instance
+        if not name.startswith("_"):
+            if name in self.dtype.names:
+                return self.column(name)
+            if hasattr(_np.recarray, name):
+                return getattr(self.to_recarray(), name)
+        raise AttributeError(
+            "'LazyLocs' object has no attribute '{}'".format(name)
+        )
+
+    def __setattr__(self, name, value):
+        if "dtype" in self.__dict__ and name in self.dtype.names:
+            self[name] = value
+        else:
+            super().__setattr__(name, value)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.column(key)
+        return self.to_recarray()[key]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, str) and self._records is None:
+            self.column(key)[...] = value
+        else:
+            self.to_recarray()[key] = value
+
+    def __iter__(self):
+        return iter(self.to_recarray())
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.to_recarray()
+        return self.to_recarray().astype(dtype)
+
+
+def iter_locs(path, chunk_rows=LOCS_STREAM_ROWS):
+    """
+    Yields the locs of a file in chunks of chunk_rows, as recarrays, and at
+    least one (empty) chunk
+    """
+    with _h5py.File(path, "r") as locs_file:
+        dataset = locs_file["locs"]
+        for start in range(0, max(len(dataset), 1), chunk_rows):
+            locs = dataset[start: start + chunk_rows]
+            yield _np.rec.array(locs, dtype=locs.dtype)
+
+
+class LocsWriter:
+    """
+    Saves locs chunk by chunk, like save_locs: locs are appended to a
+    chunked hdf5 dataset, and the info is saved on close. If the locs were
+    not appended in the order of frames, they are sorted on close, with at
+    most about LOCS_STREAM_ROWS locs in memory (see _sort_by_frame).
+    """
+
+    def __init__(self, path, dtype, info):
+        self.path = path
+        self.info = info
+        self._file = _h5py.File(path, "w")
+        self._dataset = self._file.create_dataset(
+            "locs",
+            shape=(0,),
+            maxshape=(None,),
+            dtype=dtype,
+            chunks=(LOCS_CHUNK_ROWS,),
+        )
+        self._sorted = True
+        self._last_frame = None
+
+    def append(self, locs):
+        locs = _lib.ensure_sanity(locs, self.info)
+        if len(locs) == 0:
+            return
+        if "frame" in locs.dtype.names:
+            frame = locs.frame
+            if _np.any(frame[1:] < frame[:-1]) or (
+                self._last_frame is not None and frame[0] < self._last_frame
+            ):
+                self._sorted = False
+            self._last_frame = frame[-1]
+        n = len(self._dataset)
+        self._dataset.resize((n + len(locs),))
+        self._dataset[n:] = locs
+
+    def close(self):
+        if self._file is None:
+            return
+        if not self._sorted:
+            self._sort_by_frame()
+        self._file.close()
+        self._file = None
+        base, ext = _ospath.splitext(self.path)
+        save_info(base + ".yaml", self.info)
+
+    def _sort_by_frame(self):
+        """
+        Stable external merge sort of the dataset by frame: runs of
+        LOCS_STREAM_ROWS locs are sorted into a temporary file next to the
+        output, and merged back, reading a part of each run at a time
+        """
+        dataset = self._dataset
+        N = len(dataset)
+        run_rows = LOCS_STREAM_ROWS
+        if N <= run_rows:
+            locs = dataset[...]
+            dataset[...] = locs[_np.argsort(locs["frame"], kind="stable")]
+            return
+        fd, runs_path = _tempfile.mkstemp(
+            suffix=".hdf5", dir=_ospath.dirname(_ospath.abspath(self.path))
+        )
+        _os.close(fd)
+        try:
+            with _h5py.File(runs_path, "w") as runs_file:
+                runs = runs_file.create_dataset(
+                    "runs",
+                    shape=(N,),
+                    dtype=dataset.dtype,
+                    chunks=(LOCS_CHUNK_ROWS,),
+                )
+                for start in range(0, N, run_rows):
+                    locs = dataset[start: start + run_rows]
+                    locs = locs[_np.argsort(locs["frame"], kind="stable")]
+                    runs[start: start + run_rows] = locs
+                self._merge_runs(runs, run_rows)
+        finally:
+            _os.remove(runs_path)
+
+    def _merge_runs(self, runs, run_rows):
+        """
+        Merges the sorted runs into the dataset. All buffered locs with a
+        frame below the last buffered frame of every run that is not read
+        completely are written, such that the locs of one frame are always
+        written together, in the order they were appended.
+        """
+        N = len(runs)
+        run_starts = list(range(0, N, run_rows))
+        run_stops = run_starts[1:] + [N]
+        read_rows = max(run_rows // len(run_starts), 1)
+        positions = list(run_starts)
+        buffers = []
+        for i, start in enumerate(run_starts):
+            positions[i] = min(start + read_rows, run_stops[i])
+            buffers.append(runs[start: positions[i]])
+        written = 0
+        while written < N:
+            unread = [
+                i for i in range(len(buffers)) if positions[i] < run_stops[i]
+            ]
+            if unread:
+                last = [buffers[i]["frame"][-1] for i in unread]
+                bound = min(last)
+                n_take = [
+                    _np.searchsorted(_["frame"], bound, "left")
+                    for _ in buffers
+                ]
+                if sum(n_take) == 0:
+                    # All buffered locs are in the bound frame, read on
+                    i = unread[int(_np.argmin(last))]
+                    stop = min(positions[i] + read_rows, run_stops[i])
+                    buffers[i] = _np.concatenate(
+                        [buffers[i], runs[positions[i]: stop]]
+                    )
+                    positions[i] = stop
+                    continue
+            else:
+                n_take = [len(_) for _ in buffers]
+            locs = _np.concatenate(
+                [_[:n] for _, n in zip(buffers, n_take)]
+            )
+            locs = locs[_np.argsort(locs["frame"], kind="stable")]
+            self._dataset[written: written + len(locs)] = locs
+            written += len(locs)
+            for i, n in enumerate(n_take):
+                buffers[i] = buffers[i][n:]
+                if len(buffers[i]) == 0 and positions[i] < run_stops[i]:
+                    stop = min(positions[i] + read_rows, run_stops[i])
+                    buffers[i] = runs[positions[i]: stop]
+                    positions[i] = stop
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 def load_clusters(path, qt_parent=None):
     with _h5py.File(path, "r") as cluster_file:
         clusters = cluster_file["clusters"][...]
@@ -15,10 +15,10 @@ from numpy.lib.recfunctions import append_fields as _append_fields
 from numpy.lib.recfunctions import drop_fields as _drop_fields
 import collections as _collections
 import glob as _glob
+import multiprocessing as _multiprocessing
+import os as _os
 import os.path as _ospath
 from picasso import io as _io
-from PyQt5 import QtGui, QtCore, QtWidgets
-from lmfit import Model as _Model
 
 
 # A global variable where we store all open progress and status dialogs.
@@ -27,43 +27,36 @@ from lmfit import Model as _Model
 _dialogs = []
 
 
-class ProgressDialog(QtWidgets.QProgressDialog):
-    def __init__(self, description, minimum, maximum, parent):
-        super().__init__(
-            description,
-            None,
-            minimum,
-            maximum,
-            parent,
-            QtCore.Qt.CustomizeWindowHint,
-        )
-        _dialogs.append(self)
-        self.setMinimumDuration(500)
-        self.setModal(True)
-        self.app = QtCore.QCoreApplication.instance()
-
-    def set_value(self, value):
-        self.setValue(value)
-        self.app.processEvents()
-
-    def closeEvent(self, event):
-        _dialogs.remove(self)
-
+def __getattr__(name):
+    """
+    Loads the Qt dialogs (see picasso.gui.dialogs) and the lmfit models on
+    first use, such that lib imports without GUI dependencies
+    """
+    if name in ("ProgressDialog", "StatusDialog"):
+        from .gui import dialogs
+
+        return getattr(dialogs, name)
+    elif name == "CumulativeExponentialModel":
+        from lmfit import Model
+
+        global CumulativeExponentialModel
+        CumulativeExponentialModel = Model(cumulative_exponential)
+        return CumulativeExponentialModel
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name)
+    )
 
-class StatusDialog(QtWidgets.QDialog):
-    def __init__(self, description, parent):
-        super(StatusDialog, self).__init__(
-            parent, QtCore.Qt.CustomizeWindowHint
-        )
-        _dialogs.append(self)
-        vbox = QtWidgets.QVBoxLayout(self)
-        label = QtWidgets.QLabel(description)
-        vbox.addWidget(label)
-        self.show()
-        QtCore.QCoreApplication.instance().processEvents()
 
-    def closeEvent(self, event):
-        _dialogs.remove(self)
+def n_workers(cpu_utilization=0.75):
+    """
+    Threads for parallel work in this process: the given fraction of the
+    CPUs, unless PICASSO_THREADS is set (e.g. by picasso.batch, which
+    shares the cores between files)
+    """
+    try:
+        return max(1, int(_os.environ["PICASSO_THREADS"]))
+    except (KeyError, ValueError):
+        return max(1, int(cpu_utilization * _multiprocessing.cpu_count()))
 
 
 class AutoDict(_collections.defaultdict):
@@ -79,6 +72,9 @@ class AutoDict(_collections.defaultdict):
 
 
 def cancel_dialogs():
+    from PyQt5 import QtCore
+    from .gui.dialogs import ProgressDialog
+
     dialogs = [_ for _ in _dialogs]
     for dialog in dialogs:
         if isinstance(dialog, ProgressDialog):
@@ -92,9 +88,6 @@ def cumulative_exponential(x, a, t, c):
     return a * (1 - _np.exp(-(x / t))) + c
 
 
-CumulativeExponentialModel = _Model(cumulative_exponential)
-
-
 def calculate_optimal_bins(data, max_n_bins=None):
     iqr = _np.subtract(*_np.percentile(data, [75, 25]))
     bin_size = 2 * iqr * len(data) ** (-1 / 3)
@@ -125,6 +118,18 @@ def append_to_rec(rec_array, data, name):
     return rec_array
 
 
+def locs_fingerprint(locs, info, n_samples=4096):
+    """ Cheap summary of locs and image size to detect changes """
+    step = max(1, len(locs) // n_samples)
+    return (
+        len(locs),
+        info[0]["Height"],
+        info[0]["Width"],
+        locs.x[::step].tobytes(),
+        locs.y[::step].tobytes(),
+    )
+
+
 def ensure_sanity(locs, info):
     # no inf or nan:
     locs = locs[
@@ -155,7 +160,7 @@ def locs_at(x, y, locs, r):
     return locs[is_picked]
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def check_if_in_rectangle(x, y, X, Y):
     """
     Checks if locs with coordinates (x, y) are in rectangle with corners (X, Y)
@@ -232,7 +237,20 @@ def remove_from_rec(rec_array, name):
     return _drop_fields(rec_array, name, usemask=False, asrecarray=True)
 
 
-def locs_glob_map(func, pattern, args=[], kwargs={}, extension=""):
+def _locs_map_file(path, func, args, kwargs, extension, fields, lazy):
+    locs, info = _io.load_locs(path, fields=fields, lazy=lazy)
+    result = func(locs, info, path, *args, **kwargs)
+    if extension:
+        base, ext = _ospath.splitext(path)
+        out_path = base + "_" + extension + ".hdf5"
+        locs, info = result
+        _io.save_locs(out_path, locs, info)
+
+
+def locs_glob_map(
+    func, pattern, args=[], kwargs={}, extension="", fields=None,
+    lazy=False, parallel=False,
+):
     """
     Maps a function to localization files, specified by a unix style path
     pattern.
@@ -240,13 +258,22 @@ def locs_glob_map(func, pattern, args=[], kwargs={}, extension=""):
     args and kwargs which are supplied to this map function.
     A new locs file will be saved if an extension is provided. In that case the
     mapped function must return new locs and a new info dict.
+    If fields are given, only these columns of the locs are loaded. With
+    lazy=True, func gets io.LazyLocs, which read each column on first
+    access.
+    If parallel is True, the files are processed in worker processes by
+    picasso.batch.map_files, which requires func to be defined at module
+    level. A failing file then does not stop the others and the results of
+    all files are returned. Otherwise, exceptions are raised.
     """
     paths = _glob.glob(pattern)
+    if parallel:
+        from . import batch
+
+        return batch.map_files(
+            _locs_map_file,
+            paths,
+            (func, args, kwargs, extension, fields, lazy),
+        )
     for path in paths:
-        locs, info = _io.load_locs(path)
-        result = func(locs, info, path, *args, **kwargs)
-        if extension:
-            base, ext = _ospath.splitext(path)
-            out_path = base + "_" + extension + ".hdf5"
-            locs, info = result
-            _io.save_locs(out_path, locs, info)
+        _locs_map_file(path, func, args, kwargs, extension, fields, lazy)
@@ -9,14 +9,14 @@
 """
 import numpy as _np
 import numba as _numba
-import multiprocessing as _multiprocessing
 import ctypes as _ctypes
 from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
 import threading as _threading
+import queue as _queue
 from itertools import chain as _chain
-import matplotlib.pyplot as _plt
 from . import gaussmle as _gaussmle
 from . import io as _io
+from . import lib as _lib
 
 
 _C_FLOAT_POINTER = _ctypes.POINTER(_ctypes.c_float)
@@ -36,10 +36,7 @@ LOCS_DTYPE = [
 ]
 
 
-_plt.style.use("ggplot")
-
-
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def local_maxima(frame, box):
     """ Finds pixels with maximum value within a region of interest """
     Y, X = frame.shape
@@ -61,14 +58,14 @@ def local_maxima(frame, box):
     return y, x
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def gradient_at(frame, y, x, i):
     gy = frame[y + 1, x] - frame[y - 1, x]
     gx = frame[y, x + 1] - frame[y, x - 1]
     return gy, gx
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def net_gradient(frame, y, x, box, uy, ux):
     box_half = int(box / 2)
     ng = _np.zeros(len(x), dtype=_np.float32)
@@ -85,7 +82,7 @@ def net_gradient(frame, y, x, box, uy, ux):
     return ng
 
 
-@_numba.jit(nopython=True, nogil=True, cache=False)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def identify_in_image(image, minimum_ng, box):
     y, x = local_maxima(image, box)
     box_half = int(box / 2)
@@ -127,30 +124,165 @@ def identify_by_frame_number(movie, minimum_ng, box, frame_number, roi=None):
     )
 
 
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _unit_gradients(box):
+    box_half = int(box / 2)
+    ux = _np.zeros((box, box), dtype=_np.float32)
+    uy = _np.zeros((box, box), dtype=_np.float32)
+    for i in range(box):
+        val = box_half - i
+        ux[:, i] = uy[i, :] = val
+    unorm = _np.sqrt(ux ** 2 + uy ** 2)
+    ux /= unorm
+    uy /= unorm
+    return uy, ux
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _identify_in_image_fused(image, minimum_ng, box, uy, ux, y, x, ng):
+    """
+    Single pass equivalent of identify_in_image, which writes the spots into
+    y, x and ng and returns their number. A pixel is a local maximum if it
+    is the first occurrence of the box maximum, as with argmax.
+    """
+    Y, X = image.shape
+    box_half = int(box / 2)
+    # Maximum of each row within the box (separable maximum filter)
+    row_max = _np.empty((Y, X), dtype=_np.float32)
+    for i in range(Y):
+        for j in range(box_half, X - box_half):
+            value = image[i, j - box_half]
+            for m in range(j - box_half + 1, j + box_half + 1):
+                if image[i, m] > value:
+                    value = image[i, m]
+            row_max[i, j] = value
+    # Central differences; index -1 wraps around as in gradient_at
+    gy = _np.zeros((Y, X), dtype=_np.float32)
+    gx = _np.zeros((Y, X), dtype=_np.float32)
+    for k in range(Y - 1):
+        k_prev = k - 1 if k > 0 else Y - 1
+        for m in range(X):
+            gy[k, m] = image[k + 1, m] - image[k_prev, m]
+    for k in range(Y):
+        for m in range(X - 1):
+            m_prev = m - 1 if m > 0 else X - 1
+            gx[k, m] = image[k, m + 1] - image[k, m_prev]
+    n = 0
+    for i in range(box_half, Y - box_half - 1):
+        for j in range(box_half, X - box_half - 1):
+            value = image[i, j]
+            if row_max[i, j] > value:
+                continue
+            is_max = True
+            for m in range(j - box_half, j):
+                if image[i, m] >= value:
+                    is_max = False
+                    break
+            if is_max:
+                for k in range(i - box_half, i):
+                    if row_max[k, j] >= value:
+                        is_max = False
+                        break
+            if is_max:
+                for k in range(i + 1, i + box_half + 1):
+                    if row_max[k, j] > value:
+                        is_max = False
+                        break
+            if not is_max:
+                continue
+            ng_ij = _np.float32(0.0)
+            for k_index in range(box):
+                k = i - box_half + k_index
+                for l_index in range(box):
+                    m = j - box_half + l_index
+                    if not (k == i and m == j):
+                        ng_ij += (
+                            gy[k, m] * uy[k_index, l_index]
+                            + gx[k, m] * ux[k_index, l_index]
+                        )
+            if ng_ij > minimum_ng:
+                y[n] = i
+                x[n] = j
+                ng[n] = ng_ij
+                n += 1
+    return n
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _identify_in_images(images, minimum_ng, box):
+    N, Y, X = images.shape
+    box_half_1 = int(box / 2) + 1
+    # Local maxima are more than box_half apart in both directions
+    max_n = ((Y + box_half_1 - 1) // box_half_1) * (
+        (X + box_half_1 - 1) // box_half_1
+    )
+    uy, ux = _unit_gradients(box)
+    counts = _np.zeros(N, dtype=_np.int64)
+    y = _np.zeros((N, max_n), dtype=_np.int32)
+    x = _np.zeros((N, max_n), dtype=_np.int32)
+    ng = _np.zeros((N, max_n), dtype=_np.float32)
+    for f in range(N):
+        counts[f] = _identify_in_image_fused(
+            images[f], minimum_ng, box, uy, ux, y[f], x[f], ng[f]
+        )
+    return counts, y, x, ng
+
+
+def identify_in_frames(frames, minimum_ng, box, roi=None):
+    """
+    Identifies spots in a stack of frames with a single kernel call.
+    Returns the same identifications as identify_by_frame_number for each
+    frame, with frame numbers relative to the stack.
+    """
+    if roi is not None:
+        frames = frames[:, roi[0][0]: roi[1][0], roi[0][1]: roi[1][1]]
+    images = _np.ascontiguousarray(frames, dtype=_np.float32)
+    counts, y, x, ng = _identify_in_images(images, minimum_ng, box)
+    valid = _np.arange(y.shape[1]) < counts[:, _np.newaxis]
+    frame = _np.repeat(_np.arange(len(counts)), counts)
+    y = y[valid]
+    x = x[valid]
+    if roi is not None:
+        y += roi[0][0]
+        x += roi[0][1]
+    return _np.rec.array(
+        (frame, x, y, ng[valid]),
+        dtype=[("frame", "i"), ("x", "i"), ("y", "i"), ("net_gradient", "f4")],
+    )
+
+
+def _identify_block_frames(movie):
+    """ Frames per kernel call, such that a block has about 2**20 pixels """
+    Y, X = movie.shape[-2:]
+    return max(1, 2 ** 20 // (Y * X))
+
+
 def _identify_worker(movie, current, minimum_ng, box, roi, lock):
     n_frames = len(movie)
+    block_frames = _identify_block_frames(movie)
     identifications = []
     while True:
         with lock:
-            index = current[0]
-            if index == n_frames:
+            start = current[0]
+            if start == n_frames:
                 return identifications
-            current[0] += 1
-        identifications.append(
-            identify_by_frame_number(movie, minimum_ng, box, index, roi)
-        )
+            stop = min(start + block_frames, n_frames)
+            current[0] = stop
+        ids = identify_in_frames(movie[start:stop], minimum_ng, box, roi)
+        ids.frame += start
+        identifications.append(ids)
     return identifications
 
 
 def identifications_from_futures(futures):
     ids_list_of_lists = [_.result() for _ in futures]
     ids_list = _chain(*ids_list_of_lists)
-    ids = _np.hstack(ids_list).view(_np.recarray)
+    ids = _np.hstack(list(ids_list)).view(_np.recarray)
     ids.sort(kind="mergesort", order="frame")
     return ids
 
 
-def identify_async(movie, minimum_ng, box, roi=None):
+def _n_identify_workers():
     "Use the user settings to define the number of workers that are being used"
     settings = _io.load_user_settings()
     try:
@@ -166,8 +298,11 @@ def identify_async(movie, minimum_ng, box, roi=None):
         settings["Localize"]["cpu_utilization"] = cpu_utilization
         _io.save_user_settings(settings)
 
-    n_workers = max(1, int(cpu_utilization * _multiprocessing.cpu_count()))
+    return _lib.n_workers(cpu_utilization)
+
 
+def identify_async(movie, minimum_ng, box, roi=None):
+    n_workers = _n_identify_workers()
     current = [0]
     executor = _ThreadPoolExecutor(n_workers)
     lock = _threading.Lock()
@@ -194,7 +329,7 @@ def identify(movie, minimum_ng, box, threaded=True):
     return _np.hstack(identifications).view(_np.recarray)
 
 
-@_numba.jit(nopython=True, cache=False)
+@_numba.jit(nopython=True, cache=True)
 def _cut_spots_numba(movie, ids_frame, ids_x, ids_y, box):
     n_spots = len(ids_x)
     r = int(box / 2)
@@ -204,7 +339,20 @@ def _cut_spots_numba(movie, ids_frame, ids_x, ids_y, box):
     return spots
 
 
-@_numba.jit(nopython=True, cache=False)
+def _cut_spots_array(movie, ids_frame, ids_x, ids_y, box):
+    """
+    Cuts spots from an array of frames. Frames in non-native byte order,
+    such as big endian raw movies, are cut as they are and only the bytes
+    of the spots are swapped.
+    """
+    if movie.dtype.isnative:
+        return _cut_spots_numba(movie, ids_frame, ids_x, ids_y, box)
+    movie = movie.view(movie.dtype.newbyteorder())
+    spots = _cut_spots_numba(movie, ids_frame, ids_x, ids_y, box)
+    return spots.byteswap(True)
+
+
+@_numba.jit(nopython=True, cache=True)
 def _cut_spots_frame(
     frame, frame_number, ids_frame, ids_x, ids_y, r, start, N, spots
 ):
@@ -219,7 +367,22 @@ def _cut_spots_frame(
 
 def _cut_spots(movie, ids, box):
     if isinstance(movie, _np.ndarray):
-        return _cut_spots_numba(movie, ids.frame, ids.x, ids.y, box)
+        return _cut_spots_array(movie, ids.frame, ids.x, ids.y, box)
+    elif getattr(movie, "memmaps", None) is not None:
+        # Memory mapped files, assumes identifications in order of frames
+        spots = _np.zeros((len(ids), box, box), dtype=movie.dtype)
+        bounds = _np.searchsorted(ids.frame, movie.cum_n_frames)
+        for memmap, first_frame, start, end in zip(
+            movie.memmaps, movie.cum_n_frames, bounds[:-1], bounds[1:]
+        ):
+            spots[start:end] = _cut_spots_numba(
+                memmap,
+                ids.frame[start:end] - first_frame,
+                ids.x[start:end],
+                ids.y[start:end],
+                box,
+            )
+        return spots
     else:
         """ Assumes that identifications are in order of frames! """
         r = int(box / 2)
@@ -315,6 +478,145 @@ def locs_from_fits(
     return locs
 
 
+def _identify_chunk(frames, minimum_ng, box, roi, executor, n_workers):
+    current = [0]
+    lock = _threading.Lock()
+    f = [
+        executor.submit(
+            _identify_worker, frames, current, minimum_ng, box, roi, lock
+        )
+        for _ in range(n_workers)
+    ]
+    return identifications_from_futures(f)
+
+
+def _put(queue, item, stop):
+    """ Puts item into the bounded queue unless stop is set meanwhile """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except _queue.Full:
+            pass
+    return False
+
+
+def _chunk_producer(
+    movie, minimum_ng, box, camera_info, chunk_frames, roi, queue, stop
+):
+    """
+    Reads, identifies and cuts spots in consecutive frame chunks and puts
+    them into the queue. The queue is bounded, so reading blocks whenever
+    the fitting falls behind. Returns early once stop is set, e.g. because
+    the fitting failed.
+    """
+    n_frames = len(movie)
+    n_workers = _n_identify_workers()
+    try:
+        with _ThreadPoolExecutor(n_workers) as executor:
+            for start in range(0, n_frames, chunk_frames):
+                stop_frame = min(start + chunk_frames, n_frames)
+                frames = movie[start:stop_frame]
+                ids = _identify_chunk(
+                    frames, minimum_ng, box, roi, executor, n_workers
+                )
+                spots = _cut_spots_array(
+                    frames, ids.frame, ids.x, ids.y, box
+                )
+                ids.frame += start
+                chunk = ids, _to_photons(spots, camera_info), stop_frame
+                if not _put(queue, chunk, stop):
+                    return
+    except Exception as e:
+        _put(queue, e, stop)
+    else:
+        _put(queue, None, stop)
+
+
+def localize_chunked(
+    movie,
+    camera_info,
+    minimum_ng,
+    box,
+    fit_chunk,
+    chunk_frames=1000,
+    roi=None,
+    current=None,
+):
+    """
+    Identifies and fits spots in chunks of `chunk_frames` frames, so that
+    only a few chunks of spots are held in memory at any time.
+    fit_chunk is called with the identifications and spots (in photons) of
+    each chunk and must return their locs, e.g. via locs_from_fits.
+    If given, current[0] is updated with the number of completed frames.
+    """
+    queue = _queue.Queue(maxsize=2)
+    stop = _threading.Event()
+    producer = _threading.Thread(
+        target=_chunk_producer,
+        args=(
+            movie, minimum_ng, box, camera_info, chunk_frames, roi, queue, stop
+        ),
+        daemon=True,
+    )
+    producer.start()
+    locs = []
+    empty_ids = (
+        _np.rec.array(
+            _np.zeros(
+                0,
+                dtype=[
+                    ("frame", "i"),
+                    ("x", "i"),
+                    ("y", "i"),
+                    ("net_gradient", "f4"),
+                ],
+            )
+        ),
+        _np.zeros((0, box, box), dtype=_np.float32),
+    )
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            ids, spots, stop_frame = chunk
+            if len(ids) > 0:
+                locs.append(fit_chunk(ids, spots))
+            if current is not None:
+                current[0] = stop_frame
+    finally:
+        # Lets the producer return if the fitting failed
+        stop.set()
+        producer.join()
+    if not locs:
+        # Still let the fit define the dtype of the (empty) result
+        return fit_chunk(*empty_ids)
+    return _np.hstack(locs).view(_np.recarray)
+
+
+def localize_chunked_async(
+    movie, camera_info, minimum_ng, box, fit_chunk, chunk_frames=1000, roi=None
+):
+    current = [0]
+    executor = _ThreadPoolExecutor(1)
+    f = executor.submit(
+        localize_chunked,
+        movie,
+        camera_info,
+        minimum_ng,
+        box,
+        fit_chunk,
+        chunk_frames,
+        roi,
+        current,
+    )
+    executor.shutdown(wait=False)
+    return current, f
+
+
 def localize(movie, info, parameters):
     print("localizing")
     identifications = identify(movie, parameters)
@@ -0,0 +1,144 @@
+"""
+    picasso.neighbors
+    ~~~~~~~~~~~~~~~~~
+
+    Nearest neighbors of points from a KD-tree, queried in chunks in a
+    thread pool
+
+    :copyright: Copyright (c) 2016-2018 Jungmann Lab, MPI of Biochemistry
+"""
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+
+import numpy as _np
+from scipy.spatial import cKDTree as _cKDTree
+
+from . import lib as _lib
+
+
+# Upper bound on the number of neighbors queried at once
+CHUNK_NEIGHBORS = 2 ** 20
+
+
+class Neighbors:
+    """
+    KD-tree of points (N, dimensions). Queries are split into chunks of at
+    most CHUNK_NEIGHBORS neighbors, such that memory stays bounded apart
+    from the results. Missing neighbors have an infinite distance and the
+    index N.
+    """
+
+    def __init__(self, points):
+        self.points = _np.ascontiguousarray(points, dtype=_np.float64)
+        self.N = len(self.points)
+        self.tree = _cKDTree(self.points)
+
+    def _map(self, function, n, k):
+        """ Calls function(start, stop) for chunks of n queries """
+        chunk = max(1, CHUNK_NEIGHBORS // k)
+        starts = range(0, n, chunk)
+        if len(starts) == 1:
+            function(0, n)
+            return
+        n_workers = _lib.n_workers()
+        with _ThreadPoolExecutor(n_workers) as executor:
+            for _ in executor.map(
+                lambda start: function(start, min(start + chunk, n)), starts
+            ):
+                pass
+
+    def _query(self, points, k, self_indices=None):
+        """ The k nearest neighbors, except the points at self_indices """
+        if self_indices is not None:
+            k += 1
+        distances, indices = self.tree.query(points, list(range(1, k + 1)))
+        if self_indices is not None:
+            is_self = indices == self_indices[:, _np.newaxis]
+            # Beyond k duplicates, the point itself may not be found
+            is_self[~is_self.any(axis=1), -1] = True
+            distances = distances[~is_self].reshape(-1, k - 1)
+            indices = indices[~is_self].reshape(-1, k - 1)
+        return distances, indices
+
+    def query(self, points, k=1):
+        """ Distances and indices (n, k) of the k nearest neighbors """
+        points = _np.asarray(points, dtype=_np.float64)
+        distances = _np.empty((len(points), k))
+        indices = _np.empty((len(points), k), dtype=_np.int64)
+
+        def query(start, stop):
+            distances[start:stop], indices[start:stop] = self._query(
+                points[start:stop], k
+            )
+
+        self._map(query, len(points), k)
+        return distances, indices
+
+    def kneighbors(self, k=1, indices=None):
+        """
+        Distances and indices (n, k) of the k nearest other points of the
+        points at indices (all by default), nearest first
+        """
+        if indices is None:
+            indices = _np.arange(self.N)
+        distances = _np.empty((len(indices), k))
+        neighbors = _np.empty((len(indices), k), dtype=_np.int64)
+
+        def query(start, stop):
+            query_indices = indices[start:stop]
+            distances[start:stop], neighbors[start:stop] = self._query(
+                self.points[query_indices], k, query_indices
+            )
+
+        self._map(query, len(indices), k + 1)
+        return distances, neighbors
+
+    def _nearest_accepted(self, accept):
+        """
+        Distance of each point to its nearest other point for which
+        accept(distances, neighbors, indices) holds, or inf. Points without
+        one among their k nearest neighbors are queried again with 2 * k.
+        """
+        distances = _np.full(self.N, _np.inf)
+        pending = _np.arange(self.N)
+        k = min(1, self.N - 1)
+        while len(pending) > 0 and k > 0:
+            found = _np.zeros(len(pending), dtype=bool)
+
+            def query(start, stop):
+                indices = pending[start:stop]
+                d, neighbors = self._query(self.points[indices], k, indices)
+                accepted = accept(d, neighbors, indices) & _np.isfinite(d)
+                first = accepted.argmax(axis=1)
+                found_ = accepted[_np.arange(len(indices)), first]
+                distances[indices[found_]] = d[found_, first[found_]]
+                found[start:stop] = found_
+
+            self._map(query, len(pending), k + 1)
+            pending = pending[~found]
+            if k == self.N - 1:
+                break
+            k = min(2 * k, self.N - 1)
+        return distances
+
+    def nearest_distinct(self):
+        """
+        Distance of each point to the nearest point at another position
+        """
+        return self._nearest_accepted(lambda d, neighbors, indices: d > 0)
+
+    def nearest_other(self, labels):
+        """
+        Distance of each point to the nearest point with another label
+        """
+        labels = _np.asarray(labels)
+
+        def accept(d, neighbors, indices):
+            neighbors = _np.minimum(neighbors, self.N - 1)
+            return labels[neighbors] != labels[indices, _np.newaxis]
+
+        return self._nearest_accepted(accept)
+
+
+def kneighbors(points, k=1):
+    """ Distances and indices of the k nearest other points of each point """
+    return Neighbors(points).kneighbors(k)
@@ -11,63 +11,151 @@
 import numpy as _np
 import numba as _numba
 
-from sklearn.cluster import DBSCAN as _DBSCAN
-
 from scipy import interpolate as _interpolate
 from scipy.special import iv as _iv
-from scipy.spatial import distance
-from scipy.spatial import ConvexHull
 
 from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
-import multiprocessing as _multiprocessing
-import matplotlib.pyplot as _plt
 import itertools as _itertools
-import lmfit as _lmfit
 from collections import OrderedDict as _OrderedDict
 from . import lib as _lib
+from . import grouping as _grouping
 from . import render as _render
 from . import imageprocess as _imageprocess
-from threading import Thread as _Thread
-import time as _time
-from tqdm import tqdm as _tqdm
 from numpy.lib.recfunctions import stack_arrays
+from tqdm import trange as _trange
+
+
+class IndexBlocks:
+    """
+    Spatial index of localizations in square blocks of a size (in
+    pixels). The locs are sorted by block, row by row, and
+    block_starts/block_ends delimit the locs of each block. Iterating
+    yields the tuple that get_index_blocks returned previously.
+    """
+
+    def __init__(self, locs, info, size, callback=None):
+        if callback is not None:
+            callback(0)
+        self.fingerprint = _lib.locs_fingerprint(locs, info)
+        locs = _lib.ensure_sanity(locs, info)
+        self.size = size
+        self.K, self.L = index_blocks_shape(info, size)
+        x_index = _np.minimum(_np.uint32(locs.x / size), self.L - 1)
+        y_index = _np.minimum(_np.uint32(locs.y / size), self.K - 1)
+        keys = _np.int64(y_index) * self.L + x_index
+        order = _np.argsort(keys, kind="stable")
+        keys = keys[order]
+        self.locs = locs[order]
+        self.x_index = x_index[order]
+        self.y_index = y_index[order]
+        bounds = _np.searchsorted(keys, _np.arange(self.K * self.L + 1))
+        bounds = _np.uint32(bounds)
+        self.block_starts = bounds[:-1].reshape(self.K, self.L)
+        self.block_ends = bounds[1:].reshape(self.K, self.L)
+        if callback is not None:
+            callback(self.K)
+
+    def __iter__(self):
+        return iter(
+            (
+                self.locs,
+                self.size,
+                self.x_index,
+                self.y_index,
+                self.block_starts,
+                self.block_ends,
+                self.K,
+                self.L,
+            )
+        )
+
+    def matches(self, locs, info, size):
+        """ Whether the index is of these locs and block size """
+        return (
+            size == self.size
+            and _lib.locs_fingerprint(locs, info) == self.fingerprint
+        )
+
+    def n_block_locs_at(self, x, y):
+        """ Number of locs in the 3x3 blocks around each point """
+        x = _np.atleast_1d(x).astype(_np.float64)
+        y = _np.atleast_1d(y).astype(_np.float64)
+        return _n_block_locs_at(
+            x,
+            y,
+            self.size,
+            self.block_starts,
+            self.block_ends,
+        )
+
+    def block_locs_at(self, x, y):
+        """ Locs in the 3x3 blocks around a point """
+        y_index = int(y / self.size)
+        x_index = int(x / self.size)
+        # The blocks of a row are contiguous
+        x_min = max(x_index - 1, 0)
+        x_max = min(x_index + 1, self.L - 1)
+        if x_min > x_max:
+            return self.locs[:0]
+        indices = [
+            _np.arange(self.block_starts[k, x_min], self.block_ends[k, x_max])
+            for k in range(max(y_index - 1, 0), min(y_index + 2, self.K))
+        ]
+        if len(indices) == 0:
+            return self.locs[:0]
+        return self.locs[_np.concatenate(indices)]
+
+    def indices_within(self, x, y, r):
+        """
+        The locs within r of each point, as the number per point and
+        the concatenated indices of the sorted locs
+        """
+        x = _np.atleast_1d(x).astype(_np.float64)
+        y = _np.atleast_1d(y).astype(_np.float64)
+        args = (
+            r,
+            self.locs.x,
+            self.locs.y,
+            self.size,
+            self.block_starts,
+            self.block_ends,
+        )
+        counts = _locs_within(x, y, *args, _np.zeros(0, dtype=_np.int64))
+        indices = _np.zeros(counts.sum(), dtype=_np.int64)
+        _locs_within(x, y, *args, indices)
+        return counts, indices
+
+    def locs_within(self, x, y, r):
+        """ List of the locs within r of each point """
+        counts, indices = self.indices_within(x, y, r)
+        return _np.split(self.locs[indices], _np.cumsum(counts)[:-1])
+
+    def n_locs_within(self, x, y, r):
+        """ Number of locs within r of each point, in a thread pool """
+        x = _np.atleast_1d(x).astype(_np.float64)
+        y = _np.atleast_1d(y).astype(_np.float64)
+        n_workers = _lib.n_workers()
+        chunks = _np.array_split(_np.arange(len(x)), 4 * n_workers)
+        with _ThreadPoolExecutor(n_workers) as executor:
+            counts = executor.map(
+                lambda _: _locs_within(
+                    x[_],
+                    y[_],
+                    r,
+                    self.locs.x,
+                    self.locs.y,
+                    self.size,
+                    self.block_starts,
+                    self.block_ends,
+                    _np.zeros(0, dtype=_np.int64),
+                ),
+                chunks,
+            )
+            return _np.concatenate(list(counts))
 
 
 def get_index_blocks(locs, info, size, callback=None):
-    locs = _lib.ensure_sanity(locs, info)
-    # Sort locs by indices
-    x_index = _np.uint32(locs.x / size)
-    y_index = _np.uint32(locs.y / size)
-    sort_indices = _np.lexsort([x_index, y_index])
-    locs = locs[sort_indices]
-    x_index = x_index[sort_indices]
-    y_index = y_index[sort_indices]
-    # Allocate block info arrays
-    n_blocks_y, n_blocks_x = index_blocks_shape(info, size)
-    block_starts = _np.zeros((n_blocks_y, n_blocks_x), dtype=_np.uint32)
-    block_ends = _np.zeros((n_blocks_y, n_blocks_x), dtype=_np.uint32)
-    K, L = block_starts.shape
-    # Fill in block starts and ends
-    # We are running this in a thread with a nogil numba function.
-    # This helps updating a potential GUI with the callback.
-    if callback is not None:
-        callback(0)
-        counter = [0]
-    else:
-        counter = None
-    thread = _Thread(
-        target=_fill_index_blocks,
-        args=(block_starts, block_ends, x_index, y_index, counter),
-    )
-    thread.start()
-    if callback is not None:
-        while counter[0] < K:
-            callback(counter[0])
-            _time.sleep(0.1)
-    thread.join()
-    if callback is not None:
-        callback(counter[0])
-    return locs, size, x_index, y_index, block_starts, block_ends, K, L
+    return IndexBlocks(locs, info, size, callback)
 
 
 def index_blocks_shape(info, size):
@@ -77,129 +165,119 @@ def index_blocks_shape(info, size):
     return n_blocks_y, n_blocks_x
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def n_block_locs_at(x, y, size, K, L, block_starts, block_ends):
-    x_index = _np.uint32(x / size)
-    y_index = _np.uint32(y / size)
+    x_index = int(x / size)
+    y_index = int(y / size)
     n_block_locs = 0
-    for k in range(y_index - 1, y_index + 2):
-        if 0 < k < K:
-            for l in range(x_index - 1, x_index + 2):
-                if 0 < l < L:
-                    n_block_locs += block_ends[k, l] - block_starts[k, l]
+    for ky in range(max(y_index - 1, 0), min(y_index + 2, K)):
+        for kx in range(max(x_index - 1, 0), min(x_index + 2, L)):
+            n_block_locs += block_ends[ky, kx] - block_starts[ky, kx]
     return n_block_locs
 
 
-def get_block_locs_at(x, y, index_blocks):
-    locs, size, x_index, y_index, block_starts, block_ends, K, L = index_blocks
-    x_index = _np.uint32(x / size)  # is this really necessary?
-    y_index = _np.uint32(y / size)  # is this really necessary?
-    indices = []
-    for k in range(y_index - 1, y_index + 2):
-        if 0 < k < K:
-            for l in range(x_index - 1, x_index + 2):
-                if 0 < l < L:
-                    indices.append(
-                        list(range(block_starts[k, l], block_ends[k, l]))
-                    )
-    indices = list(_itertools.chain(*indices))
-    return locs[indices]
-
-
-def _fill_index_blocks(
-    block_starts, block_ends, x_index, y_index, counter=None
-):
-    Y, X = block_starts.shape
-    N = len(x_index)
-    k = 0
-    if counter is not None:
-        counter[0] = 0
-    for i in range(Y):
-        for j in range(X):
-            k = _fill_index_block(
-                block_starts, block_ends, N, x_index, y_index, i, j, k
-            )
-        if counter is not None:
-            counter[0] = i + 1
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _n_block_locs_at(x, y, size, block_starts, block_ends):
+    K, L = block_starts.shape
+    n_block_locs = _np.zeros(len(x), dtype=_np.int64)
+    for i in range(len(x)):
+        n_block_locs[i] = n_block_locs_at(
+            x[i], y[i], size, K, L, block_starts, block_ends
+        )
+    return n_block_locs
 
 
-@_numba.jit(nopython=True, nogil=True)
-def _fill_index_block(block_starts, block_ends, N, x_index, y_index, i, j, k):
-    block_starts[i, j] = k
-    while k < N and y_index[k] == i and x_index[k] == j:
-        k += 1
-    block_ends[i, j] = k
-    return k
+def get_block_locs_at(x, y, index_blocks):
+    return index_blocks.block_locs_at(x, y)
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _locs_within(qx, qy, r, x, y, size, block_starts, block_ends, indices):
+    """
+    Counts the locs within r of each query point. If indices has the size
+    of the total count, the loc indices are filled in, query by query.
+    """
+    K, L = block_starts.shape
+    reach = int(_np.ceil(r / size))
+    r2 = r ** 2
+    fill = len(indices) > 0
+    counts = _np.zeros(len(qx), dtype=_np.int64)
+    n = 0
+    for i in range(len(qx)):
+        y_index = int(_np.floor(qy[i] / size))
+        x_index = int(_np.floor(qx[i] / size))
+        for ky in range(max(y_index - reach, 0), min(y_index + reach + 1, K)):
+            for kx in range(
+                max(x_index - reach, 0), min(x_index + reach + 1, L)
+            ):
+                for j in range(block_starts[ky, kx], block_ends[ky, kx]):
+                    if (x[j] - qx[i]) ** 2 + (y[j] - qy[i]) ** 2 < r2:
+                        if fill:
+                            indices[n] = j
+                        n += 1
+                        counts[i] += 1
+    return counts
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _distance_histogram(
-    locs,
-    bin_size,
-    r_max,
-    x_index,
-    y_index,
-    block_starts,
-    block_ends,
-    start,
-    chunk,
+    x, y, bin_size, r_max, x_index, y_index, block_starts, block_ends, indices
 ):
-    x = locs.x
-    y = locs.y
     dh_len = _np.uint32(r_max / bin_size)
     dh = _np.zeros(dh_len, dtype=_np.uint32)
     r_max_2 = r_max ** 2
     K, L = block_starts.shape
-    end = min(start + chunk, len(locs))
-    for i in range(start, end):
+    for i in indices:
         xi = x[i]
         yi = y[i]
         ki = y_index[i]
         li = x_index[i]
-        for k in range(ki, ki + 2):
-            if k < K:
-                for l in range(li, li + 2):
-                    if l < L:
-                        for j in range(block_starts[k, l], block_ends[k, l]):
-                            if j > i:
-                                dx2 = (xi - x[j]) ** 2
-                                if dx2 < r_max_2:
-                                    dy2 = (yi - y[j]) ** 2
-                                    if dy2 < r_max_2:
-                                        d = _np.sqrt(dx2 + dy2)
-                                        if d < r_max:
-                                            bin = _np.uint32(d / bin_size)
-                                            if bin < dh_len:
-                                                dh[bin] += 1
+        for ky in range(max(ki - 1, 0), min(ki + 2, K)):
+            for kx in range(max(li - 1, 0), min(li + 2, L)):
+                # Each pair once
+                j_min = max(block_starts[ky, kx], i + 1)
+                for j in range(j_min, block_ends[ky, kx]):
+                    dx2 = (xi - x[j]) ** 2
+                    if dx2 < r_max_2:
+                        dy2 = (yi - y[j]) ** 2
+                        if dy2 < r_max_2:
+                            d = _np.sqrt(dx2 + dy2)
+                            if d < r_max:
+                                bin = _np.uint32(d / bin_size)
+                                if bin < dh_len:
+                                    dh[bin] += 1
     return dh
 
 
-def distance_histogram(locs, info, bin_size, r_max):
-    locs, size, x_index, y_index, b_starts, b_ends, K, L = get_index_blocks(
-        locs, info, r_max
-    )
-    N = len(locs)
-    n_threads = _multiprocessing.cpu_count()
-    chunk = int(N / n_threads)
-    starts = range(0, N, chunk)
-    args = [
-        (
-            locs,
-            bin_size,
-            r_max,
-            x_index,
-            y_index,
-            b_starts,
-            b_ends,
-            start,
-            chunk,
-        )
-        for start in starts
+def distance_histogram(locs, info, bin_size, r_max, index_blocks=None):
+    """
+    Histogram of the distances of all pairs of locs up to r_max. An index
+    with blocks of at least r_max can be given.
+    """
+    if index_blocks is None or index_blocks.size < r_max:
+        index_blocks = IndexBlocks(locs, info, r_max)
+    n_workers = _lib.n_workers()
+    # Interleaved, as the first locs have the most pairs
+    chunks = [
+        _np.arange(_, len(index_blocks.locs), 4 * n_workers)
+        for _ in range(4 * n_workers)
     ]
-    with _ThreadPoolExecutor() as executor:
-        futures = [executor.submit(_distance_histogram, *_) for _ in args]
-    results = [future.result() for future in futures]
-    return _np.sum(results, axis=0)
+    with _ThreadPoolExecutor(n_workers) as executor:
+        results = executor.map(
+            lambda _: _distance_histogram(
+                index_blocks.locs.x,
+                index_blocks.locs.y,
+                bin_size,
+                r_max,
+                index_blocks.x_index,
+                index_blocks.y_index,
+                index_blocks.block_starts,
+                index_blocks.block_ends,
+                _,
+            ),
+            chunks,
+        )
+        return _np.sum(list(results), axis=0)
 
 
 def nena(locs, info, callback=None):
@@ -215,8 +293,10 @@ def nena(locs, info, callback=None):
         )
         return f + fc
 
-    pdf_model = _lmfit.Model(func)
-    params = _lmfit.Parameters()
+    import lmfit
+
+    pdf_model = lmfit.Model(func)
+    params = lmfit.Parameters()
     area = _np.trapz(dnfl_, bin_centers)
     median_lp = _np.mean([_np.median(locs.lpx), _np.median(locs.lpy)])
     params.add("a", value=area / 2, min=0)
@@ -257,7 +337,7 @@ def _nfndh(frame, x, y, group, d_max, bin_size, callback=None):
     return bin_centers, dnfl
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _fill_dnfl(N, frame, x, y, group, i, d_max, dnfl, bin_size):
     frame_i = frame[i]
     x_i = x[i]
@@ -284,8 +364,12 @@ def _fill_dnfl(N, frame, x, y, group, i, d_max, dnfl, bin_size):
                         dnfl[bin] += 1
 
 
-def pair_correlation(locs, info, bin_size, r_max):
-    dh = distance_histogram(locs, info, bin_size, r_max)
+def pair_correlation(locs, info, bin_size, r_max, index_blocks=None):
+    """
+    Pair correlation of the locs up to r_max. An index of the locs with
+    blocks of at least r_max can be given, see distance_histogram.
+    """
+    dh = distance_histogram(locs, info, bin_size, r_max, index_blocks)
     # Start with r-> otherwise area will be 0
     bins_lower = _np.arange(bin_size, r_max + bin_size, bin_size)
 
@@ -295,64 +379,318 @@ def pair_correlation(locs, info, bin_size, r_max):
     return bins_lower, dh / area
 
 
-def dbscan(locs, radius, min_density):
+def dbscan(locs, radius, min_density, pixelsize=None):
+    """
+    Clusters locs with DBSCAN (see _dbscan). 3D locs need the pixelsize
+    (nm/px) to scale z to pixels.
+    """
     print("Identifying clusters...")
     if hasattr(locs, "z"):
         print("z-coordinates detected")
-        pixelsize = int(input("Enter the pixelsize in nm/px:"))
+        if pixelsize is None:
+            raise ValueError("3D clustering needs the pixelsize in nm/px.")
         locs = locs[
             _np.isfinite(locs.x) & _np.isfinite(locs.y) & _np.isfinite(locs.z)
         ]
         X = _np.vstack((locs.x, locs.y, locs.z / pixelsize)).T
-        db = _DBSCAN(eps=radius, min_samples=min_density).fit(X)
-        group = _np.int32(db.labels_)  # int32 for Origin compatiblity
-        locs = _lib.append_to_rec(locs, group, "group")
-        locs = locs[locs.group != -1]
-        print("Generating cluster information...")
-        groups = _np.unique(locs.group)
-        n_groups = len(groups)
-        mean_frame = _np.zeros(n_groups)
-        std_frame = _np.zeros(n_groups)
-        com_x = _np.zeros(n_groups)
-        com_y = _np.zeros(n_groups)
-        com_z = _np.zeros(n_groups)
-        std_x = _np.zeros(n_groups)
-        std_y = _np.zeros(n_groups)
-        std_z = _np.zeros(n_groups)
-        convex_hull = _np.zeros(n_groups)
-        volume = _np.zeros(n_groups)
-        n = _np.zeros(n_groups, dtype=_np.int32)
-        for i, group in enumerate(groups):
-            group_locs = locs[locs.group == i]
-            mean_frame[i] = _np.mean(group_locs.frame)
-            com_x[i] = _np.mean(group_locs.x)
-            com_y[i] = _np.mean(group_locs.y)
-            com_z[i] = _np.mean(group_locs.z)
-            std_frame[i] = _np.std(group_locs.frame)
-            std_x[i] = _np.std(group_locs.x)
-            std_y[i] = _np.std(group_locs.y)
-            std_z[i] = _np.std(group_locs.z)
-            n[i] = len(group_locs)
-            X_group = _np.stack(
-                [group_locs.x, group_locs.y, group_locs.z / pixelsize], axis=0
-            ).T
-            volume[i] = (
-                _np.power(
-                    (std_x[i] + std_y[i] + (std_z[i] / pixelsize)) / 3 * 2, 3
-                )
-                * _np.pi
-                * 4
-                / 3
-            )
-            try:
-                hull = ConvexHull(X_group)
-                convex_hull[i] = hull.volume
-            except Exception as e:
-                print(e)
-                convex_hull[i] = 0
-        clusters = _np.rec.array(
+    else:
+        pixelsize = None
+        locs = locs[_np.isfinite(locs.x) & _np.isfinite(locs.y)]
+        X = _np.vstack((locs.x, locs.y)).T
+    group = _dbscan(X, radius, min_density)  # int32 for Origin compatiblity
+    locs = _lib.append_to_rec(locs, group, "group")
+    locs = locs[locs.group != -1]
+    print("Generating cluster information...")
+    clusters = _cluster_props(locs, pixelsize)
+    return clusters, locs
+
+
+def _dbscan(X, eps, min_samples):
+    """
+    DBSCAN labels of the points X (N, dimensions), as in scikit-learn: a
+    point is core if at least min_samples points (itself included) are
+    within eps, clusters are numbered in the order of their first core
+    point, border points join the first cluster that reaches them, and
+    noise is -1.
+    The points are binned in cells of side eps / sqrt(dimensions), such
+    that the points of a cell are all neighbors: cells with min_samples
+    points only hold core points, and the core points of a cell form one
+    cluster. Core points are found in parallel, and the clusters of
+    neighboring cells are merged by union-find.
+    """
+    N, n_dims = X.shape
+    labels = _np.full(N, -1, dtype=_np.int32)
+    if N == 0:
+        return labels
+    side = eps / _np.sqrt(n_dims)
+    X_min = X.min(axis=0)
+    cells = _np.int64(_np.floor((X - X_min) / side))
+    shape = cells.max(axis=0) + 1
+    strides = _np.append(_np.cumprod(shape[::-1])[-2::-1], 1)
+    keys = cells @ strides
+    order = _np.argsort(keys, kind="stable")
+    keys = keys[order]
+    X = _np.ascontiguousarray(X[order])
+    starts = _np.flatnonzero(_np.diff(keys)) + 1
+    starts = _np.insert(starts, 0, 0)
+    ends = _np.append(starts[1:], N)
+    cell_keys = keys[starts]
+    cell_coords = cells[order[starts]]
+    del cells, keys
+    # Offsets of the cells that can hold points within eps, forward ones
+    # (larger keys) separately
+    reach = int(_np.ceil(_np.sqrt(n_dims)))
+    offsets = _np.array(
+        list(_itertools.product(range(-reach, reach + 1), repeat=n_dims))
+    )
+    gaps = _np.maximum(_np.abs(offsets) - 1, 0)
+    offsets = offsets[(gaps ** 2).sum(axis=1) < n_dims]
+    forward = offsets[offsets @ strides > 0]
+    grid = (cell_keys, cell_coords, shape, strides)
+    eps2 = eps ** 2
+
+    n_workers = _lib.n_workers()
+    # Tasks of consecutive cells with about the same number of points
+    n_tasks = max(4 * n_workers, len(starts) // 2 ** 14)
+    bounds = _np.unique(
+        _np.searchsorted(starts, _np.linspace(0, N, n_tasks + 1))
+    )
+    tasks = list(zip(bounds[:-1], bounds[1:]))
+    core = _np.zeros(N, dtype=_np.bool_)
+    with _ThreadPoolExecutor(n_workers) as executor:
+        for _ in executor.map(
+            lambda _: _dbscan_core(
+                X, starts, ends, grid, offsets, eps2, min_samples, core, *_
+            ),
+            tasks,
+        ):
+            pass
+        cell_core = _np.logical_or.reduceat(core, starts)
+        parent = _np.arange(len(starts))
+        for edges in executor.map(
+            lambda _: _dbscan_edges(
+                X, starts, ends, grid, forward, eps2, core, cell_core, *_
+            ),
+            tasks,
+        ):
+            _union_cells(parent, edges)
+        root = _root_cells(parent)
+        # Number the clusters by their first core point
+        first = _first_core(root, starts, ends, core, order)
+        cluster_roots = _np.flatnonzero(first < N)
+        cluster_roots = cluster_roots[_np.argsort(first[cluster_roots])]
+        cell_labels = _np.full(len(starts), -1, dtype=_np.int32)
+        cell_labels[cluster_roots] = _np.arange(len(cluster_roots))
+        cell_labels = cell_labels[root]
+        sorted_labels = _np.full(N, -1, dtype=_np.int32)
+        for _ in executor.map(
+            lambda _: _dbscan_labels(
+                X,
+                starts,
+                ends,
+                grid,
+                offsets,
+                eps2,
+                core,
+                cell_core,
+                cell_labels,
+                sorted_labels,
+                *_,
+            ),
+            tasks,
+        ):
+            pass
+    labels[order] = sorted_labels
+    return labels
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _neighbor_cell(grid, c, offset):
+    """ Index of the cell at an offset from cell c, or -1 if it is empty """
+    cell_keys, cell_coords, shape, strides = grid
+    key = 0
+    for d in range(len(shape)):
+        coord = cell_coords[c, d] + offset[d]
+        if coord < 0 or coord >= shape[d]:
+            return -1
+        key += coord * strides[d]
+    i = _np.searchsorted(cell_keys, key)
+    if i < len(cell_keys) and cell_keys[i] == key:
+        return i
+    return -1
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _neighbor_cells(grid, c, offsets):
+    neighbors = _np.empty(len(offsets), dtype=_np.int64)
+    n = 0
+    for k in range(len(offsets)):
+        neighbor = _neighbor_cell(grid, c, offsets[k])
+        if neighbor != -1:
+            neighbors[n] = neighbor
+            n += 1
+    return neighbors[:n]
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _is_within(X, i, j, eps2):
+    d2 = 0.0
+    for d in range(X.shape[1]):
+        d2 += (_np.float64(X[i, d]) - _np.float64(X[j, d])) ** 2
+    return d2 <= eps2
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _dbscan_core(
+    X, starts, ends, grid, offsets, eps2, min_samples, core, c_start, c_end
+):
+    for c in range(c_start, c_end):
+        if ends[c] - starts[c] >= min_samples:
+            core[starts[c]: ends[c]] = True
+            continue
+        neighbors = _neighbor_cells(grid, c, offsets)
+        for i in range(starts[c], ends[c]):
+            n = 0
+            for neighbor in neighbors:
+                for j in range(starts[neighbor], ends[neighbor]):
+                    if _is_within(X, i, j, eps2):
+                        n += 1
+                if n >= min_samples:
+                    core[i] = True
+                    break
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _cells_connected(X, starts, ends, core, eps2, a, b):
+    """ Whether any core points of cells a and b are within eps """
+    for i in range(starts[a], ends[a]):
+        if core[i]:
+            for j in range(starts[b], ends[b]):
+                if core[j] and _is_within(X, i, j, eps2):
+                    return True
+    return False
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _dbscan_edges(
+    X, starts, ends, grid, forward, eps2, core, cell_core, c_start, c_end
+):
+    """ Pairs of cells whose core points are in the same cluster """
+    edges = _np.empty(((c_end - c_start) * len(forward), 2), dtype=_np.int64)
+    n = 0
+    for c in range(c_start, c_end):
+        if cell_core[c]:
+            for neighbor in _neighbor_cells(grid, c, forward):
+                if cell_core[neighbor] and _cells_connected(
+                    X, starts, ends, core, eps2, c, neighbor
+                ):
+                    edges[n, 0] = c
+                    edges[n, 1] = neighbor
+                    n += 1
+    return edges[:n]
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _find_root(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _union_cells(parent, edges):
+    for k in range(len(edges)):
+        a = _find_root(parent, edges[k, 0])
+        b = _find_root(parent, edges[k, 1])
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _root_cells(parent):
+    root = _np.empty(len(parent), dtype=_np.int64)
+    for i in range(len(parent)):
+        root[i] = _find_root(parent, i)
+    return root
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _first_core(root, starts, ends, core, order):
+    """ The smallest original index of the core points of each root """
+    first = _np.full(len(root), len(order), dtype=_np.int64)
+    for c in range(len(root)):
+        for i in range(starts[c], ends[c]):
+            if core[i] and order[i] < first[root[c]]:
+                first[root[c]] = order[i]
+    return first
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _dbscan_labels(
+    X,
+    starts,
+    ends,
+    grid,
+    offsets,
+    eps2,
+    core,
+    cell_core,
+    cell_labels,
+    labels,
+    c_start,
+    c_end,
+):
+    """
+    Labels of the points of cells: that of their cell for core points,
+    the smallest label of the core points within eps for border points
+    """
+    for c in range(c_start, c_end):
+        neighbors = _neighbor_cells(grid, c, offsets)
+        for i in range(starts[c], ends[c]):
+            if core[i]:
+                labels[i] = cell_labels[c]
+                continue
+            for neighbor in neighbors:
+                label = cell_labels[neighbor]
+                if not cell_core[neighbor] or (
+                    labels[i] != -1 and label >= labels[i]
+                ):
+                    continue
+                for j in range(starts[neighbor], ends[neighbor]):
+                    if core[j] and _is_within(X, i, j, eps2):
+                        labels[i] = label
+                        break
+
+
+def _cluster_props(locs, pixelsize=None):
+    """
+    Properties of the clusters given by locs.group; 3D if a pixelsize for
+    the z coordinates is given
+    """
+    groups = _grouping.Groups(locs.group)
+    group_ids = groups.ids[0]
+    mean_frame = groups.mean(locs.frame)
+    std_frame = groups.std(locs.frame)
+    com_x = groups.mean(locs.x)
+    com_y = groups.mean(locs.y)
+    std_x = groups.std(locs.x)
+    std_y = groups.std(locs.y)
+    n = groups.count()
+    if pixelsize is not None:
+        com_z = groups.mean(locs.z)
+        std_z = groups.std(locs.z)
+        X = _np.stack([locs.x, locs.y, locs.z / pixelsize], axis=1)
+        convex_hull = groups.convex_hull(X)
+        volume = (
+            _np.power((std_x + std_y + (std_z / pixelsize)) / 3 * 2, 3)
+            * _np.pi
+            * 4
+            / 3
+        )
+        return _np.rec.array(
             (
-                groups,
+                group_ids,
                 convex_hull,
                 volume,
                 mean_frame,
@@ -366,7 +704,7 @@ def dbscan(locs, radius, min_density):
                 n,
             ),
             dtype=[
-                ("groups", groups.dtype),
+                ("groups", group_ids.dtype),
                 ("convex_hull", "f4"),
                 ("volume", "f4"),
                 ("mean_frame", "f4"),
@@ -381,44 +719,12 @@ def dbscan(locs, radius, min_density):
             ],
         )
     else:
-        locs = locs[_np.isfinite(locs.x) & _np.isfinite(locs.y)]
-        X = _np.vstack((locs.x, locs.y)).T
-        db = _DBSCAN(eps=radius, min_samples=min_density).fit(X)
-        group = _np.int32(db.labels_)  # int32 for Origin compatiblity
-        locs = _lib.append_to_rec(locs, group, "group")
-        locs = locs[locs.group != -1]
-        print("Generating cluster information...")
-        groups = _np.unique(locs.group)
-        n_groups = len(groups)
-        mean_frame = _np.zeros(n_groups)
-        std_frame = _np.zeros(n_groups)
-        com_x = _np.zeros(n_groups)
-        com_y = _np.zeros(n_groups)
-        std_x = _np.zeros(n_groups)
-        std_y = _np.zeros(n_groups)
-        convex_hull = _np.zeros(n_groups)
-        area = _np.zeros(n_groups)
-        n = _np.zeros(n_groups, dtype=_np.int32)
-        for i, group in enumerate(groups):
-            group_locs = locs[locs.group == i]
-            mean_frame[i] = _np.mean(group_locs.frame)
-            com_x[i] = _np.mean(group_locs.x)
-            com_y[i] = _np.mean(group_locs.y)
-            std_frame[i] = _np.std(group_locs.frame)
-            std_x[i] = _np.std(group_locs.x)
-            std_y[i] = _np.std(group_locs.y)
-            n[i] = len(group_locs)
-            X_group = _np.stack([group_locs.x, group_locs.y], axis=0).T
-            area[i] = _np.power((std_x[i] + std_y[i]), 2) * _np.pi
-            try:
-                hull = ConvexHull(X_group)
-                convex_hull[i] = hull.volume
-            except Exception as e:
-                print(e)
-                convex_hull[i] = 0
-        clusters = _np.rec.array(
+        X = _np.stack([locs.x, locs.y], axis=1)
+        convex_hull = groups.convex_hull(X)
+        area = _np.power((std_x + std_y), 2) * _np.pi
+        return _np.rec.array(
             (
-                groups,
+                group_ids,
                 convex_hull,
                 area,
                 mean_frame,
@@ -430,7 +736,7 @@ def dbscan(locs, radius, min_density):
                 n,
             ),
             dtype=[
-                ("groups", groups.dtype),
+                ("groups", group_ids.dtype),
                 ("convex_hull", "f4"),
                 ("area", "f4"),
                 ("mean_frame", "f4"),
@@ -442,7 +748,7 @@ def dbscan(locs, radius, min_density):
                 ("n", "i4"),
             ],
         )
-    return clusters, locs
+
 
 def hdbscan(locs, min_cluster_size, min_samples):
 
@@ -456,208 +762,32 @@ def hdbscan(locs, min_cluster_size, min_samples):
             _np.isfinite(locs.x) & _np.isfinite(locs.y) & _np.isfinite(locs.z)
         ]
         X = _np.vstack((locs.x, locs.y, locs.z / pixelsize)).T
-        hdb = _HDBSCAN(
-            min_samples=min_samples, min_cluster_size=min_cluster_size
-        ).fit(X)
-        group = _np.int32(hdb.labels_)  # int32 for Origin compatiblity
-        locs = _lib.append_to_rec(locs, group, "group")
-        locs = locs[locs.group != -1]
-        print("Generating cluster information...")
-        groups = _np.unique(locs.group)
-        n_groups = len(groups)
-        mean_frame = _np.zeros(n_groups)
-        std_frame = _np.zeros(n_groups)
-        com_x = _np.zeros(n_groups)
-        com_y = _np.zeros(n_groups)
-        com_z = _np.zeros(n_groups)
-        std_x = _np.zeros(n_groups)
-        std_y = _np.zeros(n_groups)
-        std_z = _np.zeros(n_groups)
-        convex_hull = _np.zeros(n_groups)
-        volume = _np.zeros(n_groups)
-        n = _np.zeros(n_groups, dtype=_np.int32)
-        for i, group in enumerate(groups):
-            group_locs = locs[locs.group == i]
-            mean_frame[i] = _np.mean(group_locs.frame)
-            com_x[i] = _np.mean(group_locs.x)
-            com_y[i] = _np.mean(group_locs.y)
-            com_z[i] = _np.mean(group_locs.z)
-            std_frame[i] = _np.std(group_locs.frame)
-            std_x[i] = _np.std(group_locs.x)
-            std_y[i] = _np.std(group_locs.y)
-            std_z[i] = _np.std(group_locs.z)
-            n[i] = len(group_locs)
-            X_group = _np.stack(
-                [group_locs.x, group_locs.y, group_locs.z / pixelsize], axis=0
-            ).T
-            volume[i] = (
-                _np.power(
-                    (std_x[i] + std_y[i] + (std_z[i] / pixelsize)) / 3 * 2, 3
-                )
-                * _np.pi
-                * 4
-                / 3
-            )
-            try:
-                hull = ConvexHull(X_group)
-                convex_hull[i] = hull.volume
-            except Exception as e:
-                print(e)
-                convex_hull[i] = 0
-        clusters = _np.rec.array(
-            (
-                groups,
-                convex_hull,
-                volume,
-                mean_frame,
-                com_x,
-                com_y,
-                com_z,
-                std_frame,
-                std_x,
-                std_y,
-                std_z,
-                n,
-            ),
-            dtype=[
-                ("groups", groups.dtype),
-                ("convex_hull", "f4"),
-                ("volume", "f4"),
-                ("mean_frame", "f4"),
-                ("com_x", "f4"),
-                ("com_y", "f4"),
-                ("com_z", "f4"),
-                ("std_frame", "f4"),
-                ("std_x", "f4"),
-                ("std_y", "f4"),
-                ("std_z", "f4"),
-                ("n", "i4"),
-            ],
-        )
     else:
+        pixelsize = None
         locs = locs[_np.isfinite(locs.x) & _np.isfinite(locs.y)]
         X = _np.vstack((locs.x, locs.y)).T
-        hdb = _HDBSCAN(
-            min_samples=min_samples, min_cluster_size=min_cluster_size
-        ).fit(X)
-        group = _np.int32(hdb.labels_)  # int32 for Origin compatiblity
-        locs = _lib.append_to_rec(locs, group, "group")
-        locs = locs[locs.group != -1]
-        print("Generating cluster information...")
-        groups = _np.unique(locs.group)
-        n_groups = len(groups)
-        mean_frame = _np.zeros(n_groups)
-        std_frame = _np.zeros(n_groups)
-        com_x = _np.zeros(n_groups)
-        com_y = _np.zeros(n_groups)
-        std_x = _np.zeros(n_groups)
-        std_y = _np.zeros(n_groups)
-        convex_hull = _np.zeros(n_groups)
-        area = _np.zeros(n_groups)
-        n = _np.zeros(n_groups, dtype=_np.int32)
-        for i, group in enumerate(groups):
-            group_locs = locs[locs.group == i]
-            mean_frame[i] = _np.mean(group_locs.frame)
-            com_x[i] = _np.mean(group_locs.x)
-            com_y[i] = _np.mean(group_locs.y)
-            std_frame[i] = _np.std(group_locs.frame)
-            std_x[i] = _np.std(group_locs.x)
-            std_y[i] = _np.std(group_locs.y)
-            n[i] = len(group_locs)
-            X_group = _np.stack([group_locs.x, group_locs.y], axis=0).T
-            area[i] = _np.power((std_x[i] + std_y[i]), 2) * _np.pi
-            try:
-                hull = ConvexHull(X_group)
-                convex_hull[i] = hull.volume
-            except Exception as e:
-                print(e)
-                convex_hull[i] = 0
-        clusters = _np.rec.array(
-            (
-                groups,
-                convex_hull,
-                area,
-                mean_frame,
-                com_x,
-                com_y,
-                std_frame,
-                std_x,
-                std_y,
-                n,
-            ),
-            dtype=[
-                ("groups", groups.dtype),
-                ("convex_hull", "f4"),
-                ("area", "f4"),
-                ("mean_frame", "f4"),
-                ("com_x", "f4"),
-                ("com_y", "f4"),
-                ("std_frame", "f4"),
-                ("std_x", "f4"),
-                ("std_y", "f4"),
-                ("n", "i4"),
-            ],
-        )
+    hdb = _HDBSCAN(
+        min_samples=min_samples, min_cluster_size=min_cluster_size
+    ).fit(X)
+    group = _np.int32(hdb.labels_)  # int32 for Origin compatiblity
+    locs = _lib.append_to_rec(locs, group, "group")
+    locs = locs[locs.group != -1]
+    print("Generating cluster information...")
+    clusters = _cluster_props(locs, pixelsize)
     return clusters, locs
 
-@_numba.jit(nopython=True, nogil=True)
-def _local_density(
-    locs, radius, x_index, y_index, block_starts, block_ends, start, chunk
-):
-    x = locs.x
-    y = locs.y
-    N = len(x)
-    r2 = radius ** 2
-    end = min(start + chunk, N)
-    density = _np.zeros(N, dtype=_np.uint32)
-    for i in range(start, end):
-        yi = y[i]
-        xi = x[i]
-        ki = y_index[i]
-        li = x_index[i]
-        di = 0
-        for k in range(ki - 1, ki + 2):
-            for l in range(li - 1, li + 2):
-                j_min = block_starts[k, l]
-                j_max = block_ends[k, l]
-                for j in range(j_min, j_max):
-                    dx2 = (xi - x[j]) ** 2
-                    if dx2 < r2:
-                        dy2 = (yi - y[j]) ** 2
-                        if dy2 < r2:
-                            d2 = dx2 + dy2
-                            if d2 < r2:
-                                di += 1
-        density[i] = di
-    return density
-
 
-def compute_local_density(locs, info, radius):
-    locs, x_index, y_index, block_starts, block_ends = get_index_blocks(
-        locs, info, radius
-    )
-    N = len(locs)
-    n_threads = _multiprocessing.cpu_count()
-    chunk = int(N / n_threads)
-    starts = range(0, N, chunk)
-    args = [
-        (
-            locs,
-            radius,
-            x_index,
-            y_index,
-            block_starts,
-            block_ends,
-            start,
-            chunk,
-        )
-        for start in starts
-    ]
-    with _ThreadPoolExecutor() as executor:
-        futures = [executor.submit(_local_density, *_) for _ in args]
-    density = _np.sum([future.result() for future in futures], axis=0)
+def compute_local_density(locs, info, radius, index_blocks=None):
+    """
+    Appends the number of locs within radius of each loc (including
+    itself). The locs are sorted and sanitized by the index.
+    """
+    if index_blocks is None:
+        index_blocks = IndexBlocks(locs, info, radius)
+    locs = index_blocks.locs
+    density = index_blocks.n_locs_within(locs.x, locs.y, radius)
     locs = _lib.remove_from_rec(locs, "density")
-    return _lib.append_to_rec(locs, density, "density")
+    return _lib.append_to_rec(locs, _np.uint32(density), "density")
 
 
 def compute_dark_times(locs, group=None):
@@ -678,23 +808,58 @@ def dark_times(locs, group=None):
     return dark
 
 
-@_numba.jit(nopython=True)
 def _dark_times(locs, group, last_frame):
+    """
+    The dark time of a loc is the number of frames since the latest
+    preceding event of its group ends, or -1 if there is none. Groups are
+    processed in parallel.
+    """
     N = len(locs)
-    max_frame = locs.frame.max()
-    dark = max_frame * _np.ones(len(locs), dtype=_np.int32)
-    for i in range(N):
-        for j in range(N):
-            if (group[i] == group[j]) and (i != j):
-                dark_ij = locs.frame[i] - last_frame[j]
-                if (dark_ij > 0) and (dark_ij < dark[i]):
-                    dark[i] = dark_ij
-    for i in range(N):
-        if dark[i] == max_frame:
-            dark[i] = -1
+    frame = locs.frame.astype(_np.int64)
+    last_frame = last_frame.astype(_np.int64)
+    max_frame = frame.max()
+    # Locs sorted by group and last frame
+    by_group = _np.lexsort((last_frame, group))
+    bounds = _np.flatnonzero(_np.diff(group[by_group])) + 1
+    bounds = _np.concatenate(([0], bounds, [N]))
+    dark = _np.empty(N, dtype=_np.int32)
+    n_workers = _lib.n_workers()
+    n_groups = len(bounds) - 1
+    n_tasks = min(n_groups, 4 * n_workers)
+    task_bounds = _np.linspace(0, n_groups, n_tasks + 1).astype(_np.int64)
+    with _ThreadPoolExecutor(n_workers) as executor:
+        for f in [
+            executor.submit(
+                _dark_times_groups,
+                by_group,
+                bounds[first: last + 1],
+                frame,
+                last_frame,
+                max_frame,
+                dark,
+            )
+            for first, last in zip(task_bounds[:-1], task_bounds[1:])
+        ]:
+            f.result()
     return dark
 
 
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _dark_times_groups(by_group, bounds, frame, last_frame, max_frame, dark):
+    """ by_group[bounds[k]:bounds[k + 1]] are the locs of a group """
+    for k in range(len(bounds) - 1):
+        indices = by_group[bounds[k]: bounds[k + 1]]
+        sorted_last_frame = last_frame[indices]
+        for i in indices:
+            # Latest event of the group that ends before the loc starts
+            j = _np.searchsorted(sorted_last_frame, frame[i]) - 1
+            if j < 0:
+                dark[i] = -1
+            else:
+                dark_i = frame[i] - sorted_last_frame[j]
+                dark[i] = dark_i if dark_i < max_frame else -1
+
+
 def link(
     locs,
     info,
@@ -768,356 +933,239 @@ def weighted_variance(locs):
 # Combine localizations: calculate the properties of the group
 def cluster_combine(locs):
     print("Combining localizations...")
-    combined_locs = []
-    if hasattr(locs[0], "z"):
+    clusters = _grouping.Groups(locs.group, locs.cluster)
+    group_id, cluster = clusters.ids
+    n = clusters.count()
+    columns = [
+        ("group", group_id, group_id.dtype),
+        ("cluster", cluster, cluster.dtype),
+        ("mean_frame", clusters.mean(locs.frame), "f4"),
+        ("x", clusters.weighted_mean(locs.x, locs.photons), "f4"),
+        ("y", clusters.weighted_mean(locs.y, locs.photons), "f4"),
+    ]
+    if hasattr(locs, "z"):
         print("z-mode")
-        for group in _tqdm(_np.unique(locs["group"])):
-            temp = locs[locs["group"] == group]
-            cluster = _np.unique(temp["cluster"])
-            n_cluster = len(cluster)
-            mean_frame = _np.zeros(n_cluster)
-            std_frame = _np.zeros(n_cluster)
-            com_x = _np.zeros(n_cluster)
-            com_y = _np.zeros(n_cluster)
-            com_z = _np.zeros(n_cluster)
-            std_x = _np.zeros(n_cluster)
-            std_y = _np.zeros(n_cluster)
-            std_z = _np.zeros(n_cluster)
-            group_id = _np.zeros(n_cluster)
-            n = _np.zeros(n_cluster, dtype=_np.int32)
-            for i, clusterval in enumerate(cluster):
-                cluster_locs = temp[temp["cluster"] == clusterval]
-                mean_frame[i] = _np.mean(cluster_locs.frame)
-                com_x[i] = _np.average(
-                    cluster_locs.x, weights=cluster_locs.photons
-                )
-                com_y[i] = _np.average(
-                    cluster_locs.y, weights=cluster_locs.photons
-                )
-                com_z[i] = _np.average(
-                    cluster_locs.z, weights=cluster_locs.photons
-                )
-                std_frame[i] = _np.std(cluster_locs.frame)
-                std_x[i] = _np.std(cluster_locs.x) / _np.sqrt(
-                    len(cluster_locs)
-                )
-                std_y[i] = _np.std(cluster_locs.y) / _np.sqrt(
-                    len(cluster_locs)
-                )
-                std_z[i] = _np.std(cluster_locs.z) / _np.sqrt(
-                    len(cluster_locs)
-                )
-                n[i] = len(cluster_locs)
-                group_id[i] = group
-            clusters = _np.rec.array(
-                (
-                    group_id,
-                    cluster,
-                    mean_frame,
-                    com_x,
-                    com_y,
-                    com_z,
-                    std_frame,
-                    std_x,
-                    std_y,
-                    std_z,
-                    n,
-                ),
-                dtype=[
-                    ("group", group.dtype),
-                    ("cluster", cluster.dtype),
-                    ("mean_frame", "f4"),
-                    ("x", "f4"),
-                    ("y", "f4"),
-                    ("z", "f4"),
-                    ("std_frame", "f4"),
-                    ("lpx", "f4"),
-                    ("lpy", "f4"),
-                    ("lpz", "f4"),
-                    ("n", "i4"),
-                ],
-            )
-            combined_locs.append(clusters)
-    else:
-        for group in _tqdm(_np.unique(locs["group"])):
-            temp = locs[locs["group"] == group]
-            cluster = _np.unique(temp["cluster"])
-            n_cluster = len(cluster)
-            mean_frame = _np.zeros(n_cluster)
-            std_frame = _np.zeros(n_cluster)
-            com_x = _np.zeros(n_cluster)
-            com_y = _np.zeros(n_cluster)
-            std_x = _np.zeros(n_cluster)
-            std_y = _np.zeros(n_cluster)
-            group_id = _np.zeros(n_cluster)
-            n = _np.zeros(n_cluster, dtype=_np.int32)
-            for i, clusterval in enumerate(cluster):
-                cluster_locs = temp[temp["cluster"] == clusterval]
-                mean_frame[i] = _np.mean(cluster_locs.frame)
-                com_x[i] = _np.average(
-                    cluster_locs.x, weights=cluster_locs.photons
-                )
-                com_y[i] = _np.average(
-                    cluster_locs.y, weights=cluster_locs.photons
-                )
-                std_frame[i] = _np.std(cluster_locs.frame)
-                std_x[i] = _np.std(cluster_locs.x) / _np.sqrt(
-                    len(cluster_locs)
-                )
-                std_y[i] = _np.std(cluster_locs.y) / _np.sqrt(
-                    len(cluster_locs)
-                )
-                n[i] = len(cluster_locs)
-                group_id[i] = group
-            clusters = _np.rec.array(
-                (
-                    group_id,
-                    cluster,
-                    mean_frame,
-                    com_x,
-                    com_y,
-                    std_frame,
-                    std_x,
-                    std_y,
-                    n,
-                ),
-                dtype=[
-                    ("group", group.dtype),
-                    ("cluster", cluster.dtype),
-                    ("mean_frame", "f4"),
-                    ("x", "f4"),
-                    ("y", "f4"),
-                    ("std_frame", "f4"),
-                    ("lpx", "f4"),
-                    ("lpy", "f4"),
-                    ("n", "i4"),
-                ],
-            )
-            combined_locs.append(clusters)
-
-    combined_locs = stack_arrays(combined_locs, asrecarray=True, usemask=False)
-
+        columns.append(
+            ("z", clusters.weighted_mean(locs.z, locs.photons), "f4")
+        )
+    columns += [
+        ("std_frame", clusters.std(locs.frame), "f4"),
+        ("lpx", clusters.std(locs.x) / _np.sqrt(n), "f4"),
+        ("lpy", clusters.std(locs.y) / _np.sqrt(n), "f4"),
+    ]
+    if hasattr(locs, "z"):
+        columns.append(("lpz", clusters.std(locs.z) / _np.sqrt(n), "f4"))
+    columns.append(("n", n, "i4"))
+    combined_locs = _np.rec.array(
+        tuple([_[1] for _ in columns]), dtype=[(_[0], _[2]) for _ in columns]
+    )
     return combined_locs
 
 
 def cluster_combine_dist(locs):
     print("Calculating distances...")
-
+    groups = _grouping.Groups(locs.group)
+    # The combined locs of each group, in their order
+    combined_locs = groups.sort(locs)
+    cluster = _grouping.Groups(locs.group, locs.cluster).ids[1]
+    columns = [
+        ("group", combined_locs.group, locs.group.dtype),
+        ("cluster", cluster, locs.cluster.dtype),
+    ]
+    for name in ["mean_frame", "x", "y", "z", "std_frame"]:
+        if name in locs.dtype.names:
+            columns.append((name, combined_locs[name], "f4"))
+    for name in ["lpx", "lpy", "lpz"]:
+        if name in locs.dtype.names:
+            columns.append((name, combined_locs[name], "f4"))
+    columns.append(("n", combined_locs.n, "i4"))
+    X_xy = _np.stack([locs.x, locs.y], axis=1)
     if hasattr(locs, "z"):
         print("XYZ")
         pixelsize = int(input("Enter the pixelsize in nm/px:"))
-
-        combined_locs = []
-        for group in _tqdm(_np.unique(locs["group"])):
-            temp = locs[locs["group"] == group]
-            cluster = _np.unique(temp["cluster"])
-            n_cluster = len(cluster)
-            mean_frame = temp["mean_frame"]
-            std_frame = temp["std_frame"]
-            com_x = temp["x"]
-            com_y = temp["y"]
-            com_z = temp["z"]
-            std_x = temp["lpx"]
-            std_y = temp["lpy"]
-            std_z = temp["lpz"]
-            group_id = temp["group"]
-            n = temp["n"]
-            min_dist = _np.zeros(n_cluster)
-            min_dist_xy = _np.zeros(n_cluster)
-            for i, clusterval in enumerate(cluster):
-                # find nearest neighbor in xyz
-                group_locs = temp[temp["cluster"] != clusterval]
-                cluster_locs = temp[temp["cluster"] == clusterval]
-                ref_point = _np.array(
-                    [
-                        cluster_locs.x,
-                        cluster_locs.y,
-                        cluster_locs.z / pixelsize,
-                    ]
-                )
-                all_points = _np.array(
-                    [group_locs.x, group_locs.y, group_locs.z / pixelsize]
-                )
-                distances = distance.cdist(
-                    ref_point.transpose(), all_points.transpose()
-                )
-                min_dist[i] = _np.amin(distances)
-                # find nearest neighbor in xy
-                ref_point_xy = _np.array([cluster_locs.x, cluster_locs.y])
-                all_points_xy = _np.array([group_locs.x, group_locs.y])
-                distances_xy = distance.cdist(
-                    ref_point_xy.transpose(), all_points_xy.transpose()
-                )
-                min_dist_xy[i] = _np.amin(distances_xy)
-
-            clusters = _np.rec.array(
-                (
-                    group_id,
-                    cluster,
-                    mean_frame,
-                    com_x,
-                    com_y,
-                    com_z,
-                    std_frame,
-                    std_x,
-                    std_y,
-                    std_z,
-                    n,
-                    min_dist,
-                    min_dist_xy,
-                ),
-                dtype=[
-                    ("group", group.dtype),
-                    ("cluster", cluster.dtype),
-                    ("mean_frame", "f4"),
-                    ("x", "f4"),
-                    ("y", "f4"),
-                    ("z", "f4"),
-                    ("std_frame", "f4"),
-                    ("lpx", "f4"),
-                    ("lpy", "f4"),
-                    ("lpz", "f4"),
-                    ("n", "i4"),
-                    ("min_dist", "f4"),
-                    ("mind_dist_xy", "f4"),
-                ],
-            )
-            combined_locs.append(clusters)
-
+        X = _np.stack([locs.x, locs.y, locs.z / pixelsize], axis=1)
+        min_dist = groups.min_distance_to_others(X, locs.cluster)
+        min_dist_xy = groups.min_distance_to_others(X_xy, locs.cluster)
+        columns += [
+            ("min_dist", min_dist, "f4"),
+            ("mind_dist_xy", min_dist_xy, "f4"),
+        ]
     else:  # 2D case
         print("XY")
-        combined_locs = []
-        for group in _tqdm(_np.unique(locs["group"])):
-            temp = locs[locs["group"] == group]
-            cluster = _np.unique(temp["cluster"])
-            n_cluster = len(cluster)
-            mean_frame = temp["mean_frame"]
-            std_frame = temp["std_frame"]
-            com_x = temp["x"]
-            com_y = temp["y"]
-            std_x = temp["lpx"]
-            std_y = temp["lpy"]
-            group_id = temp["group"]
-            n = temp["n"]
-            min_dist = _np.zeros(n_cluster)
-
-            for i, clusterval in enumerate(cluster):
-                # find nearest neighbor in xyz
-                group_locs = temp[temp["cluster"] != clusterval]
-                cluster_locs = temp[temp["cluster"] == clusterval]
-                ref_point_xy = _np.array([cluster_locs.x, cluster_locs.y])
-                all_points_xy = _np.array([group_locs.x, group_locs.y])
-                distances_xy = distance.cdist(
-                    ref_point_xy.transpose(), all_points_xy.transpose()
-                )
-                min_dist[i] = _np.amin(distances_xy)
-
-            clusters = _np.rec.array(
-                (
-                    group_id,
-                    cluster,
-                    mean_frame,
-                    com_x,
-                    com_y,
-                    std_frame,
-                    std_x,
-                    std_y,
-                    n,
-                    min_dist,
-                ),
-                dtype=[
-                    ("group", group.dtype),
-                    ("cluster", cluster.dtype),
-                    ("mean_frame", "f4"),
-                    ("x", "f4"),
-                    ("y", "f4"),
-                    ("std_frame", "f4"),
-                    ("lpx", "f4"),
-                    ("lpy", "f4"),
-                    ("n", "i4"),
-                    ("min_dist", "f4"),
-                ],
-            )
-            combined_locs.append(clusters)
-
-    combined_locs = stack_arrays(combined_locs, asrecarray=True, usemask=False)
+        min_dist = groups.min_distance_to_others(X_xy, locs.cluster)
+        columns.append(("min_dist", min_dist, "f4"))
+    combined_locs = _np.rec.array(
+        tuple([_[1] for _ in columns]), dtype=[(_[0], _[2]) for _ in columns]
+    )
     return combined_locs
 
 
-@_numba.jit(nopython=True)
 def get_link_groups(locs, d_max, max_dark_time, group):
-    """ Assumes that locs are sorted by frame """
-    frame = locs.frame
+    """
+    Assumes that locs are sorted by frame. Locs are bucketed by group, frame
+    and a spatial grid with cell size d_max, such that the next loc of a
+    link group is only searched in the neighboring cells of the next
+    max_dark_time + 1 frames. Groups are linked in parallel.
+    """
+    N = len(locs)
+    frame = locs.frame.astype(_np.int64)
     x = locs.x
     y = locs.y
-    N = len(x)
-    link_group = -_np.ones(N, dtype=_np.int32)
-    current_link_group = -1
-    for i in range(N):
-        if link_group[i] == -1:  # loc has no group yet
-            current_link_group += 1
-            link_group[i] = current_link_group
-            current_index = i
-            next_loc_index_in_group = _get_next_loc_index_in_link_group(
-                current_index,
-                link_group,
-                N,
-                frame,
-                x,
-                y,
-                d_max,
-                max_dark_time,
-                group,
-            )
-            while next_loc_index_in_group != -1:
-                link_group[next_loc_index_in_group] = current_link_group
-                current_index = next_loc_index_in_group
-                next_loc_index_in_group = _get_next_loc_index_in_link_group(
-                    current_index,
-                    link_group,
-                    N,
-                    frame,
-                    x,
-                    y,
-                    d_max,
-                    max_dark_time,
-                    group,
-                )
-    return link_group
+    # Cells slightly larger than d_max, so that linked locs are at most one
+    # cell apart despite rounding
+    cell_size = 1.001 * d_max if d_max > 0 else 1.0
+    x_cell = _np.nan_to_num(_np.floor(x / cell_size)).astype(_np.int64)
+    y_cell = _np.nan_to_num(_np.floor(y / cell_size)).astype(_np.int64)
+    # Locs of each group in order of index
+    by_group = _np.argsort(group, kind="stable")
+    # Locs of each group sorted by frame, cell and index
+    by_bucket = _np.lexsort((x_cell, y_cell, frame, group))
+    group_bounds = _np.flatnonzero(_np.diff(group[by_group])) + 1
+    group_bounds = _np.concatenate(([0], group_bounds, [N]))
+    link_start = -_np.ones(N, dtype=_np.int64)
+    n_workers = _lib.n_workers()
+    args = (
+        frame,
+        x,
+        y,
+        x_cell,
+        y_cell,
+        group,
+        d_max,
+        max_dark_time,
+        by_group,
+        by_bucket,
+        link_start,
+    )
+    starts = sorted(
+        zip(group_bounds[:-1], group_bounds[1:]),
+        key=lambda _: _[0] - _[1],
+    )
+    with _ThreadPoolExecutor(n_workers) as executor:
+        for f in [
+            executor.submit(_link_groups, start, stop, *args)
+            for start, stop in starts
+        ]:
+            f.result()
+    # Link groups are numbered in order of their first loc
+    link_group = _np.unique(link_start, return_inverse=True)[1]
+    return link_group.astype(_np.int32)
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _find_bucket(frame, y_cell, x_cell, by_bucket, start, stop, f, cy, cx):
+    """ Index into by_bucket of the first loc of a bucket or larger """
+    while start < stop:
+        middle = (start + stop) // 2
+        i = by_bucket[middle]
+        if (frame[i], y_cell[i], x_cell[i]) < (f, cy, cx):
+            start = middle + 1
+        else:
+            stop = middle
+    return start
 
 
-@_numba.jit(nopython=True)
-def _get_next_loc_index_in_link_group(
-    current_index, link_group, N, frame, x, y, d_max, max_dark_time, group
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _link_groups(
+    start,
+    stop,
+    frame,
+    x,
+    y,
+    x_cell,
+    y_cell,
+    group,
+    d_max,
+    max_dark_time,
+    by_group,
+    by_bucket,
+    link_start,
 ):
-    current_frame = frame[current_index]
-    current_x = x[current_index]
-    current_y = y[current_index]
-    current_group = group[current_index]
-    min_frame = current_frame + 1
-    for min_index in range(current_index + 1, N):
-        if frame[min_index] >= min_frame:
-            break
-    max_frame = current_frame + max_dark_time + 1
-    for max_index in range(min_index, N):
-        if frame[max_index] > max_frame:
-            break
-    else:
-        max_index = N
+    """
+    Links the locs by_group[start:stop], which share the same group, and
+    sets link_start to the first loc of their link group
+    """
+    N = len(frame)
     d_max_2 = d_max ** 2
-    for j in range(min_index, max_index):
-        if group[j] == current_group:
-            if link_group[j] == -1:
+    for k in range(start, stop):
+        i = by_group[k]
+        if link_start[i] != -1:
+            continue
+        link_start[i] = i
+        current_index = i
+        while True:
+            current_frame = frame[current_index]
+            current_x = x[current_index]
+            current_y = y[current_index]
+            next_index = -1
+            for f in range(
+                current_frame + 1, current_frame + max_dark_time + 2
+            ):
+                for cy in range(
+                    y_cell[current_index] - 1, y_cell[current_index] + 2
+                ):
+                    for cx in range(
+                        x_cell[current_index] - 1, x_cell[current_index] + 2
+                    ):
+                        m = _find_bucket(
+                            frame,
+                            y_cell,
+                            x_cell,
+                            by_bucket,
+                            start,
+                            stop,
+                            f,
+                            cy,
+                            cx,
+                        )
+                        while m < stop:
+                            j = by_bucket[m]
+                            if (
+                                frame[j] != f
+                                or y_cell[j] != cy
+                                or x_cell[j] != cx
+                            ):
+                                break
+                            m += 1
+                            if next_index != -1 and j > next_index:
+                                break
+                            if link_start[j] != -1:
+                                continue
+                            dx2 = (current_x - x[j]) ** 2
+                            if dx2 <= d_max_2:
+                                dy2 = (current_y - y[j]) ** 2
+                                if dy2 <= d_max_2:
+                                    if _np.sqrt(dx2 + dy2) <= d_max:
+                                        next_index = j
+                                        break
+                if next_index != -1:
+                    break
+            # For identical results to earlier versions, locs in the last
+            # frame can be followed by the last loc, and the last loc by any
+            # loc of the group
+            candidates = by_group[start:start]
+            if current_index == N - 1:
+                candidates = by_group[start:stop]
+            elif current_frame == frame[N - 1] and next_index == -1:
+                if group[N - 1] == group[current_index]:
+                    candidates = by_group[stop - 1: stop]
+            for j in candidates:
+                if link_start[j] != -1:
+                    continue
                 dx2 = (current_x - x[j]) ** 2
                 if dx2 <= d_max_2:
                     dy2 = (current_y - y[j]) ** 2
                     if dy2 <= d_max_2:
                         if _np.sqrt(dx2 + dy2) <= d_max:
-                            return j
-    return -1
+                            next_index = j
+                            break
+            if next_index == -1:
+                break
+            link_start[next_index] = i
+            current_index = next_index
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_count(link_group, n_locs, n_groups):
     result = _np.zeros(n_groups, dtype=_np.uint32)
     for i in range(n_locs):
@@ -1126,7 +1174,7 @@ def _link_group_count(link_group, n_locs, n_groups):
     return result
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_sum(column, link_group, n_locs, n_groups):
     result = _np.zeros(n_groups, dtype=column.dtype)
     for i in range(n_locs):
@@ -1135,7 +1183,7 @@ def _link_group_sum(column, link_group, n_locs, n_groups):
     return result
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_mean(column, link_group, n_locs, n_groups, n_locs_per_group):
     group_sum = _link_group_sum(column, link_group, n_locs, n_groups)
     result = _np.empty(
@@ -1145,7 +1193,7 @@ def _link_group_mean(column, link_group, n_locs, n_groups, n_locs_per_group):
     return result
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_weighted_mean(
     column, weights, link_group, n_locs, n_groups, n_locs_per_group
 ):
@@ -1158,7 +1206,7 @@ def _link_group_weighted_mean(
     )
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_min_max(column, link_group, n_locs, n_groups):
     min_ = _np.empty(n_groups, dtype=column.dtype)
     max_ = _np.empty(n_groups, dtype=column.dtype)
@@ -1174,7 +1222,7 @@ def _link_group_min_max(column, link_group, n_locs, n_groups):
     return min_, max_
 
 
-@_numba.jit(nopython=True)
+@_numba.jit(nopython=True, cache=True)
 def _link_group_last(column, link_group, n_locs, n_groups):
     result = _np.zeros(n_groups, dtype=column.dtype)
     for i in range(n_locs):
@@ -1287,7 +1335,7 @@ def undrift(
     segmentation_callback=None,
     rcc_callback=None,
 ):
-    bounds, segments = _render.segment(
+    bounds, segments = _render.iter_segments(
         locs,
         info,
         segmentation,
@@ -1295,6 +1343,14 @@ def undrift(
         segmentation_callback,
     )
     shift_y, shift_x = _imageprocess.rcc(segments, 32, rcc_callback)
+    return _segment_drift(locs, info, bounds, shift_x, shift_y, display)
+
+
+def _segment_drift(locs, info, bounds, shift_x, shift_y, display):
+    """
+    Interpolates the drift of each frame from the shifts of the segments,
+    optionally plots it, and subtracts it from the locs
+    """
     t = (bounds[1:] + bounds[:-1]) / 2
     drift_x_pol = _interpolate.InterpolatedUnivariateSpline(t, shift_x, k=3)
     drift_y_pol = _interpolate.InterpolatedUnivariateSpline(t, shift_y, k=3)
@@ -1302,50 +1358,235 @@ def undrift(
     drift = (drift_x_pol(t_inter), drift_y_pol(t_inter))
     drift = _np.rec.array(drift, dtype=[("x", "f"), ("y", "f")])
     if display:
-        fig1 = _plt.figure(figsize=(17, 6))
-        _plt.suptitle("Estimated drift")
-        _plt.subplot(1, 2, 1)
-        _plt.plot(drift.x, label="x interpolated")
-        _plt.plot(drift.y, label="y interpolated")
+        import matplotlib.pyplot as plt
+
+        plt.style.use("ggplot")
+        fig1 = plt.figure(figsize=(17, 6))
+        plt.suptitle("Estimated drift")
+        plt.subplot(1, 2, 1)
+        plt.plot(drift.x, label="x interpolated")
+        plt.plot(drift.y, label="y interpolated")
         t = (bounds[1:] + bounds[:-1]) / 2
-        _plt.plot(
+        plt.plot(
             t,
             shift_x,
             "o",
-            color=list(_plt.rcParams["axes.prop_cycle"])[0]["color"],
+            color=list(plt.rcParams["axes.prop_cycle"])[0]["color"],
             label="x",
         )
-        _plt.plot(
+        plt.plot(
             t,
             shift_y,
             "o",
-            color=list(_plt.rcParams["axes.prop_cycle"])[1]["color"],
+            color=list(plt.rcParams["axes.prop_cycle"])[1]["color"],
             label="y",
         )
-        _plt.legend(loc="best")
-        _plt.xlabel("Frame")
-        _plt.ylabel("Drift (pixel)")
-        _plt.subplot(1, 2, 2)
-        _plt.plot(
+        plt.legend(loc="best")
+        plt.xlabel("Frame")
+        plt.ylabel("Drift (pixel)")
+        plt.subplot(1, 2, 2)
+        plt.plot(
             drift.x,
             drift.y,
-            color=list(_plt.rcParams["axes.prop_cycle"])[2]["color"],
+            color=list(plt.rcParams["axes.prop_cycle"])[2]["color"],
         )
-        _plt.plot(
+        plt.plot(
             shift_x,
             shift_y,
             "o",
-            color=list(_plt.rcParams["axes.prop_cycle"])[2]["color"],
+            color=list(plt.rcParams["axes.prop_cycle"])[2]["color"],
         )
-        _plt.axis("equal")
-        _plt.xlabel("x")
-        _plt.ylabel("y")
+        plt.axis("equal")
+        plt.xlabel("x")
+        plt.ylabel("y")
         fig1.show()
     locs.x -= drift.x[locs.frame]
     locs.y -= drift.y[locs.frame]
     return drift, locs
 
 
+def undrift_locs(
+    locs,
+    info,
+    segmentation,
+    display=True,
+    callback=None,
+    max_shift=0.5,
+    resolution=None,
+):
+    """
+    Estimates drift from the localizations directly, without rendering.
+    The locs of consecutive windows of segmentation frames are matched to
+    a reference of all previous, drift corrected locs, which are counted
+    in the cells (of size resolution, in pixels) of a spatial hash. The
+    shift of a window maximizes its overlap with the reference, searched
+    up to max_shift from the drift extrapolated from previous windows.
+    """
+    if resolution is None:
+        if hasattr(locs, "lpx"):
+            resolution = float(_np.median(locs.lpx) + _np.median(locs.lpy))
+            resolution = min(max(resolution / 2, 0.01), 0.5)
+        else:
+            resolution = 0.1
+    n_frames = info[0]["Frames"]
+    n_seg = _render.n_segments(info, segmentation)
+    bounds = _np.linspace(0, n_frames - 1, n_seg + 1, dtype=_np.uint32)
+    frame = locs.frame
+    order = _np.argsort(frame, kind="stable")
+    starts = _np.searchsorted(frame[order], bounds)
+    x = locs.x[order]
+    y = locs.y[order]
+    reference = _LocsHash(resolution)
+    shift_x = _np.zeros(n_seg)
+    shift_y = _np.zeros(n_seg)
+    if callback is not None:
+        callback(0)
+    for i in _trange(n_seg, desc="Matching windows", unit="windows"):
+        x_ = x[starts[i]: starts[i + 1]]
+        y_ = y[starts[i]: starts[i + 1]]
+        if i > 1:
+            shift_x[i] = 2 * shift_x[i - 1] - shift_x[i - 2]
+            shift_y[i] = 2 * shift_y[i - 1] - shift_y[i - 2]
+        if i > 0:
+            # A coarse search around the extrapolation with a subset of
+            # the locs, then refinement around it with all of them
+            step = max(1, len(x_) // 2 ** 14)
+            for search, step in [(max_shift, step), (2 * resolution, 1)]:
+                shift_x[i], shift_y[i] = reference.match(
+                    x_[::step], y_[::step], shift_x[i], shift_y[i], search
+                )
+        reference.add(x_ - shift_x[i], y_ - shift_y[i])
+        if callback is not None:
+            callback(i + 1)
+    return _segment_drift(locs, info, bounds, shift_x, shift_y, display)
+
+
+# Fibonacci hashing of the cell keys
+_HASH_MULTIPLIER = _np.uint64(11400714819323198485)
+# Cell keys are (cy + _HASH_OFFSET) * _HASH_STRIDE + cx + _HASH_OFFSET
+_HASH_OFFSET = 2 ** 21
+_HASH_STRIDE = 2 ** 22
+
+
+class _LocsHash:
+    """
+    Localization counts per cell of a square grid, in an open addressing
+    hash table that only holds the occupied cells
+    """
+
+    def __init__(self, resolution, size=2 ** 16):
+        self.resolution = resolution
+        self.n_cells = 0
+        self._allocate(size)
+
+    def _allocate(self, size):
+        self.keys = _np.full(size, -1, dtype=_np.int64)
+        self.counts = _np.zeros(size, dtype=_np.float64)
+        self.shift = _np.uint64(64 - int(_np.log2(size)))
+
+    def add(self, x, y):
+        # Keep the table at most half full
+        size = len(self.keys)
+        if 2 * (self.n_cells + len(x)) > size:
+            keys, counts = self.keys, self.counts
+            while 2 * (self.n_cells + len(x)) > size:
+                size *= 2
+            self._allocate(size)
+            occupied = keys != -1
+            _hash_insert(
+                self.keys, self.counts, self.shift, keys[occupied],
+                counts[occupied],
+            )
+        cell_keys = _cell_keys(x, y, self.resolution)
+        self.n_cells += _hash_insert(
+            self.keys, self.counts, self.shift, cell_keys,
+            _np.ones(len(cell_keys)),
+        )
+
+    def match(self, x, y, shift_x, shift_y, search):
+        """
+        The shift (up to search from the given shift) of the locs with the
+        largest overlap with the counts. The shift is kept if the locs do
+        not overlap.
+        """
+        m = int(_np.ceil(search / self.resolution))
+        n_workers = _lib.n_workers()
+        chunks = _np.array_split(_np.arange(len(x)), n_workers)
+        with _ThreadPoolExecutor(n_workers) as executor:
+            overlaps = executor.map(
+                lambda _: _hash_overlap(
+                    self.keys, self.counts, self.shift, x[_], y[_],
+                    shift_x, shift_y, self.resolution, m,
+                ),
+                chunks,
+            )
+            overlap = sum(overlaps)
+        if overlap.max() == 0:
+            return shift_x, shift_y
+        oy, ox = _np.unravel_index(overlap.argmax(), overlap.shape)
+        if 0 < oy < 2 * m and 0 < ox < 2 * m:
+            roi = overlap[oy - 1: oy + 2, ox - 1: ox + 2]
+            dy, dx = _imageprocess._subpixel_peak(roi)
+            oy, ox = oy + dy, ox + dx
+        # The counts lie at a cell offset from the shifted locs, i.e., the
+        # locs are shifted by the opposite
+        return (
+            shift_x - (ox - m) * self.resolution,
+            shift_y - (oy - m) * self.resolution,
+        )
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _cell_keys(x, y, resolution):
+    keys = _np.zeros(len(x), dtype=_np.int64)
+    for i in range(len(x)):
+        cx = int(_np.floor(x[i] / resolution))
+        cy = int(_np.floor(y[i] / resolution))
+        keys[i] = (cy + _HASH_OFFSET) * _HASH_STRIDE + cx + _HASH_OFFSET
+    return keys
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _hash_slot(keys, key, shift):
+    """ Slot of a key, or the empty slot where it belongs """
+    mask = len(keys) - 1
+    slot = _np.int64((_np.uint64(key) * _HASH_MULTIPLIER) >> shift)
+    while keys[slot] != key and keys[slot] != -1:
+        slot = (slot + 1) & mask
+    return slot
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _hash_insert(keys, counts, shift, new_keys, new_counts):
+    n_new = 0
+    for i in range(len(new_keys)):
+        slot = _hash_slot(keys, new_keys[i], shift)
+        if keys[slot] == -1:
+            keys[slot] = new_keys[i]
+            n_new += 1
+        counts[slot] += new_counts[i]
+    return n_new
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _hash_overlap(
+    keys, counts, shift, x, y, shift_x, shift_y, resolution, m
+):
+    """ Counts at cell offsets in [-m, m] of the shifted locs, summed """
+    overlap = _np.zeros((2 * m + 1, 2 * m + 1))
+    for i in range(len(x)):
+        cx = int(_np.floor((x[i] - shift_x) / resolution))
+        cy = int(_np.floor((y[i] - shift_y) / resolution))
+        for oy in range(-m, m + 1):
+            key_y = (cy + oy + _HASH_OFFSET) * _HASH_STRIDE + _HASH_OFFSET
+            for ox in range(-m, m + 1):
+                key = key_y + cx + ox
+                slot = _hash_slot(keys, key, shift)
+                if keys[slot] == key:
+                    overlap[oy + m, ox + m] += counts[slot]
+    return overlap
+
+
 def align(locs, infos, display=False):
     images = []
     for i, (locs_, info_) in enumerate(zip(locs, infos)):
@@ -1365,8 +1606,8 @@ def groupprops(locs, callback=None):
         locs = locs[locs.dark != -1]
     except AttributeError:
         pass
-    group_ids = _np.unique(locs.group)
-    n = len(group_ids)
+    groups = _grouping.Groups(locs.group)
+    n = len(groups)
     n_cols = len(locs.dtype)
     names = ["group", "n_events"] + list(
         _itertools.chain(
@@ -1374,21 +1615,17 @@ def groupprops(locs, callback=None):
         )
     )
     formats = ["i4", "i4"] + 2 * n_cols * ["f4"]
-    groups = _np.recarray(n, formats=formats, names=names)
+    group_props = _np.recarray(n, formats=formats, names=names)
     if callback is not None:
         callback(0)
-    for i, group_id in enumerate(
-        _tqdm(group_ids, desc="Calculating group statistics", unit="Groups")
-    ):
-        group_locs = locs[locs.group == group_id]
-        groups["group"][i] = group_id
-        groups["n_events"][i] = len(group_locs)
-        for name in locs.dtype.names:
-            groups[name + "_mean"][i] = _np.mean(group_locs[name])
-            groups[name + "_std"][i] = _np.std(group_locs[name])
-        if callback is not None:
-            callback(i + 1)
-    return groups
+    group_props["group"] = groups.ids[0]
+    group_props["n_events"] = groups.count()
+    for name in locs.dtype.names:
+        group_props[name + "_mean"] = groups.mean(locs[name])
+        group_props[name + "_std"] = groups.std(locs[name])
+    if callback is not None:
+        callback(n)
+    return group_props
 
 
 def calculate_fret(acc_locs, don_locs):
@@ -7,13 +7,24 @@
     :author: Joerg Schnitzbauer, 2015
     :copyright: Copyright (c) 2015 Jungmann Lab, MPI of Biochemistry
 """
+import queue as _queue
+import threading as _threading
+from collections import OrderedDict as _OrderedDict
+from collections import deque as _deque
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+
 import numpy as _np
 import numba as _numba
 import scipy.signal as _signal
 from tqdm import trange as _trange
 
+from . import lib as _lib
+
 
 _DRAW_MAX_SIGMA = 3
+_TILE_SIZE = 128
+# Threads that set serial draw their tiles without a pool of their own
+_thread_state = _threading.local()
 
 
 def render(
@@ -50,7 +61,7 @@ def render(
         raise Exception("blur_method not understood.")
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _render_setup(locs, oversampling, y_min, x_min, y_max, x_max):
     n_pixel_y = int(_np.ceil(oversampling * (y_max - y_min)))
     n_pixel_x = int(_np.ceil(oversampling * (x_max - x_min)))
@@ -65,7 +76,7 @@ def _render_setup(locs, oversampling, y_min, x_min, y_max, x_max):
     return image, n_pixel_y, n_pixel_x, x, y, in_view
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _render_setup3d(
     locs, oversampling, y_min, x_min, y_max, x_max, z_min, z_max, pixelsize
 ):
@@ -93,7 +104,7 @@ def _render_setup3d(
     return image, n_pixel_y, n_pixel_x, n_pixel_z, x, y, z, in_view
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _render_setupz(locs, oversampling, x_min, z_min, x_max, z_max, pixelsize):
     n_pixel_x = int(_np.ceil(oversampling * (x_max - x_min)))
     n_pixel_z = int(_np.ceil(oversampling * (z_max - z_min) / pixelsize))
@@ -108,7 +119,7 @@ def _render_setupz(locs, oversampling, x_min, z_min, x_max, z_max, pixelsize):
     return image, n_pixel_z, n_pixel_x, x, z, in_view
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _fill(image, x, y):
     x = x.astype(_np.int32)
     y = y.astype(_np.int32)
@@ -116,7 +127,7 @@ def _fill(image, x, y):
         image[j, i] += 1
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _fill3d(image, x, y, z):
     x = x.astype(_np.int32)
     y = y.astype(_np.int32)
@@ -126,7 +137,7 @@ def _fill3d(image, x, y, z):
     return image
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def render_hist(locs, oversampling, y_min, x_min, y_max, x_max):
     image, n_pixel_y, n_pixel_x, x, y, in_view = _render_setup(
         locs, oversampling, y_min, x_min, y_max, x_max
@@ -135,7 +146,7 @@ def render_hist(locs, oversampling, y_min, x_min, y_max, x_max):
     return len(x), image
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def render_histz(locs, oversampling, x_min, z_min, x_max, z_max, pixelsize):
     image, n_pixel_z, n_pixel_x, x, z, in_view = _render_setupz(
         locs, oversampling, x_min, z_min, x_max, z_max, pixelsize
@@ -144,7 +155,7 @@ def render_histz(locs, oversampling, x_min, z_min, x_max, z_max, pixelsize):
     return len(x), image
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def render_hist3d(
     locs, oversampling, y_min, x_min, y_max, x_max, z_min, z_max, pixelsize
 ):
@@ -155,7 +166,6 @@ def render_hist3d(
     return len(x), image
 
 
-@_numba.jit(nopython=True, nogil=True)
 def render_gaussian(
     locs, oversampling, y_min, x_min, y_max, x_max, min_blur_width
 ):
@@ -164,35 +174,12 @@ def render_gaussian(
     )
     blur_width = oversampling * _np.maximum(locs.lpx, min_blur_width)
     blur_height = oversampling * _np.maximum(locs.lpy, min_blur_width)
-    sy = blur_height[in_view]
-    sx = blur_width[in_view]
-    for x_, y_, sx_, sy_ in zip(x, y, sx, sy):
-        max_y = _DRAW_MAX_SIGMA * sy_
-        i_min = _np.int32(y_ - max_y)
-        if i_min < 0:
-            i_min = 0
-        i_max = _np.int32(y_ + max_y + 1)
-        if i_max > n_pixel_y:
-            i_max = n_pixel_y
-        max_x = _DRAW_MAX_SIGMA * sx_
-        j_min = _np.int32(x_ - max_x)
-        if j_min < 0:
-            j_min = 0
-        j_max = _np.int32(x_ + max_x) + 1
-        if j_max > n_pixel_x:
-            j_max = n_pixel_x
-        for i in range(i_min, i_max):
-            for j in range(j_min, j_max):
-                image[i, j] += _np.exp(
-                    -(
-                        (j - x_ + 0.5) ** 2 / (2 * sx_ ** 2)
-                        + (i - y_ + 0.5) ** 2 / (2 * sy_ ** 2)
-                    )
-                ) / (2 * _np.pi * sx_ * sy_)
+    sy = blur_height[in_view].astype(_np.float64)
+    sx = blur_width[in_view].astype(_np.float64)
+    _draw_gaussians(image, x, y, sx, sy)
     return len(x), image
 
 
-@_numba.jit(nopython=True, nogil=True)
 def render_gaussian_iso(
     locs, oversampling, y_min, x_min, y_max, x_max, min_blur_width
 ):
@@ -202,33 +189,156 @@ def render_gaussian_iso(
     blur_width = oversampling * _np.maximum(locs.lpx, min_blur_width)
     blur_height = oversampling * _np.maximum(locs.lpy, min_blur_width)
     sy = (blur_height[in_view] + blur_width[in_view]) / 2
+    sy = sy.astype(_np.float64)
     sx = sy
-    for x_, y_, sx_, sy_ in zip(x, y, sx, sy):
-        max_y = _DRAW_MAX_SIGMA * sy_
-        i_min = _np.int32(y_ - max_y)
-        if i_min < 0:
-            i_min = 0
-        i_max = _np.int32(y_ + max_y + 1)
-        if i_max > n_pixel_y:
-            i_max = n_pixel_y
-        max_x = _DRAW_MAX_SIGMA * sx_
-        j_min = _np.int32(x_ - max_x)
-        if j_min < 0:
-            j_min = 0
-        j_max = _np.int32(x_ + max_x) + 1
-        if j_max > n_pixel_x:
-            j_max = n_pixel_x
-        for i in range(i_min, i_max):
-            for j in range(j_min, j_max):
-                image[i, j] += _np.exp(
-                    -(
-                        (j - x_ + 0.5) ** 2 / (2 * sx_ ** 2)
-                        + (i - y_ + 0.5) ** 2 / (2 * sy_ ** 2)
-                    )
-                ) / (2 * _np.pi * sx_ * sy_)
+    _draw_gaussians(image, x, y, sx, sy)
     return len(x), image
 
 
+def _draw_gaussians(image, x, y, sx, sy):
+    """
+    Adds a normalized Gaussian for each loc to the image. The image is cut
+    into tiles, which are drawn in parallel. Each tile draws the part of
+    every kernel that overlaps it, so no two threads write the same pixel.
+    """
+    n_pixel_y, n_pixel_x = image.shape
+    n_tiles_y = -(-n_pixel_y // _TILE_SIZE)
+    n_tiles_x = -(-n_pixel_x // _TILE_SIZE)
+    tile_start, tile_locs = _bin_to_tiles(
+        x, y, sx, sy, n_pixel_y, n_pixel_x, n_tiles_y, n_tiles_x, _TILE_SIZE
+    )
+    n_tiles = n_tiles_y * n_tiles_x
+    if getattr(_thread_state, "serial", False):
+        n_workers = 1
+    else:
+        n_workers = _lib.n_workers()
+    # Tasks of consecutive tiles with about the same number of kernels
+    n_tasks = min(n_tiles, 4 * n_workers)
+    task_bounds = _np.searchsorted(
+        tile_start, _np.linspace(0, tile_start[-1], n_tasks + 1)
+    )
+    task_bounds[0] = 0
+    task_bounds[-1] = n_tiles
+    task_bounds = _np.unique(task_bounds)
+    args = (x, y, sx, sy, tile_start, tile_locs, n_tiles_x, _TILE_SIZE)
+    if len(task_bounds) == 2 or n_workers == 1:
+        _draw_tiles(image, 0, n_tiles, *args)
+        return
+    with _ThreadPoolExecutor(n_workers) as executor:
+        for f in [
+            executor.submit(_draw_tiles, image, first, last, *args)
+            for first, last in zip(task_bounds[:-1], task_bounds[1:])
+        ]:
+            f.result()
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _gaussian_bounds(x_, y_, sx_, sy_, n_pixel_y, n_pixel_x):
+    """ Pixel range [i_min, i_max) x [j_min, j_max) of a loc's kernel """
+    max_y = _DRAW_MAX_SIGMA * sy_
+    i_min = _np.int32(y_ - max_y)
+    if i_min < 0:
+        i_min = 0
+    i_max = _np.int32(y_ + max_y + 1)
+    if i_max > n_pixel_y:
+        i_max = n_pixel_y
+    max_x = _DRAW_MAX_SIGMA * sx_
+    j_min = _np.int32(x_ - max_x)
+    if j_min < 0:
+        j_min = 0
+    j_max = _np.int32(x_ + max_x) + 1
+    if j_max > n_pixel_x:
+        j_max = n_pixel_x
+    return i_min, i_max, j_min, j_max
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _bin_to_tiles(
+    x, y, sx, sy, n_pixel_y, n_pixel_x, n_tiles_y, n_tiles_x, tile_size
+):
+    """
+    tile_locs[tile_start[t]:tile_start[t + 1]] are the locs whose kernel
+    overlaps tile t, in their original order
+    """
+    N = len(x)
+    # Tiles overlapped by each kernel, [ty_min, ty_max) x [tx_min, tx_max)
+    tiles = _np.zeros((N, 4), dtype=_np.int32)
+    tile_start = _np.zeros(n_tiles_y * n_tiles_x + 1, dtype=_np.int64)
+    for loc in range(N):
+        i_min, i_max, j_min, j_max = _gaussian_bounds(
+            x[loc], y[loc], sx[loc], sy[loc], n_pixel_y, n_pixel_x
+        )
+        if i_max <= i_min or j_max <= j_min:
+            continue
+        tiles[loc, 0] = i_min // tile_size
+        tiles[loc, 1] = (i_max - 1) // tile_size + 1
+        tiles[loc, 2] = j_min // tile_size
+        tiles[loc, 3] = (j_max - 1) // tile_size + 1
+        for ty in range(tiles[loc, 0], tiles[loc, 1]):
+            for tx in range(tiles[loc, 2], tiles[loc, 3]):
+                tile_start[ty * n_tiles_x + tx + 1] += 1
+    tile_start = _np.cumsum(tile_start)
+    tile_locs = _np.empty(tile_start[-1], dtype=_np.int64)
+    tile_fill = tile_start[:-1].copy()
+    for loc in range(N):
+        for ty in range(tiles[loc, 0], tiles[loc, 1]):
+            for tx in range(tiles[loc, 2], tiles[loc, 3]):
+                tile = ty * n_tiles_x + tx
+                tile_locs[tile_fill[tile]] = loc
+                tile_fill[tile] += 1
+    return tile_start, tile_locs
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _draw_tiles(
+    image,
+    first,
+    last,
+    x,
+    y,
+    sx,
+    sy,
+    tile_start,
+    tile_locs,
+    n_tiles_x,
+    tile_size,
+):
+    n_pixel_y, n_pixel_x = image.shape
+    # The kernel is separable: one 1D table per axis instead of a 2D exp
+    gy = _np.empty(tile_size)
+    gx = _np.empty(tile_size)
+    for tile in range(first, last):
+        y0 = (tile // n_tiles_x) * tile_size
+        x0 = (tile % n_tiles_x) * tile_size
+        y1 = min(y0 + tile_size, n_pixel_y)
+        x1 = min(x0 + tile_size, n_pixel_x)
+        for loc in tile_locs[tile_start[tile]: tile_start[tile + 1]]:
+            x_ = x[loc]
+            y_ = y[loc]
+            sx_ = sx[loc]
+            sy_ = sy[loc]
+            i_min, i_max, j_min, j_max = _gaussian_bounds(
+                x_, y_, sx_, sy_, n_pixel_y, n_pixel_x
+            )
+            i_min = max(i_min, y0)
+            i_max = min(i_max, y1)
+            j_min = max(j_min, x0)
+            j_max = min(j_max, x1)
+            for i in range(i_min, i_max):
+                gy[i - i_min] = _np.exp(
+                    -((i - y_ + 0.5) ** 2) / (2 * sy_ ** 2)
+                )
+            norm = 1 / (2 * _np.pi * sx_ * sy_)
+            for j in range(j_min, j_max):
+                gx[j - j_min] = norm * _np.exp(
+                    -((j - x_ + 0.5) ** 2) / (2 * sx_ ** 2)
+                )
+            for i in range(i_min, i_max):
+                gy_ = gy[i - i_min]
+                for j in range(j_min, j_max):
+                    image[i, j] += gy_ * gx[j - j_min]
+
+
 def render_convolve(
     locs, oversampling, y_min, x_min, y_max, x_max, min_blur_width
 ):
@@ -272,24 +382,303 @@ def _fftconvolve(image, blur_width, blur_height):
 
 
 def segment(locs, info, segmentation, kwargs={}, callback=None):
-    Y = info[0]["Height"]
-    X = info[0]["Width"]
+    bounds, segments = iter_segments(
+        locs, info, segmentation, kwargs, callback
+    )
+    stack = None
+    for i, image in enumerate(segments):
+        if stack is None:
+            stack = _np.zeros(
+                (len(bounds) - 1,) + image.shape, dtype=_np.float32
+            )
+        stack[i] = image
+    if stack is None:
+        stack = _np.zeros(
+            (0, info[0]["Height"], info[0]["Width"]), dtype=_np.float32
+        )
+    return bounds, stack
+
+
+def iter_segments(locs, info, segmentation, kwargs={}, callback=None):
+    """
+    Renders the locs of consecutive frame segments. Returns the segment
+    bounds and a generator of the segment images, in order. The locs are
+    sorted by frame once and sliced per segment; only a few segments are
+    rendered ahead in parallel, such that the whole stack never needs to
+    be in memory. Each segment is rendered in a single thread.
+    """
     n_frames = info[0]["Frames"]
     n_seg = n_segments(info, segmentation)
     bounds = _np.linspace(0, n_frames - 1, n_seg + 1, dtype=_np.uint32)
-    segments = _np.zeros((n_seg, Y, X))
-    if callback is not None:
-        callback(0)
-    for i in _trange(n_seg, desc="Generating segments", unit="segments"):
-        segment_locs = locs[
-            (locs.frame >= bounds[i]) & (locs.frame < bounds[i + 1])
-        ]
-        _, segments[i] = render(segment_locs, info, **kwargs)
+    frame = locs.frame
+    if _np.any(frame[1:] < frame[:-1]):
+        locs = locs[_np.argsort(frame, kind="stable")]
+        frame = locs.frame
+    starts = _np.searchsorted(frame, bounds)
+
+    def render_segment(i):
+        _thread_state.serial = True
+        segment_locs = locs[starts[i]: starts[i + 1]]
+        return render(segment_locs, info, **kwargs)[1]
+
+    def generate():
         if callback is not None:
-            callback(i + 1)
-    return bounds, segments
+            callback(0)
+        n_workers = _lib.n_workers()
+        with _ThreadPoolExecutor(n_workers) as executor:
+            futures = _deque()
+            for i in _trange(
+                n_seg, desc="Generating segments", unit="segments"
+            ):
+                while len(futures) <= n_workers and (
+                    i + len(futures) < n_seg
+                ):
+                    futures.append(
+                        executor.submit(render_segment, i + len(futures))
+                    )
+                image = futures.popleft().result()
+                if callback is not None:
+                    callback(i + 1)
+                yield image
+
+    return bounds, generate()
 
 
 def n_segments(info, segmentation):
     n_frames = info[0]["Frames"]
     return int(_np.round(n_frames / segmentation))
+
+
+class TileCache:
+    """
+    Histogram renderings of the locs of one channel at power-of-two
+    oversamplings ("levels"), cut into square tiles. Tiles are rendered
+    when first requested, or ahead of time by a background thread, and the
+    least recently used tiles are evicted beyond max_bytes, which includes
+    the index into the locs.
+    """
+
+    TILE_SIZE = 256
+    MIN_LEVEL = -4
+    MAX_LEVEL = 8
+    # Upper bound on the number of index blocks
+    MAX_BLOCKS = 2 ** 22
+
+    def __init__(self, locs, info, max_bytes=512 * 2 ** 20):
+        self.height = info[0]["Height"]
+        self.width = info[0]["Width"]
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._fingerprint = _lib.locs_fingerprint(locs, info)
+        self._tiles = _OrderedDict()
+        self._lock = _threading.Lock()
+        self._queue = _queue.Queue()
+        self.ready = _threading.Event()
+        self._thread = _threading.Thread(
+            target=self._work, args=(locs,), daemon=True
+        )
+        self._thread.start()
+
+    def matches(self, locs, info):
+        return _lib.locs_fingerprint(locs, info) == self._fingerprint
+
+    def close(self):
+        self._queue.put(None)
+
+    def _work(self, locs):
+        self._build_index(locs)
+        self.ready.set()
+        # Render the coarse levels in full, within a quarter of the budget
+        n_bytes = 0
+        for level in range(self.MIN_LEVEL, self.MAX_LEVEL + 1):
+            n_tiles_y, n_tiles_x = self._n_tiles(level)
+            n_bytes += n_tiles_y * n_tiles_x * self.TILE_SIZE ** 2 * 4
+            if n_bytes > self.max_bytes / 4:
+                break
+            for ty in range(n_tiles_y):
+                for tx in range(n_tiles_x):
+                    self.tile(level, ty, tx)
+        while True:
+            key = self._queue.get()
+            if key is None:
+                return
+            self.tile(*key)
+
+    def _build_index(self, locs):
+        """
+        Indexes the locs in the image by square blocks of power-of-two
+        camera pixels, through an order array into the columns of locs
+        """
+        n_pixels = self.height * self.width
+        self.block_size = 2 ** max(
+            0, int(_np.ceil(_np.log2(n_pixels / self.MAX_BLOCKS) / 2))
+        )
+        self.n_blocks_y = int(_np.ceil(self.height / self.block_size))
+        self.n_blocks_x = int(_np.ceil(self.width / self.block_size))
+        self.x = locs.x
+        self.y = locs.y
+        in_image = (self.x >= 0) & (self.y >= 0)
+        in_image &= (self.x < self.width) & (self.y < self.height)
+        in_image = _np.flatnonzero(in_image)
+        x = self.x[in_image]
+        y = self.y[in_image]
+        block = (y // self.block_size).astype(_np.int64) * self.n_blocks_x
+        block += (x // self.block_size).astype(_np.int64)
+        del x, y
+        order = _np.argsort(block, kind="stable")
+        index_dtype = _np.int32 if len(self.x) < 2 ** 31 else _np.int64
+        self.order = in_image[order].astype(index_dtype)
+        self.block_start = _np.searchsorted(
+            block[order], _np.arange(self.n_blocks_y * self.n_blocks_x + 1)
+        )
+        with self._lock:
+            self.n_bytes += self.order.nbytes + self.block_start.nbytes
+
+    def _n_tiles(self, level):
+        scale = 2.0 ** level
+        n_tiles_y = int(_np.ceil(scale * self.height / self.TILE_SIZE))
+        n_tiles_x = int(_np.ceil(scale * self.width / self.TILE_SIZE))
+        return n_tiles_y, n_tiles_x
+
+    def tile(self, level, ty, tx):
+        """ Tile (ty, tx) at oversampling 2 ** level """
+        key = (level, ty, tx)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+        image = _render_hist_tile(
+            self.x,
+            self.y,
+            self.order,
+            self.block_start,
+            self.n_blocks_y,
+            self.n_blocks_x,
+            self.block_size,
+            2.0 ** level,
+            ty * self.TILE_SIZE,
+            tx * self.TILE_SIZE,
+            self.TILE_SIZE,
+        )
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = image
+                self.n_bytes += image.nbytes
+                while self.n_bytes > self.max_bytes and len(self._tiles) > 1:
+                    _, evicted = self._tiles.popitem(last=False)
+                    self.n_bytes -= evicted.nbytes
+            return self._tiles[key]
+
+    def render(self, oversampling, viewport, exact=False):
+        """
+        Histogram of the viewport, composited from the tiles at the lowest
+        level that is not coarser than oversampling. Returns the number of
+        locs and the image like render.render, or None if the index is not
+        built yet or the oversampling is outside the levels.
+        The image is on the pixel grid of the level, which only matches
+        render.render if oversampling is a power of two and the viewport
+        starts and ends on pixels of that grid. If exact, returns None
+        otherwise.
+        """
+        level = int(_np.ceil(_np.log2(oversampling)))
+        if not self.ready.is_set():
+            return None
+        if level < self.MIN_LEVEL or level > self.MAX_LEVEL:
+            return None
+        scale = 2.0 ** level
+        T = self.TILE_SIZE
+        (y_min, x_min), (y_max, x_max) = viewport
+        i_min = int(_np.floor(scale * y_min))
+        i_max = max(int(_np.ceil(scale * y_max)), i_min + 1)
+        j_min = int(_np.floor(scale * x_min))
+        j_max = max(int(_np.ceil(scale * x_max)), j_min + 1)
+        if exact and (
+            scale != oversampling
+            or (i_min, j_min) != (scale * y_min, scale * x_min)
+            or (i_max, j_max) != (scale * y_max, scale * x_max)
+        ):
+            return None
+        image = _np.zeros((i_max - i_min, j_max - j_min), dtype=_np.float32)
+        n_tiles_y, n_tiles_x = self._n_tiles(level)
+        ty_min = max(i_min // T, 0)
+        ty_max = min((i_max - 1) // T + 1, n_tiles_y)
+        tx_min = max(j_min // T, 0)
+        tx_max = min((j_max - 1) // T + 1, n_tiles_x)
+        for ty in range(ty_min, ty_max):
+            y0 = max(ty * T, i_min)
+            y1 = min((ty + 1) * T, i_max)
+            for tx in range(tx_min, tx_max):
+                x0 = max(tx * T, j_min)
+                x1 = min((tx + 1) * T, j_max)
+                image[y0 - i_min: y1 - i_min, x0 - j_min: x1 - j_min] = (
+                    self.tile(level, ty, tx)[
+                        y0 - ty * T: y1 - ty * T, x0 - tx * T: x1 - tx * T
+                    ]
+                )
+        self._prefetch(level, ty_min, ty_max, tx_min, tx_max)
+        return int(image.sum(dtype=_np.float64)), image
+
+    def _prefetch(self, level, ty_min, ty_max, tx_min, tx_max):
+        """
+        Replaces pending requests with the tiles around the viewport and
+        the viewport at the neighboring levels
+        """
+        while True:
+            try:
+                self._queue.get_nowait()
+            except _queue.Empty:
+                break
+        keys = []
+        n_tiles_y, n_tiles_x = self._n_tiles(level)
+        for ty in range(max(ty_min - 1, 0), min(ty_max + 1, n_tiles_y)):
+            for tx in range(max(tx_min - 1, 0), min(tx_max + 1, n_tiles_x)):
+                keys.append((level, ty, tx))
+        if level > self.MIN_LEVEL:
+            for ty in range(ty_min // 2, (ty_max - 1) // 2 + 1):
+                for tx in range(tx_min // 2, (tx_max - 1) // 2 + 1):
+                    keys.append((level - 1, ty, tx))
+        if level < self.MAX_LEVEL:
+            n_tiles_y, n_tiles_x = self._n_tiles(level + 1)
+            for ty in range(2 * ty_min, min(2 * ty_max, n_tiles_y)):
+                for tx in range(2 * tx_min, min(2 * tx_max, n_tiles_x)):
+                    keys.append((level + 1, ty, tx))
+        for key in keys:
+            with self._lock:
+                cached = key in self._tiles
+            if not cached:
+                self._queue.put(key)
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _render_hist_tile(
+    x,
+    y,
+    order,
+    block_start,
+    n_blocks_y,
+    n_blocks_x,
+    block_size,
+    scale,
+    y0,
+    x0,
+    tile_size,
+):
+    """
+    Histogram of pixels [y0, y0 + tile_size) x [x0, x0 + tile_size), where
+    pixel i covers camera pixels [i / scale, (i + 1) / scale), from the
+    locs order[block_start[b]:block_start[b + 1]] in each block b
+    """
+    image = _np.zeros((tile_size, tile_size), dtype=_np.float32)
+    by_min = min(int(y0 / scale // block_size), n_blocks_y)
+    by_max = min(int((y0 + tile_size) / scale // block_size) + 1, n_blocks_y)
+    bx_min = min(int(x0 / scale // block_size), n_blocks_x)
+    bx_max = min(int((x0 + tile_size) / scale // block_size) + 1, n_blocks_x)
+    for by in range(by_min, by_max):
+        start = block_start[by * n_blocks_x + bx_min]
+        stop = block_start[by * n_blocks_x + bx_max]
+        for k in order[start:stop]:
+            i = int(_np.floor(scale * y[k])) - y0
+            j = int(_np.floor(scale * x[k])) - x0
+            if 0 <= i < tile_size and 0 <= j < tile_size:
+                image[i, j] += 1
+    return image
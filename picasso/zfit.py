@@ -1,16 +1,16 @@
 import numpy as _np
 import numba as _numba
-import multiprocessing as _multiprocessing
 import concurrent.futures as _futures
-from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
-from scipy.optimize import minimize_scalar as _minimize_scalar
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
 from tqdm import tqdm as _tqdm
 import yaml as _yaml
-import matplotlib.pyplot as _plt
 from . import lib as _lib
 
 
-_plt.style.use("ggplot")
+# Number of z values in the lookup table of the calibration curves
+Z_TABLE_SIZE = 256
+# Half z range searched for calibrations that do not store their "Range"
+DEFAULT_Z_HALF_RANGE = 1000.0
 
 
 def nan_index(y):
@@ -73,6 +73,7 @@ def calibrate_z(locs, info, d, magnification_factor, path=None):
     calibration = {
         "X Coefficients": [float(_) for _ in cx],
         "Y Coefficients": [float(_) for _ in cy],
+        "Range": float(range),
     }
     if path is not None:
         with open(path, "w") as f:
@@ -81,90 +82,93 @@ def calibrate_z(locs, info, d, magnification_factor, path=None):
     locs = fit_z(locs, info, calibration, magnification_factor)
     locs.z /= magnification_factor
 
-    _plt.figure(figsize=(18, 10))
+    import matplotlib.pyplot as plt
 
-    _plt.subplot(231)
+    plt.style.use("ggplot")
+    plt.figure(figsize=(18, 10))
+
+    plt.subplot(231)
     # Plot this if calibration curve is fitted to each localization
-    # _plt.plot(true_z, locs.sx, '.', label='x', alpha=0.2)
-    # _plt.plot(true_z, locs.sy, '.', label='y', alpha=0.2)
-    # _plt.plot(true_z, _np.polyval(cx, true_z), '0.3', lw=1.5, label='x fit')
-    # _plt.plot(true_z, _np.polyval(cy, true_z), '0.3', lw=1.5, label='y fit')
-    _plt.plot(z_range, mean_sx, ".-", label="x")
-    _plt.plot(z_range, mean_sy, ".-", label="y")
-    _plt.plot(z_range, _np.polyval(cx, z_range), "0.3", lw=1.5, label="x fit")
-    _plt.plot(z_range, _np.polyval(cy, z_range), "0.3", lw=1.5, label="y fit")
-    _plt.xlabel("Stage position")
-    _plt.ylabel("Mean spot width/height")
-    _plt.xlim(z_range.min(), z_range.max())
-    _plt.legend(loc="best")
-
-    ax = _plt.subplot(232)
-    _plt.scatter(locs.sx, locs.sy, c="k", lw=0, alpha=0.1)
-    _plt.plot(
+    # plt.plot(true_z, locs.sx, '.', label='x', alpha=0.2)
+    # plt.plot(true_z, locs.sy, '.', label='y', alpha=0.2)
+    # plt.plot(true_z, _np.polyval(cx, true_z), '0.3', lw=1.5, label='x fit')
+    # plt.plot(true_z, _np.polyval(cy, true_z), '0.3', lw=1.5, label='y fit')
+    plt.plot(z_range, mean_sx, ".-", label="x")
+    plt.plot(z_range, mean_sy, ".-", label="y")
+    plt.plot(z_range, _np.polyval(cx, z_range), "0.3", lw=1.5, label="x fit")
+    plt.plot(z_range, _np.polyval(cy, z_range), "0.3", lw=1.5, label="y fit")
+    plt.xlabel("Stage position")
+    plt.ylabel("Mean spot width/height")
+    plt.xlim(z_range.min(), z_range.max())
+    plt.legend(loc="best")
+
+    ax = plt.subplot(232)
+    plt.scatter(locs.sx, locs.sy, c="k", lw=0, alpha=0.1)
+    plt.plot(
         _np.polyval(cx, z_range),
         _np.polyval(cy, z_range),
         lw=1.5,
         label="calibration from fit of mean width/height",
     )
-    _plt.plot()
+    plt.plot()
     ax.set_aspect("equal")
-    _plt.xlabel("Spot width")
-    _plt.ylabel("Spot height")
-    _plt.legend(loc="best")
-
-    _plt.subplot(233)
-    _plt.plot(locs.z, locs.sx, ".", label="x", alpha=0.2)
-    _plt.plot(locs.z, locs.sy, ".", label="y", alpha=0.2)
-    _plt.plot(
+    plt.xlabel("Spot width")
+    plt.ylabel("Spot height")
+    plt.legend(loc="best")
+
+    plt.subplot(233)
+    plt.plot(locs.z, locs.sx, ".", label="x", alpha=0.2)
+    plt.plot(locs.z, locs.sy, ".", label="y", alpha=0.2)
+    plt.plot(
         z_range, _np.polyval(cx, z_range), "0.3", lw=1.5, label="calibration"
     )
-    _plt.plot(z_range, _np.polyval(cy, z_range), "0.3", lw=1.5)
-    _plt.xlim(z_range.min(), z_range.max())
-    _plt.xlabel("Estimated z")
-    _plt.ylabel("Spot width/height")
-    _plt.legend(loc="best")
-
-    ax = _plt.subplot(234)
-    _plt.plot(z_range[locs.frame], locs.z, ".k", alpha=0.1)
-    _plt.plot(
+    plt.plot(z_range, _np.polyval(cy, z_range), "0.3", lw=1.5)
+    plt.xlim(z_range.min(), z_range.max())
+    plt.xlabel("Estimated z")
+    plt.ylabel("Spot width/height")
+    plt.legend(loc="best")
+
+    ax = plt.subplot(234)
+    plt.plot(z_range[locs.frame], locs.z, ".k", alpha=0.1)
+    plt.plot(
         [z_range.min(), z_range.max()],
         [z_range.min(), z_range.max()],
         lw=1.5,
         label="identity",
     )
-    _plt.xlim(z_range.min(), z_range.max())
-    _plt.ylim(z_range.min(), z_range.max())
+    plt.xlim(z_range.min(), z_range.max())
+    plt.ylim(z_range.min(), z_range.max())
     ax.set_aspect("equal")
-    _plt.xlabel("Stage position")
-    _plt.ylabel("Estimated z")
-    _plt.legend(loc="best")
+    plt.xlabel("Stage position")
+    plt.ylabel("Estimated z")
+    plt.legend(loc="best")
 
-    ax = _plt.subplot(235)
+    ax = plt.subplot(235)
     deviation = locs.z - z_range[locs.frame]
     bins = _lib.calculate_optimal_bins(deviation, max_n_bins=1000)
-    _plt.hist(deviation, bins)
-    _plt.xlabel("Deviation to true position")
-    _plt.ylabel("Occurence")
+    plt.hist(deviation, bins)
+    plt.xlabel("Deviation to true position")
+    plt.ylabel("Occurence")
 
-    ax = _plt.subplot(236)
+    ax = plt.subplot(236)
     square_deviation = deviation ** 2
     mean_square_deviation_frame = [
         _np.mean(square_deviation[locs.frame == _]) for _ in frame_range
     ]
     rmsd_frame = _np.sqrt(mean_square_deviation_frame)
-    _plt.plot(z_range, rmsd_frame, ".-", color="0.3")
-    _plt.xlim(z_range.min(), z_range.max())
-    _plt.gca().set_ylim(bottom=0)
-    _plt.xlabel("Stage position")
-    _plt.ylabel("Mean z precision")
+    plt.plot(z_range, rmsd_frame, ".-", color="0.3")
+    plt.xlim(z_range.min(), z_range.max())
+    plt.gca().set_ylim(bottom=0)
+    plt.xlabel("Stage position")
+    plt.ylabel("Mean z precision")
 
-    _plt.tight_layout(pad=2)
+    plt.tight_layout(pad=2)
 
     if path is not None:
         dirname = path[0:-5]
-        _plt.savefig(dirname + ".png", format='png', dpi=300)
+        plt.savefig(dirname + ".png", format='png', dpi=300)
 
-    _plt.show()
+    plt.show()
 
     export = False
     # Export
@@ -190,7 +194,7 @@ def calibrate_z(locs, info, d, magnification_factor, path=None):
     return calibration
 
 
-@_numba.jit(nopython=True, nogil=True)
+@_numba.jit(nopython=True, nogil=True, cache=True)
 def _fit_z_target(z, sx, sy, cx, cy):
     z2 = z * z
     z3 = z * z2
@@ -222,17 +226,101 @@ def _fit_z_target(z, sx, sy, cx, cy):
     # return (sx-wx)**2 + (sy-wy)**2
 
 
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _sqrt_width_derivatives(z, c):
+    """ Square root of the calibration width and its first two derivatives """
+    w = 0.0
+    dw = 0.0
+    d2w = 0.0
+    for k in range(7):
+        n = 6 - k
+        w += c[k] * z ** n
+        if n > 0:
+            dw += n * c[k] * z ** (n - 1)
+        if n > 1:
+            d2w += n * (n - 1) * c[k] * z ** (n - 2)
+    u = _np.sqrt(w)
+    du = dw / (2 * u)
+    d2u = d2w / (2 * u) - dw ** 2 / (4 * u ** 3)
+    return u, du, d2u
+
+
+@_numba.jit(nopython=True, nogil=True, cache=True)
+def _fit_z_table(sx, sy, cx, cy, z_table, z, square_d_zcalib, n_newton=4):
+    """
+    Minimizes _fit_z_target for each localization by a search in the lookup
+    table z_table, followed by Newton steps within the neighboring entries
+    """
+    n_table = len(z_table)
+    root_wx = _np.empty(n_table)
+    root_wy = _np.empty(n_table)
+    for k in range(n_table):
+        root_wx[k] = _sqrt_width_derivatives(z_table[k], cx)[0]
+        root_wy[k] = _sqrt_width_derivatives(z_table[k], cy)[0]
+    dz = z_table[1] - z_table[0]
+    for i in range(len(sx)):
+        root_sx = _np.sqrt(sx[i])
+        root_sy = _np.sqrt(sy[i])
+        best = -1
+        best_target = _np.inf
+        for k in range(n_table):
+            target = (root_sx - root_wx[k]) ** 2 + (root_sy - root_wy[k]) ** 2
+            if target < best_target:
+                best_target = target
+                best = k
+        if best < 0:
+            z[i] = _np.nan
+            square_d_zcalib[i] = _np.nan
+            continue
+        best_z = z_table[best]
+        lower = max(z_table[0], best_z - dz)
+        upper = min(z_table[-1], best_z + dz)
+        zi = best_z
+        for _ in range(n_newton):
+            u, du, d2u = _sqrt_width_derivatives(zi, cx)
+            v, dv, d2v = _sqrt_width_derivatives(zi, cy)
+            d_target = -2 * (root_sx - u) * du - 2 * (root_sy - v) * dv
+            d2_target = (
+                2 * du ** 2
+                - 2 * (root_sx - u) * d2u
+                + 2 * dv ** 2
+                - 2 * (root_sy - v) * d2v
+            )
+            if not d2_target > 0:
+                break
+            zi = min(max(zi - d_target / d2_target, lower), upper)
+            target = _fit_z_target(zi, sx[i], sy[i], cx, cy)
+            if target < best_target:
+                best_target = target
+                best_z = zi
+        z[i] = best_z
+        square_d_zcalib[i] = best_target
+
+
+def _z_table(calibration, cx, cy):
+    """
+    z values at which the calibration curves are tabulated: the range around
+    zero in which both widths are positive, within twice the calibrated
+    range (or DEFAULT_Z_HALF_RANGE for calibrations without a range)
+    """
+    half_range = calibration.get("Range", DEFAULT_Z_HALF_RANGE)
+    z = _np.linspace(-half_range, half_range, 2 * Z_TABLE_SIZE + 1)
+    positive = (_np.polyval(cx, z) > 0) & (_np.polyval(cy, z) > 0)
+    lower = upper = Z_TABLE_SIZE
+    while lower > 0 and positive[lower - 1]:
+        lower -= 1
+    while upper < len(z) - 1 and positive[upper + 1]:
+        upper += 1
+    return _np.linspace(z[lower], z[upper], Z_TABLE_SIZE)
+
+
 def fit_z(locs, info, calibration, magnification_factor, filter=2):
     cx = _np.array(calibration["X Coefficients"])
     cy = _np.array(calibration["Y Coefficients"])
     z = _np.zeros_like(locs.x)
     square_d_zcalib = _np.zeros_like(z)
-    sx = locs.sx
-    sy = locs.sy
-    for i in range(len(z)):
-        result = _minimize_scalar(_fit_z_target, args=(sx[i], sy[i], cx, cy))
-        z[i] = result.x
-        square_d_zcalib[i] = result.fun
+    z_table = _z_table(calibration, cx, cy)
+    _fit_z_table(locs.sx, locs.sy, cx, cy, z_table, z, square_d_zcalib)
     z *= magnification_factor
     locs = _lib.append_to_rec(locs, z, "z")
     locs = _lib.append_to_rec(locs, _np.sqrt(square_d_zcalib), "d_zcalib")
@@ -243,7 +331,7 @@ def fit_z(locs, info, calibration, magnification_factor, filter=2):
 def fit_z_parallel(
     locs, info, calibration, magnification_factor, filter=2, asynch=False
 ):
-    n_workers = max(1, int(0.75 * _multiprocessing.cpu_count()))
+    n_workers = _lib.n_workers()
     n_locs = len(locs)
     n_tasks = 100 * n_workers
     spots_per_task = [
@@ -254,7 +342,7 @@ def fit_z_parallel(
     ]
     start_indices = _np.cumsum([0] + spots_per_task[:-1])
     fs = []
-    executor = _ProcessPoolExecutor(n_workers)
+    executor = _ThreadPoolExecutor(n_workers)
     for i, n_locs_task in zip(start_indices, spots_per_task):
         fs.append(
             executor.submit(
@@ -266,6 +354,7 @@ def fit_z_parallel(
                 filter=0,
             )
         )
+    executor.shutdown(wait=False)
     if asynch:
         return fs
     with _tqdm(total=n_tasks, unit="task") as progress_bar:
@@ -0,0 +1,140 @@
+"""
+Some rudimentary tests.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+
+import h5py
+import numpy as np
+import yaml
+
+from picasso import batch, io
+
+
+def test_split_cores():
+    assert batch.split_cores(1, 8) == (1, 8)
+    assert batch.split_cores(3, 8) == (3, 2)
+    assert batch.split_cores(20, 8) == (8, 1)
+    assert batch.split_cores(0, 8) == (1, 8)
+
+
+def test_density_files():
+    """
+    Test that the density command processes files in parallel worker
+    processes, gives the same locs as in this process and that a broken
+    file fails on its own
+    """
+    random = np.random.RandomState(0)
+    info = [{"Width": 32, "Height": 32, "Frames": 100}]
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [
+            os.path.join(directory, "{}.hdf5".format(i)) for i in range(3)
+        ]
+        for path in paths:
+            N = 2000
+            locs = np.rec.array(
+                (
+                    np.sort(random.randint(0, 100, N)).astype("u4"),
+                    random.uniform(0, 32, N),
+                    random.uniform(0, 32, N),
+                    random.uniform(0.01, 0.1, N),
+                    random.uniform(0.01, 0.1, N),
+                ),
+                dtype=[
+                    ("frame", "u4"),
+                    ("x", "f4"),
+                    ("y", "f4"),
+                    ("lpx", "f4"),
+                    ("lpy", "f4"),
+                ],
+            )
+            io.save_locs(path, locs, info)
+        broken = os.path.join(directory, "3.hdf5")
+        with open(broken, "w") as f:
+            f.write("not a locs file")
+        summary = os.path.join(directory, "summary.yaml")
+        returncode = subprocess.run(
+            [
+                sys.executable, "-m", "picasso", "--cores", "2",
+                "--summary", summary,
+                "density", os.path.join(directory, "?.hdf5"), "1.0",
+            ],
+        ).returncode
+        assert returncode == 1
+        with open(summary) as f:
+            results = yaml.safe_load(f)
+        status = {os.path.basename(_["Path"]): _["Status"] for _ in results}
+        assert status == {
+            "0.hdf5": "Done",
+            "1.hdf5": "Done",
+            "2.hdf5": "Done",
+            "3.hdf5": "Failed",
+        }
+        from picasso import postprocess
+
+        for path in paths:
+            locs, info = io.load_locs(path)
+            expected = postprocess.compute_local_density(locs, info, 1.0)
+            base, ext = os.path.splitext(path)
+            density, _ = io.load_locs(base + "_density.hdf5")
+            assert np.array_equal(density, expected)
+        subprocess.run(
+            [
+                sys.executable, "-m", "picasso", "density", "--indexed",
+                paths[0], "1.0",
+            ],
+            check=True,
+        )
+        base, ext = os.path.splitext(paths[0])
+        with h5py.File(base + "_density.hdf5", "r") as locs_file:
+            assert "index" in locs_file
+        locs, info = io.load_locs(paths[0])
+        density, _ = io.load_locs(base + "_density.hdf5")
+        assert np.array_equal(density.frame, locs.frame)
+
+
+def test_locs_glob_map():
+    """
+    Test that locs_glob_map calls closures in this process by default and
+    raises their exceptions
+    """
+    from picasso import lib
+
+    locs = np.rec.array(
+        (
+            np.arange(10, dtype="u4"),
+            np.ones(10),
+            np.ones(10),
+            np.full(10, 0.1),
+            np.full(10, 0.1),
+        ),
+        dtype=[
+            ("frame", "u4"),
+            ("x", "f4"),
+            ("y", "f4"),
+            ("lpx", "f4"),
+            ("lpy", "f4"),
+        ],
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "locs.hdf5")
+        io.save_locs(path, locs, [{"Width": 2, "Height": 2}])
+        n_locs = []
+        lib.locs_glob_map(
+            lambda locs, info, path: n_locs.append(len(locs)),
+            os.path.join(directory, "*.hdf5"),
+        )
+        assert n_locs == [10]
+
+        def fail(locs, info, path):
+            raise ValueError(path)
+
+        try:
+            lib.locs_glob_map(fail, path)
+        except ValueError:
+            pass
+        else:
+            assert False
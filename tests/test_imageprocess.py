@@ -0,0 +1,32 @@
+"""
+Some rudimentary tests.
+"""
+
+import numpy as np
+
+from picasso import imageprocess
+
+
+def test_rcc():
+    """ Recover known subpixel shifts of a random pattern of spots """
+    random = np.random.RandomState(0)
+    size = 96
+    spots = random.uniform(10, size - 10, (100, 2))
+    y, x = np.mgrid[:size, :size] + 0.5
+    true_shifts = np.array([[0, 0], [0.3, -1.2], [2.6, 0.8], [-1.7, -2.4]])
+    segments = []
+    for dy, dx in true_shifts:
+        segment = np.zeros((size, size))
+        for sy, sx in spots:
+            segment += np.exp(
+                -((y - sy - dy) ** 2 + (x - sx - dx) ** 2) / (2 * 1.5 ** 2)
+            )
+        segments.append(segment)
+    progress = []
+    for max_shift in [None, 32]:
+        shift_y, shift_x = imageprocess.rcc(
+            np.array(segments), max_shift, progress.append
+        )
+        assert np.allclose(shift_y, true_shifts[:, 0], atol=0.05)
+        assert np.allclose(shift_x, true_shifts[:, 1], atol=0.05)
+        assert progress[0] == 0 and progress[-1] == 6
@@ -0,0 +1,303 @@
+"""
+Some rudimentary tests.
+"""
+
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from picasso import io
+
+
+def _locs(N, random):
+    return np.rec.array(
+        (
+            np.sort(random.randint(0, 1000, N)).astype("u4"),
+            random.uniform(0, 128, N),
+            random.uniform(0, 96, N),
+            random.uniform(100, 1000, N),
+            random.uniform(0.01, 0.1, N),
+            random.uniform(0.01, 0.1, N),
+        ),
+        dtype=[
+            ("frame", "u4"),
+            ("x", "f4"),
+            ("y", "f4"),
+            ("photons", "f4"),
+            ("lpx", "f4"),
+            ("lpy", "f4"),
+        ],
+    )
+
+
+def test_load_locs_selection():
+    """
+    Partial reads of plain and indexed locs files against filtering all
+    locs in memory
+    """
+    random = np.random.RandomState(0)
+    locs = _locs(50000, random)
+    info = [{"Height": 96, "Width": 128, "Frames": 1000}]
+    selections = [
+        (None, None, None),
+        ([(10.5, 20), (40, 90.2)], None, None),
+        (None, (100, 234), ["x", "y"]),
+        ([(50, 100), (200, 200)], (900, 2000), ["photons", "frame"]),
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "locs.hdf5")
+        for kwargs in [{}, {"indexed": True, "compression": "gzip"}]:
+            io.save_locs(path, locs, info, **kwargs)
+            for viewport, frames, fields in selections:
+                selected, _ = io.load_locs(
+                    path, viewport=viewport, frames=frames, fields=fields
+                )
+                in_selection = np.ones(len(locs), dtype=bool)
+                if viewport is not None:
+                    (y_min, x_min), (y_max, x_max) = viewport
+                    in_selection &= (locs.x >= x_min) & (locs.x < x_max)
+                    in_selection &= (locs.y >= y_min) & (locs.y < y_max)
+                if frames is not None:
+                    in_selection &= (locs.frame >= frames[0]) & (
+                        locs.frame < frames[1]
+                    )
+                reference = locs[in_selection]
+                if fields is None:
+                    fields = list(locs.dtype.names)
+                assert list(selected.dtype.names) == fields
+                assert len(selected) == len(reference)
+                for name in fields:
+                    # Indexed files store the locs in a different order
+                    assert np.array_equal(
+                        np.sort(selected[name]), np.sort(reference[name])
+                    )
+                if "frame" in fields:
+                    # but are loaded in the order of frames
+                    assert np.array_equal(selected.frame, reference.frame)
+
+
+def test_load_locs_fields():
+    """ Selected columns of plain and compressed locs files """
+    random = np.random.RandomState(0)
+    locs = _locs(10000, random)
+    info = [{"Height": 96, "Width": 128, "Frames": 1000}]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "locs.hdf5")
+        for kwargs in [{}, {"compression": "gzip"}]:
+            io.save_locs(path, locs, info, **kwargs)
+            selected, _ = io.load_locs(path, fields=["y", "x"])
+            assert isinstance(selected, np.recarray)
+            assert selected.dtype.names == ("y", "x")
+            assert np.array_equal(selected.y, locs.y)
+            assert np.array_equal(selected.x, locs.x)
+            try:
+                io.load_locs(path, fields=["x", "group"])
+            except ValueError:
+                pass
+            else:
+                assert False
+
+
+def test_lazy_locs():
+    """
+    Columns read on access, from a memory map, compressed chunks or an
+    indexed file
+    """
+    random = np.random.RandomState(0)
+    locs = _locs(10000, random)
+    info = [{"Height": 96, "Width": 128, "Frames": 1000}]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "locs.hdf5")
+        for kwargs in [{}, {"compression": "gzip"}, {"indexed": True}]:
+            io.save_locs(path, locs, info, **kwargs)
+            reference, _ = io.load_locs(path)
+            lazy_locs, _ = io.load_locs(path, lazy=True)
+            assert isinstance(lazy_locs, io.LazyLocs)
+            assert len(lazy_locs) == len(locs)
+            assert lazy_locs.dtype == locs.dtype
+            assert np.array_equal(lazy_locs.x, reference.x)
+            assert np.array_equal(lazy_locs["frame"], locs.frame)
+            assert not hasattr(lazy_locs, "group")
+            # Changes to read columns carry over to the recarray
+            lazy_locs.x -= 1
+            in_frames = reference.frame < 100
+            selected = lazy_locs[lazy_locs.frame < 100]
+            assert isinstance(selected, np.recarray)
+            assert np.array_equal(selected.x, reference.x[in_frames] - 1)
+            assert np.array_equal(selected.y, reference.y[in_frames])
+            lazy_locs, _ = io.load_locs(path, lazy=True, fields=["y", "x"])
+            assert lazy_locs.dtype.names == ("y", "x")
+            assert np.array_equal(lazy_locs.to_recarray().y, reference.y)
+
+
+def test_locs_writer(monkeypatch):
+    """
+    Streaming locs in chunks to a LocsWriter against a stable sort in
+    memory, for locs in and out of frame order, sorted in memory and in
+    merged runs
+    """
+    random = np.random.RandomState(0)
+    locs = _locs(50000, random)
+    info = [{"Height": 96, "Width": 128, "Frames": 1000}]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "locs.hdf5")
+        out_path = os.path.join(tmp_dir, "locs_out.hdf5")
+        for order, run_rows in [
+            (np.arange(len(locs)), 2 ** 20),
+            (random.permutation(len(locs)), 2 ** 20),
+            (random.permutation(len(locs)), 7000),
+            (np.argsort(random.randint(0, 50, len(locs))), 999),
+        ]:
+            monkeypatch.setattr(io, "LOCS_STREAM_ROWS", run_rows)
+            io.save_locs(path, locs[order], info)
+            chunks = io.iter_locs(path, chunk_rows=4096)
+            with io.LocsWriter(out_path, locs.dtype, info) as writer:
+                for chunk in chunks:
+                    assert len(chunk) <= 4096
+                    writer.append(chunk)
+            streamed, _ = io.load_locs(out_path)
+            reference = locs[order]
+            reference = reference[np.argsort(reference.frame, kind="stable")]
+            assert np.array_equal(streamed, reference)
+            # The sorted runs are removed
+            assert sorted(os.listdir(tmp_dir)) == [
+                "locs.hdf5", "locs.yaml", "locs_out.hdf5", "locs_out.yaml"
+            ]
+
+
+def _write_tif(path, movie, byte_order="<", compression=1, gaps=None):
+    """
+    Writes a minimal TIFF with one strip per frame, each following its
+    IFD and the given number of gap bytes
+    """
+    n_frames, height, width = movie.shape
+    if gaps is None:
+        gaps = [0] * n_frames
+    data = movie.astype(byte_order + movie.dtype.str[1:])
+    n_entries = 6
+    ifd_bytes = 2 + 12 * n_entries + 4
+    with open(path, "wb") as f:
+        f.write({"<": b"II", ">": b"MM"}[byte_order])
+        f.write(struct.pack(byte_order + "HL", 42, 8))
+        offset = 8
+        for i, frame in enumerate(data):
+            image_offset = offset + ifd_bytes
+            next_offset = image_offset + frame.nbytes + gaps[i]
+            entries = [
+                (256, 3, width),
+                (257, 3, height),
+                (258, 3, 8 * movie.dtype.itemsize),
+                (259, 3, compression),
+                (273, 4, image_offset),
+                (279, 4, frame.nbytes),
+            ]
+            f.write(struct.pack(byte_order + "H", n_entries))
+            for tag, type, value in entries:
+                if type == 3:
+                    entry = struct.pack(
+                        byte_order + "HHLHH", tag, 3, 1, value, 0
+                    )
+                else:
+                    entry = struct.pack(byte_order + "HHLL", tag, 4, 1, value)
+                f.write(entry)
+            last = i == n_frames - 1
+            f.write(struct.pack(byte_order + "L", 0 if last else next_offset))
+            f.write(frame.tobytes())
+            f.write(b"\0" * gaps[i])
+            offset = next_offset
+
+
+def test_tif_memmap():
+    """
+    Memory mapped TIFF frames and stacks against reading each frame, and
+    the layouts that fall back to reading frames
+    """
+    random = np.random.RandomState(0)
+    movie = random.randint(0, 2 ** 16, (12, 9, 11)).astype(np.uint16)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "movie.ome.tif")
+        for gap in [0, 6]:
+            _write_tif(path, movie, gaps=[gap] * len(movie))
+            with io.TiffMap(path) as tif:
+                memmap = tif.memmap()
+                assert memmap is not None
+                for i in range(len(movie)):
+                    assert np.array_equal(memmap[i], tif.get_frame(i))
+                assert np.array_equal(memmap, movie)
+            loaded, info = io.load_tif(path)
+            assert isinstance(loaded, np.ndarray)
+            assert np.array_equal(loaded, movie)
+            assert info[0]["Frames"] == len(movie)
+        for kwargs in [
+            {"compression": 5},
+            {"byte_order": ">"},
+            {"gaps": random.randint(0, 4, len(movie))},
+        ]:
+            _write_tif(path, movie, **kwargs)
+            with io.TiffMap(path) as tif:
+                assert tif.memmap() is None
+                assert np.array_equal(tif[:], movie)
+            loaded, info = io.load_tif(path)
+            assert loaded.memmaps is None
+            assert np.array_equal(loaded[:], movie)
+            loaded.close()
+
+
+def test_tif_multi_memmap():
+    """
+    Stacks and spots of memory mapped multi-file TIFF movies against
+    reading each frame
+    """
+    from picasso import localize
+
+    random = np.random.RandomState(0)
+    movie = random.randint(0, 2 ** 16, (30, 16, 20)).astype(np.uint16)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [
+            os.path.join(tmp_dir, name)
+            for name in [
+                "movie.ome.tif", "movie_1.ome.tif", "movie_2.ome.tif"
+            ]
+        ]
+        for path, frames in zip(paths, np.split(movie, [10, 22])):
+            _write_tif(path, frames, gaps=[4] * len(frames))
+        loaded, info = io.load_tif(paths[0])
+        assert loaded.memmaps is not None
+        assert info[0]["Frames"] == len(movie)
+        with io.TiffMultiMap(paths[0]) as frames:
+            assert frames.memmaps is None
+            for i in range(len(movie)):
+                assert np.array_equal(
+                    loaded.get_frame(i), frames.get_frame(i)
+                )
+            for indices in [
+                range(0, 30),
+                range(3, 8),
+                range(8, 15),
+                range(5, 29, 3),
+                range(29, 2, -2),
+                range(4, 4),
+            ]:
+                stack = loaded.get_stack(indices)
+                assert np.array_equal(stack, frames.get_stack(indices))
+                assert len(stack) == len(indices)
+                if len(indices) > 0:
+                    assert np.array_equal(stack, movie[list(indices)])
+            # A stack within one file is a view into its memory map
+            assert np.shares_memory(
+                loaded.get_stack(range(12, 20)), loaded.memmaps[1]
+            )
+            ids = np.rec.array(
+                (
+                    np.sort(random.randint(0, 30, 200)),
+                    random.randint(3, 17, 200),
+                    random.randint(3, 13, 200),
+                ),
+                dtype=[("frame", "i"), ("x", "i"), ("y", "i")],
+            )
+            spots = localize._cut_spots(loaded, ids, 7)
+            assert np.array_equal(spots, localize._cut_spots(frames, ids, 7))
+            assert np.array_equal(spots, localize._cut_spots(movie, ids, 7))
+        loaded.close()
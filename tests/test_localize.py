@@ -27,7 +27,281 @@ def test_localize():
     args.gain = 1
     args.qe = 1
     args.drift = 100
+    args.chunk_frames = 0
 
     for fit_method in ["mle"]:
         args.fit_method = fit_method
         main._localize(args)
+
+
+def test_cli_help():
+    """
+    Test that the command line parser, including warmup, can be built
+    """
+    import subprocess
+    import sys
+
+    output = subprocess.run(
+        [sys.executable, "-m", "picasso", "--help"],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    assert "warmup" in output
+
+
+def test_localize_chunked():
+    """
+    Test that chunked localization gives the same locs as fitting
+    all identifications at once
+    """
+    import numpy as np
+    from picasso import io, localize, gaussmle
+
+    movie, info = io.load_movie("./tests/data/testdata.raw")
+    movie = movie[:100]
+    camera_info = {"baseline": 0, "sensitivity": 1, "gain": 1, "qe": 1}
+    box = 7
+    current, futures = localize.identify_async(movie, 5000, box)
+    ids = localize.identifications_from_futures(futures)
+    locs = localize.fit(movie, camera_info, ids, box)
+
+    def fit_chunk(ids, spots):
+        thetas, CRLBs, likelihoods, iterations = gaussmle.gaussmle_parallel(
+            spots, 0.001, 100
+        )
+        return localize.locs_from_fits(
+            ids, thetas, CRLBs, likelihoods, iterations, box
+        )
+
+    chunked_locs = localize.localize_chunked(
+        movie, camera_info, 5000, box, fit_chunk, chunk_frames=32
+    )
+    assert len(locs) > 0
+    assert locs.dtype == chunked_locs.dtype
+    for name in locs.dtype.names:
+        assert np.array_equal(locs[name], chunked_locs[name], equal_nan=True)
+
+
+def test_localize_chunked_stops():
+    """
+    Test chunked localization of an empty movie and that the reading
+    thread stops when the fit fails
+    """
+    import threading
+    from picasso import io, localize, gaussmle
+
+    movie, info = io.load_movie("./tests/data/testdata.raw")
+    camera_info = {"baseline": 0, "sensitivity": 1, "gain": 1, "qe": 1}
+    box = 7
+
+    def fit_chunk(ids, spots):
+        thetas, CRLBs, likelihoods, iterations = gaussmle.gaussmle_parallel(
+            spots, 0.001, 100
+        )
+        return localize.locs_from_fits(
+            ids, thetas, CRLBs, likelihoods, iterations, box
+        )
+
+    locs = localize.localize_chunked(
+        movie[:0], camera_info, 5000, box, fit_chunk
+    )
+    assert len(locs) == 0
+    assert "photons" in locs.dtype.names
+
+    def fail(ids, spots):
+        raise ValueError("fit failed")
+
+    try:
+        localize.localize_chunked(
+            movie, camera_info, 5000, box, fail, chunk_frames=8
+        )
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert not any(
+        "_chunk_producer" in thread.name for thread in threading.enumerate()
+    )
+
+
+def test_gaussmle_ranges(monkeypatch):
+    """
+    Test that fitting contiguous ranges of spots in parallel gives the same
+    result as fitting the spots one by one
+    """
+    import numpy as np
+    from picasso import io, localize, gaussmle
+
+    monkeypatch.setenv("PICASSO_THREADS", "4")
+    monkeypatch.setattr(gaussmle, "MAX_RANGE", 16)
+    movie, info = io.load_movie("./tests/data/testdata.raw")
+    camera_info = {"baseline": 0, "sensitivity": 1, "gain": 1, "qe": 1}
+    current, futures = localize.identify_async(movie, 5000, 7)
+    ids = localize.identifications_from_futures(futures)
+    spots = localize.get_spots(movie, ids, 7, camera_info)
+    N = len(spots)
+    assert N > 100
+    thetas = np.zeros((N, 6), dtype=np.float32)
+    CRLBs = np.inf * np.ones((N, 6), dtype=np.float32)
+    likelihoods = np.zeros(N, dtype=np.float32)
+    iterations = np.zeros(N, dtype=np.int32)
+    for index in range(N):
+        gaussmle._mlefit_sigma(
+            spots, index, thetas, CRLBs, likelihoods, iterations, 0.001, 100
+        )
+    expected = thetas, CRLBs, likelihoods, iterations
+    results = [
+        gaussmle.gaussmle(spots, 0.001, 100, method="sigma"),
+        gaussmle.gaussmle_parallel(spots, 0.001, 100, method="sigma"),
+    ]
+    current, *result, fs = gaussmle._gaussmle_submit(
+        spots, 0.001, 100, "sigma"
+    )
+    assert len(fs) == 4
+    for f in fs:
+        f.result()
+    assert current[0] == N
+    results.append(result)
+    for result in results:
+        for a, b in zip(expected, result):
+            assert np.array_equal(a, b, equal_nan=True)
+
+
+def test_big_endian_raw():
+    """
+    Test that a big endian raw movie stays memory mapped and gives the same
+    spots as its little endian original
+    """
+    import os
+    import tempfile
+    import numpy as np
+    from picasso import io, localize
+
+    movie, info = io.load_movie("./tests/data/testdata.raw")
+    movie = movie[:100]
+    box = 7
+    ids = localize.identify(movie, 5000, box)
+    camera_info = {"baseline": 0, "sensitivity": 1, "gain": 1, "qe": 1}
+    spots = localize.get_spots(movie, ids, box, camera_info)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "movie.raw")
+        big_info = [dict(info[0], Frames=len(movie))]
+        big_info[0]["Byte Order"] = ">"
+        io.save_raw(path, movie.astype(">u2"), big_info)
+        big_movie, big_info = io.load_movie(path)
+        assert isinstance(big_movie, np.memmap)
+        assert big_movie.dtype == np.dtype(">u2")
+        assert np.array_equal(big_movie, movie)
+        big_ids = localize.identify(big_movie, 5000, box)
+        assert np.array_equal(ids, big_ids)
+        big_spots = localize.get_spots(big_movie, big_ids, box, camera_info)
+        assert np.array_equal(spots, big_spots)
+        chunked_ids = localize.identify_in_frames(big_movie, 5000, box)
+        assert np.array_equal(
+            localize._cut_spots(big_movie, chunked_ids, box),
+            localize._cut_spots(movie, chunked_ids, box),
+        )
+        del big_movie
+
+
+def test_identify_in_frames():
+    """
+    Test that the batched identification gives the same spots as
+    identifying frame by frame
+    """
+    import numpy as np
+    from picasso import io, localize
+
+    movie, info = io.load_movie("./tests/data/testdata.raw")
+    random_movie = np.random.RandomState(0).randint(0, 100, (10, 45, 41))
+    for frames, minimum_ng, box in [
+        (movie[:100], 5000, 7),
+        (random_movie.astype("u2"), -1e9, 5),
+    ]:
+        ids = np.hstack(
+            [
+                localize.identify_by_frame_number(frames, minimum_ng, box, i)
+                for i in range(len(frames))
+            ]
+        )
+        batch_ids = localize.identify_in_frames(frames, minimum_ng, box)
+        assert len(ids) > 0
+        assert ids.dtype == batch_ids.dtype
+        for name in ids.dtype.names:
+            assert np.array_equal(ids[name], batch_ids[name])
+
+
+def test_gausslq_fit_spots():
+    """
+    Test that the batched least squares fits agree with scipy's leastsq
+    """
+    import numpy as np
+    from picasso import io, localize, gausslq
+
+    movie, info = io.load_movie("./tests/data/testdata.raw")
+    camera_info = {"baseline": 0, "sensitivity": 1, "gain": 1, "qe": 1}
+    ids = localize.identify(movie[:200], 5000, 7)
+    spots = localize.get_spots(movie, ids, 7, camera_info)
+    theta = gausslq.fit_spots_parallel(spots)
+    reference = np.array([gausslq.fit_spot(spot) for spot in spots])
+    assert len(spots) > 0
+    xy_sigma = [0, 1, 4, 5]
+    assert np.allclose(theta[:, xy_sigma], reference[:, xy_sigma], atol=0.02)
+    assert np.allclose(theta[:, 2:4], reference[:, 2:4], rtol=0.01, atol=1)
+
+
+def test_fit_z():
+    """
+    Test that the lookup table z fit finds the minima of _fit_z_target
+    """
+    import numpy as np
+    from scipy.optimize import minimize_scalar
+    from picasso import zfit
+
+    z_range = np.linspace(-600, 600, 121)
+    cx = np.polyfit(z_range, np.sqrt(1 + ((z_range - 250) / 400) ** 2), 6)
+    cy = np.polyfit(z_range, np.sqrt(1 + ((z_range + 250) / 400) ** 2), 6)
+    random = np.random.RandomState(0)
+    true_z = random.uniform(-500, 500, 200)
+    sx = np.polyval(cx, true_z) * random.normal(1, 0.05, len(true_z))
+    sy = np.polyval(cy, true_z) * random.normal(1, 0.05, len(true_z))
+    z = np.zeros(len(true_z))
+    square_d_zcalib = np.zeros(len(true_z))
+    z_table = zfit._z_table({"Range": 1200.0}, cx, cy)
+    zfit._fit_z_table(sx, sy, cx, cy, z_table, z, square_d_zcalib)
+    for i in range(len(true_z)):
+        result = minimize_scalar(
+            zfit._fit_z_target, args=(sx[i], sy[i], cx, cy)
+        )
+        if np.isfinite(result.fun):
+            assert abs(z[i] - result.x) < 0.5
+            assert np.isclose(square_d_zcalib[i], result.fun, atol=1e-9)
+
+
+def test_import_time():
+    """
+    Test that the computational modules import quickly and without GUI or
+    plotting libraries
+    """
+    import subprocess
+    import sys
+
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import picasso.localize\n"
+        "print(time.perf_counter() - start)\n"
+        "import picasso.postprocess, picasso.zfit, picasso.gausslq\n"
+        "print(' '.join(sorted(sys.modules)))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.splitlines()
+    modules = output[1].split()
+    for gui_module in ["PyQt5", "matplotlib", "lmfit"]:
+        assert gui_module not in modules
+    assert float(output[0]) < 2.0
@@ -0,0 +1,28 @@
+"""
+Some rudimentary tests.
+"""
+
+import numpy as np
+from scipy.spatial import distance
+
+from picasso import neighbors
+
+
+def test_neighbors():
+    """ Neighbor queries against all pairwise distances """
+    random = np.random.RandomState(0)
+    points = random.uniform(0, 10, (2000, 2))
+    # Points at the same position
+    points[1] = points[2] = points[0]
+    d = distance.cdist(points, points)
+    np.fill_diagonal(d, np.inf)
+    distances, indices = neighbors.kneighbors(points, 3)
+    assert np.allclose(distances, np.sort(d, axis=1)[:, :3])
+    assert np.all(indices != np.arange(len(points))[:, np.newaxis])
+    index = neighbors.Neighbors(points)
+    d_distinct = np.where(d == 0, np.inf, d)
+    assert np.allclose(index.nearest_distinct(), d_distinct.min(axis=1))
+    # Labels of large regions, such that many neighbors share a label
+    labels = np.int32(points[:, 0] > 3) + 2 * np.int32(points[:, 1] > 8)
+    d[labels[:, np.newaxis] == labels] = np.inf
+    assert np.allclose(index.nearest_other(labels), d.min(axis=1))
@@ -0,0 +1,270 @@
+"""
+Some rudimentary tests.
+"""
+
+import numba
+import numpy as np
+
+from picasso import postprocess
+
+
+def _dark_times_quadratic(frame, last_frame, group):
+    """ The previous O(N^2) implementation of postprocess._dark_times """
+    N = len(frame)
+    max_frame = frame.max()
+    dark = max_frame * np.ones(N, dtype=np.int32)
+    for i in range(N):
+        for j in range(N):
+            if (group[i] == group[j]) and (i != j):
+                dark_ij = frame[i] - last_frame[j]
+                if (dark_ij > 0) and (dark_ij < dark[i]):
+                    dark[i] = dark_ij
+    dark[dark == max_frame] = -1
+    return dark
+
+
+def test_dark_times():
+    """
+    Test dark times against the previous implementation, including
+    overlapping events
+    """
+    random = np.random.RandomState(0)
+    for N, n_frames, n_groups in [(1, 10, 1), (50, 100, 1), (300, 500, 7)]:
+        locs = np.rec.array(
+            (
+                np.sort(random.randint(0, n_frames, N)),
+                random.randint(1, 20, N),
+                random.randint(0, n_groups, N),
+            ),
+            dtype=[("frame", "u4"), ("len", "i4"), ("group", "i4")],
+        )
+        last_frame = locs.frame + locs.len - 1
+        dark = postprocess.dark_times(locs)
+        reference = _dark_times_quadratic(
+            locs.frame.astype(np.int64), last_frame, locs.group
+        )
+        assert np.array_equal(dark, reference)
+        dark = postprocess.dark_times(locs, np.zeros(N))
+        reference = _dark_times_quadratic(
+            locs.frame.astype(np.int64), last_frame, np.zeros(N)
+        )
+        assert np.array_equal(dark, reference)
+
+
+@numba.jit(nopython=True)
+def _next_in_link_group(
+    current_index, link_group, N, frame, x, y, d_max, max_dark_time, group
+):
+    """ The previous per-loc search of postprocess.get_link_groups """
+    current_frame = frame[current_index]
+    current_x = x[current_index]
+    current_y = y[current_index]
+    current_group = group[current_index]
+    min_frame = current_frame + 1
+    for min_index in range(current_index + 1, N):
+        if frame[min_index] >= min_frame:
+            break
+    max_frame = current_frame + max_dark_time + 1
+    for max_index in range(min_index, N):
+        if frame[max_index] > max_frame:
+            break
+    else:
+        max_index = N
+    d_max_2 = d_max ** 2
+    for j in range(min_index, max_index):
+        if group[j] == current_group:
+            if link_group[j] == -1:
+                dx2 = (current_x - x[j]) ** 2
+                if dx2 <= d_max_2:
+                    dy2 = (current_y - y[j]) ** 2
+                    if dy2 <= d_max_2:
+                        if np.sqrt(dx2 + dy2) <= d_max:
+                            return j
+    return -1
+
+
+@numba.jit(nopython=True)
+def _link_groups_reference(frame, x, y, d_max, max_dark_time, group):
+    """ The previous implementation of postprocess.get_link_groups """
+    N = len(x)
+    link_group = -np.ones(N, dtype=np.int32)
+    current_link_group = -1
+    for i in range(N):
+        if link_group[i] == -1:
+            current_link_group += 1
+            link_group[i] = current_link_group
+            j = _next_in_link_group(
+                i, link_group, N, frame, x, y, d_max, max_dark_time, group
+            )
+            while j != -1:
+                link_group[j] = current_link_group
+                j = _next_in_link_group(
+                    j, link_group, N, frame, x, y, d_max, max_dark_time, group
+                )
+    return link_group
+
+
+def test_link_groups():
+    """
+    Test link groups against the previous implementation, including locs
+    in the last frame and the last loc, which it could link backwards
+    """
+    random = np.random.RandomState(0)
+    for trial in range(300):
+        N = random.randint(1, 200)
+        n_frames = random.randint(1, 30)
+        size = random.uniform(1, 10)
+        locs = np.rec.array(
+            (
+                np.sort(random.randint(0, n_frames, N)).astype("u4"),
+                random.uniform(0, size, N).astype("f4"),
+                random.uniform(0, size, N).astype("f4"),
+            ),
+            dtype=[("frame", "u4"), ("x", "f4"), ("y", "f4")],
+        )
+        group = random.randint(0, random.randint(1, 4), N).astype(np.int32)
+        d_max = random.choice([0.0, 0.5, 1.0, 3.0])
+        max_dark_time = random.randint(0, 4)
+        link_group = postprocess.get_link_groups(
+            locs, d_max, max_dark_time, group
+        )
+        reference = _link_groups_reference(
+            locs.frame.astype(np.int64),
+            locs.x,
+            locs.y,
+            d_max,
+            max_dark_time,
+            group,
+        )
+        assert np.array_equal(link_group, reference)
+
+
+def test_groups():
+    """
+    Test grouped reductions against evaluating each group separately
+    """
+    from picasso import grouping
+
+    random = np.random.RandomState(0)
+    group = random.randint(0, 20, 1000)
+    values = random.rand(1000).astype(np.float32)
+    weights = random.rand(1000)
+    groups = grouping.Groups(group)
+    assert np.array_equal(groups.ids[0], np.unique(group))
+    for i, group_id in enumerate(groups.ids[0]):
+        in_group = group == group_id
+        assert groups.count()[i] == in_group.sum()
+        assert np.isclose(groups.mean(values)[i], values[in_group].mean())
+        assert np.isclose(groups.std(values)[i], values[in_group].std())
+        assert groups.min(values)[i] == values[in_group].min()
+        assert groups.max(values)[i] == values[in_group].max()
+        assert groups.first(values)[i] == values[in_group][0]
+        assert groups.last(values)[i] == values[in_group][-1]
+        assert np.isclose(
+            groups.weighted_mean(values, weights)[i],
+            np.average(values[in_group], weights=weights[in_group]),
+        )
+
+
+def test_undrift_locs():
+    """ Drift estimated from the locs of repeatedly imaged sites """
+    random = np.random.RandomState(0)
+    n_frames = 2000
+    size = 64
+    sites = random.uniform(2, size - 2, (200, 2))
+    t = np.arange(n_frames)
+    drift_x = 0.5 * np.sin(3 * t / n_frames) + t / n_frames
+    drift_y = 0.3 * np.cos(5 * t / n_frames)
+    frame = np.repeat(t, 20)
+    site = random.randint(0, len(sites), len(frame))
+    noise = random.normal(0, 0.1, (2, len(frame)))
+    locs = np.rec.array(
+        (
+            frame.astype("u4"),
+            sites[site, 0] + drift_x[frame] + noise[0],
+            sites[site, 1] + drift_y[frame] + noise[1],
+            np.full(len(frame), 0.1),
+            np.full(len(frame), 0.1),
+        ),
+        dtype=[
+            ("frame", "u4"),
+            ("x", "f4"),
+            ("y", "f4"),
+            ("lpx", "f4"),
+            ("lpy", "f4"),
+        ],
+    )
+    info = [{"Height": size, "Width": size, "Frames": n_frames}]
+    drift, locs = postprocess.undrift_locs(locs, info, 100, display=False)
+    assert len(drift) == n_frames
+    # Drift is relative to the first segment
+    inner = slice(100, n_frames - 100)
+    error_x = (drift.x - drift_x)[inner]
+    error_y = (drift.y - drift_y)[inner]
+    assert np.abs(error_x - error_x.mean()).max() < 0.02
+    assert np.abs(error_y - error_y.mean()).max() < 0.02
+
+
+def test_index_blocks():
+    """ Queries of the block index against all locs """
+    from picasso import lib
+
+    random = np.random.RandomState(0)
+    N = 2000
+    size = 16
+    locs = np.rec.array(
+        (
+            random.uniform(0, size, N),
+            random.uniform(0, size, N),
+            np.full(N, 0.1),
+            np.full(N, 0.1),
+        ),
+        dtype=[("x", "f4"), ("y", "f4"), ("lpx", "f4"), ("lpy", "f4")],
+    )
+    info = [{"Height": size, "Width": size}]
+    x = random.uniform(0, size, 100)
+    y = random.uniform(0, size, 100)
+    for block_size, r in [(0.5, 0.5), (0.5, 1.2), (2, 0.7)]:
+        index_blocks = postprocess.IndexBlocks(locs, info, block_size)
+        picked = index_blocks.locs_within(x, y, r)
+        n = index_blocks.n_locs_within(x, y, r)
+        for x_, y_, picked_, n_ in zip(x, y, picked, n):
+            reference = lib.locs_at(x_, y_, locs, r)
+            assert len(picked_) == n_ == len(reference)
+            assert np.array_equal(np.sort(picked_.x), np.sort(reference.x))
+    density = postprocess.compute_local_density(locs, info, 0.5)
+    dx = density.x[:, np.newaxis] - density.x
+    dy = density.y[:, np.newaxis] - density.y
+    d = np.hypot(dx, dy)
+    assert np.array_equal(density.density, (d < 0.5).sum(axis=1))
+    # An index with larger blocks is shared by the pair correlation
+    bins, reference = postprocess.pair_correlation(locs, info, 0.1, 1)
+    index_blocks = postprocess.IndexBlocks(locs, info, 2)
+    bins_, pc = postprocess.pair_correlation(locs, info, 0.1, 1, index_blocks)
+    assert np.array_equal(bins, bins_)
+    assert np.array_equal(pc, reference)
+    dh, _ = np.histogram(d[np.triu_indices(N, 1)], np.arange(0, 1.05, 0.1))
+    assert np.array_equal(
+        postprocess.distance_histogram(locs, info, 0.1, 1, index_blocks)[:10],
+        dh,
+    )
+
+
+def test_dbscan():
+    """ Labels of the grid DBSCAN against scikit-learn """
+    from sklearn.cluster import DBSCAN
+
+    random = np.random.RandomState(0)
+    for n_dims, eps, min_samples in [(2, 0.2, 5), (3, 0.3, 10), (2, 0.1, 1)]:
+        centers = random.uniform(0, 20, (30, n_dims))
+        X = np.concatenate(
+            [
+                centers[random.randint(0, 30, 3000)]
+                + random.normal(0, 0.15, (3000, n_dims)),
+                random.uniform(0, 20, (1000, n_dims)),
+            ]
+        ).astype(np.float32)
+        X = X[random.permutation(len(X))]
+        reference = DBSCAN(eps=eps, min_samples=min_samples).fit(X).labels_
+        labels = postprocess._dbscan(X, eps, min_samples)
+        assert np.array_equal(labels, reference)
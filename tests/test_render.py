@@ -0,0 +1,203 @@
+"""
+Some rudimentary tests.
+"""
+
+import numpy as np
+
+from picasso import render
+
+
+def _render_gaussian_reference(x, y, sx, sy, shape):
+    """ Draws each Gaussian with the 2D exponential, over the full image """
+    i, j = np.mgrid[: shape[0], : shape[1]]
+    image = np.zeros(shape)
+    for x_, y_, sx_, sy_ in zip(x, y, sx, sy):
+        kernel = np.exp(
+            -(
+                (j - x_ + 0.5) ** 2 / (2 * sx_ ** 2)
+                + (i - y_ + 0.5) ** 2 / (2 * sy_ ** 2)
+            )
+        ) / (2 * np.pi * sx_ * sy_)
+        # Only within _DRAW_MAX_SIGMA of the center, as in render.py
+        i_min = max(int(y_ - render._DRAW_MAX_SIGMA * sy_), 0)
+        i_max = int(y_ + render._DRAW_MAX_SIGMA * sy_ + 1)
+        j_min = max(int(x_ - render._DRAW_MAX_SIGMA * sx_), 0)
+        j_max = int(x_ + render._DRAW_MAX_SIGMA * sx_) + 1
+        image[i_min:i_max, j_min:j_max] += kernel[i_min:i_max, j_min:j_max]
+    return image
+
+
+def test_render_gaussian():
+    """ Tiled rendering against the per-loc 2D kernel, across tiles """
+    random = np.random.RandomState(0)
+    N = 500
+    size = 40
+    oversampling = 8
+    locs = np.rec.array(
+        (
+            random.uniform(0, size, N),
+            random.uniform(0, size, N),
+            random.uniform(0.05, 1, N),
+            random.uniform(0.05, 1, N),
+        ),
+        dtype=[("x", "f4"), ("y", "f4"), ("lpx", "f4"), ("lpy", "f4")],
+    )
+    info = [{"Height": size, "Width": size}]
+    n, image = render.render(locs, info, oversampling, blur_method="gaussian")
+    assert n == N
+    assert image.shape == (oversampling * size, oversampling * size)
+    x = oversampling * np.float64(locs.x)
+    y = oversampling * np.float64(locs.y)
+    sx = oversampling * np.float64(locs.lpx)
+    sy = oversampling * np.float64(locs.lpy)
+    reference = _render_gaussian_reference(x, y, sx, sy, image.shape)
+    assert np.allclose(image, reference, rtol=1e-4, atol=1e-6)
+
+
+def test_tile_cache():
+    """ Viewports composited from tiles against a direct histogram """
+    random = np.random.RandomState(0)
+    N = 20000
+    size = 64
+    locs = np.rec.array(
+        (random.uniform(-1, size + 1, N), random.uniform(-1, size + 1, N)),
+        dtype=[("x", "f4"), ("y", "f4")],
+    )
+    info = [{"Height": size, "Width": size}]
+    tile_cache = render.TileCache(locs, info, max_bytes=2 ** 20)
+    tile_cache.ready.wait()
+    for oversampling, viewport in [
+        (1, [(0, 0), (size, size)]),
+        (3, [(-5.5, 10.25), (30, 80)]),
+        (0.1, [(0, 0), (size, size)]),
+        (16, [(20.3, 40.1), (36.7, 45)]),
+    ]:
+        n_locs, image = tile_cache.render(oversampling, viewport)
+        scale = 2.0 ** np.ceil(np.log2(oversampling))
+        (y_min, x_min), (y_max, x_max) = viewport
+        i = np.floor(scale * np.float64(locs.y)) - np.floor(scale * y_min)
+        j = np.floor(scale * np.float64(locs.x)) - np.floor(scale * x_min)
+        in_image = (
+            (locs.x >= 0) & (locs.y >= 0) & (locs.x < size) & (locs.y < size)
+        )
+        in_view = (i >= 0) & (j >= 0)
+        in_view &= (i < image.shape[0]) & (j < image.shape[1])
+        reference = np.zeros(image.shape)
+        np.add.at(
+            reference,
+            (np.int64(i[in_image & in_view]), np.int64(j[in_image & in_view])),
+            1,
+        )
+        assert np.array_equal(image, reference)
+        assert n_locs == reference.sum()
+    # Tiles beyond the budget are evicted, and the index counts towards it
+    assert tile_cache.n_bytes <= 2 ** 20
+    assert tile_cache.n_bytes >= tile_cache.order.nbytes
+    assert np.shares_memory(tile_cache.x, locs.x)
+    tile_cache.close()
+
+
+def test_tile_cache_exact():
+    """
+    Full and aligned exports from tiles against render.render, and the
+    renderings that tiles cannot give exactly
+    """
+    random = np.random.RandomState(0)
+    N = 20000
+    size = 64
+    locs = np.rec.array(
+        (random.uniform(-1, size + 1, N), random.uniform(-1, size + 1, N)),
+        dtype=[("x", "f4"), ("y", "f4")],
+    )
+    info = [{"Height": size, "Width": size}]
+    tile_cache = render.TileCache(locs, info, max_bytes=2 ** 20)
+    tile_cache.ready.wait()
+    for oversampling, viewport in [
+        (1, [(0, 0), (size, size)]),
+        (8, [(0, 0), (size, size)]),
+        (0.25, [(0, 0), (size, size)]),
+        (4, [(10.25, 20.5), (30.5, 45)]),
+    ]:
+        n_locs, image = tile_cache.render(oversampling, viewport, exact=True)
+        reference = render.render(locs, info, oversampling, viewport)
+        assert n_locs == reference[0]
+        assert np.array_equal(image, reference[1])
+    for oversampling, viewport in [
+        (5, [(0, 0), (size, size)]),
+        (3, [(0, 0), (size, size)]),
+        (4, [(10.1, 20), (30, 45)]),
+        (4, [(10, 20), (30.1, 45)]),
+        (0.25, [(0, 0), (30, 30)]),
+    ]:
+        assert tile_cache.render(oversampling, viewport, exact=True) is None
+        assert tile_cache.render(oversampling, viewport) is not None
+    tile_cache.close()
+
+
+def test_segment():
+    """ Segments of unsorted locs against masking each segment """
+    random = np.random.RandomState(0)
+    N = 5000
+    size = 32
+    n_frames = 1000
+    locs = np.rec.array(
+        (
+            random.randint(0, n_frames, N).astype("u4"),
+            random.uniform(0, size, N),
+            random.uniform(0, size, N),
+        ),
+        dtype=[("frame", "u4"), ("x", "f4"), ("y", "f4")],
+    )
+    info = [{"Height": size, "Width": size, "Frames": n_frames}]
+    bounds, segments = render.segment(locs, info, 100)
+    assert len(bounds) == 11
+    assert segments.shape == (10, size, size)
+    for i, image in enumerate(segments):
+        in_segment = (locs.frame >= bounds[i]) & (locs.frame < bounds[i + 1])
+        _, reference = render.render(locs[in_segment], info)
+        assert np.array_equal(image, reference)
+
+
+def test_segment_gaussian(monkeypatch):
+    """
+    Blurred segments against render.render, drawn without a thread pool
+    inside each segment worker
+    """
+    monkeypatch.setenv("PICASSO_THREADS", "4")
+    pools = []
+
+    class Executor(render._ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            super().__init__(*args, **kwargs)
+
+    random = np.random.RandomState(0)
+    N = 5000
+    size = 32
+    n_frames = 1000
+    locs = np.rec.array(
+        (
+            np.sort(random.randint(0, n_frames, N)).astype("u4"),
+            random.uniform(0, size, N),
+            random.uniform(0, size, N),
+            random.uniform(0.05, 1, N),
+            random.uniform(0.05, 1, N),
+        ),
+        dtype=[
+            ("frame", "u4"),
+            ("x", "f4"),
+            ("y", "f4"),
+            ("lpx", "f4"),
+            ("lpy", "f4"),
+        ],
+    )
+    info = [{"Height": size, "Width": size, "Frames": n_frames}]
+    kwargs = {"oversampling": 8, "blur_method": "gaussian"}
+    monkeypatch.setattr(render, "_ThreadPoolExecutor", Executor)
+    bounds, segments = render.segment(locs, info, 100, kwargs)
+    # Only the pool of segment workers
+    assert len(pools) == 1
+    for i, image in enumerate(segments):
+        in_segment = (locs.frame >= bounds[i]) & (locs.frame < bounds[i + 1])
+        _, reference = render.render(locs[in_segment], info, **kwargs)
+        assert np.allclose(image, reference, rtol=1e-5, atol=1e-6)